@@ -1,16 +1,158 @@
-from fastapi import FastAPI, HTTPException
+from fastapi import FastAPI, HTTPException, Request
+from fastapi.responses import JSONResponse, PlainTextResponse, StreamingResponse
 from pydantic import BaseModel
 import torch
-from transformers import AutoTokenizer, AutoModelForCausalLM
+from transformers import AutoTokenizer, AutoModelForCausalLM, LogitsProcessorList, StoppingCriteriaList
 import uvicorn
+import argparse
 import asyncio
-from typing import Dict, Any
+import gc
+import json
+import os
+import sys
+import threading
+import time
+from typing import Dict, Any, AsyncIterator, Awaitable, Callable, List, NamedTuple, Optional, Sequence, Tuple, Union
 import logging
 
+from backends import select_backend
+from catalog import CatalogIndex, snippet
+from constrained import ConstrainedAnswers, template_fields
+from multiprocess import configure_threads, share_weights, worker_layout
+from intents import IntentClassifier, reply_fields
+from inference import InferenceExecutor, InferenceRejectedError, MicroBatcher, ordered_map
+from load_shedding import LoadController, LoadThresholds
+from metrics import (
+    DEGRADATIONS, DRAFT_TOKENS, FALLBACKS, GENERATED_TOKENS, REGISTRY, REQUEST_SECONDS, RESPONSES, STAGE_SECONDS, TOKENS_PER_SECOND,
+    begin_request, record_stage, stage_timer
+)
+from prepare_model import DEFAULT_BUNDLE_DIR, DEFAULT_MODEL, bundle_ready, prepare, write_bundle
+from postprocess import REPLY_FORMATS, PostProcessor
+from prefix_cache import CachedPrefix, PrefixKVCache, assemble_prefixed_batch, snapshot_row
+from prompt_builder import PromptBuilder, Segment, render
+from response_cache import ResponseCache, stock_status
+from scheduler import FairScheduler, parse_mapping
+from sessions import SessionStore, kv_bytes_per_token
+from singleflight import SingleFlight
+from speculative import PromptLookupDrafter, SpeculativeDecoder, sampling_processors
+from stopping import GenerationTimer, ReplyRules, ReplyStoppingCriteria
+from streaming import AsyncTextStreamer, DuplexStreamingResponse, StopOnEvent, StreamingReplyFilter, format_sse
+
 # Configure logging
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+# Model source; a prepared bundle in the cache volume is loaded offline when present
+MODEL_NAME = os.getenv("MODEL_NAME", DEFAULT_MODEL)
+MODEL_BUNDLE_DIR = os.getenv("MODEL_BUNDLE_DIR", DEFAULT_BUNDLE_DIR)
+# Write the bundle after a hub download so the next restart is offline
+PREPARE_MODEL_BUNDLE = os.getenv("PREPARE_MODEL_BUNDLE", "true").lower() == "true"
+
+# Number of uvicorn worker processes; they share the bundle's weights through one
+# copy-on-write mapping when SHARE_WEIGHTS is on and the float32 backend is served
+SERVER_WORKERS = int(os.getenv("SERVER_WORKERS", "1"))
+SHARE_WEIGHTS = os.getenv("SHARE_WEIGHTS", "true").lower() == "true"
+
+# Inference worker pool settings
+INFERENCE_WORKERS = int(os.getenv("INFERENCE_WORKERS", "1"))
+INFERENCE_MAX_QUEUE = int(os.getenv("INFERENCE_MAX_QUEUE", "16"))
+INFERENCE_TIMEOUT = float(os.getenv("INFERENCE_TIMEOUT", "15"))
+# Answer with 503 instead of a fallback response when the pool is saturated
+REJECT_ON_OVERLOAD = os.getenv("REJECT_ON_OVERLOAD", "false").lower() == "true"
+
+# Request scheduling ("name:value,..." lists): a free worker takes the waiting job with the lowest
+# class priority number first, shared across sellers by weighted fair queuing (weight 1 unless
+# listed). Classes are the endpoints plus chat_batch for /chat/batch items. Work still queued past
+# its class deadline (default INFERENCE_TIMEOUT) is dropped
+SCHEDULER_PRIORITIES = parse_mapping(os.getenv("SCHEDULER_PRIORITIES", "chat:0,website_helper:1,chat_batch:2"))
+SCHEDULER_SELLER_WEIGHTS = parse_mapping(os.getenv("SCHEDULER_SELLER_WEIGHTS", ""))
+SCHEDULER_DEADLINES = parse_mapping(os.getenv("SCHEDULER_DEADLINES", "chat_batch:300"))
+
+# Adaptive load shedding: pressure is the largest of recent queue wait, recent
+# prefill+decode time and current queue depth relative to these targets
+LOAD_SHEDDING = os.getenv("LOAD_SHEDDING", "true").lower() == "true"
+LOAD_SHED_QUEUE_WAIT_MS = float(os.getenv("LOAD_SHED_QUEUE_WAIT_MS", "500"))
+LOAD_SHED_LATENCY_MS = float(os.getenv("LOAD_SHED_LATENCY_MS", "4000"))
+LOAD_SHED_QUEUE_DEPTH = int(os.getenv("LOAD_SHED_QUEUE_DEPTH", "8"))
+# Pressure at which max_new_tokens shrinks, low-value intents get the fallback and the website helper is shed
+LOAD_SHED_REDUCE_TOKENS_AT = float(os.getenv("LOAD_SHED_REDUCE_TOKENS_AT", "1.0"))
+LOAD_SHED_LOW_VALUE_AT = float(os.getenv("LOAD_SHED_LOW_VALUE_AT", "1.5"))
+LOAD_SHED_WEBSITE_HELPER_AT = float(os.getenv("LOAD_SHED_WEBSITE_HELPER_AT", "2.0"))
+# Smallest fraction of max_new_tokens kept under load
+LOAD_SHED_MIN_TOKEN_SCALE = float(os.getenv("LOAD_SHED_MIN_TOKEN_SCALE", "0.5"))
+LOAD_SHED_LOW_VALUE_INTENTS = [
+    label.strip() for label in os.getenv("LOAD_SHED_LOW_VALUE_INTENTS", "greeting,thanks").split(",") if label.strip()
+]
+# Seconds for the latency signals to halve once generations stop
+LOAD_SHED_HALF_LIFE = float(os.getenv("LOAD_SHED_HALF_LIFE", "5"))
+
+# Micro-batching settings (BATCH_MAX_SIZE=1 disables batching)
+BATCH_MAX_SIZE = int(os.getenv("BATCH_MAX_SIZE", "4"))
+BATCH_MAX_WAIT_MS = float(os.getenv("BATCH_MAX_WAIT_MS", "10"))
+
+# /chat/batch and `app.py --batch`: requests in flight per JSONL stream and the longest accepted line.
+# Their items are scheduled in the CHAT_BATCH_CLASS priority class and wait instead of being shed
+CHAT_BATCH_CLASS = "chat_batch"
+CHAT_BATCH_WINDOW = int(os.getenv("CHAT_BATCH_WINDOW", "8"))
+CHAT_BATCH_MAX_LINE_BYTES = int(os.getenv("CHAT_BATCH_MAX_LINE_BYTES", str(64 * 1024)))
+
+# Number of (template, seller name) system prompt prefixes kept prefilled
+PREFIX_CACHE_SIZE = int(os.getenv("PREFIX_CACHE_SIZE", "16"))
+
+# Response cache settings (RESPONSE_CACHE_SIZE=0 disables the local tier)
+RESPONSE_CACHE_SIZE = int(os.getenv("RESPONSE_CACHE_SIZE", "1024"))
+RESPONSE_CACHE_MAX_BYTES = int(os.getenv("RESPONSE_CACHE_MAX_BYTES", str(8 * 1024 * 1024)))
+RESPONSE_CACHE_TTL = float(os.getenv("RESPONSE_CACHE_TTL", "600"))
+RESPONSE_CACHE_REDIS_URL = os.getenv("RESPONSE_CACHE_REDIS_URL", "")
+
+# Multi-turn chat sessions keyed by ChatRequest.context["chat_id"]; each keeps the KV states
+# of its last prompt (up to CHAT_SESSION_MAX_MB, CHAT_SESSIONS_MAX_MB in total) and a text
+# history of its last CHAT_SESSION_MAX_TURNS turns for rebuilding the prompt.
+# CHAT_SESSION_MAX_MB=0 sizes the per-session cap to a full-length chat prompt of the loaded model
+CHAT_SESSIONS = os.getenv("CHAT_SESSIONS", "true").lower() == "true"
+CHAT_SESSIONS_MAX = int(os.getenv("CHAT_SESSIONS_MAX", "256"))
+CHAT_SESSION_TTL = float(os.getenv("CHAT_SESSION_TTL", "1800"))
+CHAT_SESSION_MAX_MB = float(os.getenv("CHAT_SESSION_MAX_MB", "0"))
+CHAT_SESSIONS_MAX_MB = float(os.getenv("CHAT_SESSIONS_MAX_MB", "256"))
+CHAT_SESSION_MAX_TURNS = int(os.getenv("CHAT_SESSION_MAX_TURNS", "8"))
+# Prompt tokens a new turn needs on top of the snapshot; with less room the prompt is rebuilt
+CHAT_SESSION_TURN_TOKENS = int(os.getenv("CHAT_SESSION_TURN_TOKENS", "96"))
+
+# Identical requests (same response cache key) that arrive together share one generation
+COALESCE_REQUESTS = os.getenv("COALESCE_REQUESTS", "true").lower() == "true"
+
+# Speculative decoding: draft up to SPECULATIVE_DRAFT_TOKENS tokens by looking up the trailing
+# n-gram (at most SPECULATIVE_MAX_NGRAM tokens) in the prompt and verify them in one forward pass.
+# Batched requests are then decoded one row at a time; streaming keeps plain generate()
+SPECULATIVE_DECODING = os.getenv("SPECULATIVE_DECODING", "false").lower() == "true"
+SPECULATIVE_DRAFT_TOKENS = int(os.getenv("SPECULATIVE_DRAFT_TOKENS", "8"))
+SPECULATIVE_MAX_NGRAM = int(os.getenv("SPECULATIVE_MAX_NGRAM", "3"))
+
+# CPU inference backend: float32, int8, bfloat16, compile or auto (fastest that passes the self-benchmark).
+# auto is opt-in: it benchmarks every backend on each start and may pick a different one between runs
+INFERENCE_BACKEND = os.getenv("INFERENCE_BACKEND", "float32").lower()
+# Minimum greedy next-token agreement with float32 for a converted backend to be used
+BACKEND_MIN_AGREEMENT = float(os.getenv("BACKEND_MIN_AGREEMENT", "0.9"))
+
+# Answer confident FAQ intents (shipping, returns, thanks, account) from templates without the model
+INTENT_PREROUTE = os.getenv("INTENT_PREROUTE", "true").lower() == "true"
+# Minimum share of the matched trigger phrases the FAQ intent must hold to be pre-routed
+INTENT_PREROUTE_MIN_SCORE = float(os.getenv("INTENT_PREROUTE_MIN_SCORE", "0.75"))
+
+# Start price, stock and spec replies from a template filled with product_info facts; the
+# model only writes the rest of the sentence and cannot generate digits while doing so
+CONSTRAINED_ANSWERS = os.getenv("CONSTRAINED_ANSWERS", "true").lower() == "true"
+
+# Local product catalog export (JSON or JSONL); products a question mentions are added to its prompt
+CATALOG_PATH = os.getenv("CATALOG_PATH", "")
+# Seconds between checks of the export for changes; only changed products are re-indexed
+CATALOG_REFRESH_SECONDS = float(os.getenv("CATALOG_REFRESH_SECONDS", "60"))
+# Related product snippets per prompt; they are the first text trimmed to fit the token budget
+CATALOG_TOP_K = int(os.getenv("CATALOG_TOP_K", "2"))
+# Optional sentence-transformers model for semantic catalog search and the cosine a match needs
+CATALOG_EMBEDDING_MODEL = os.getenv("CATALOG_EMBEDDING_MODEL", "")
+CATALOG_MIN_SIMILARITY = float(os.getenv("CATALOG_MIN_SIMILARITY", "0.5"))
+
 app = FastAPI(title="SmolLM2 AI Chat Service", version="1.0.0")
 
 class ChatRequest(BaseModel):
@@ -31,6 +173,46 @@ class WebsiteHelperResponse(BaseModel):
     response: str
     confidence: float = 0.9
 
+async def iter_jsonl_lines(chunks: AsyncIterator[bytes], max_line_bytes: int) -> AsyncIterator[Optional[bytes]]:
+    """Split a byte stream into non-empty lines; a line longer than ``max_line_bytes`` is yielded as None"""
+    buffer = b""
+    oversized = False
+    async for chunk in chunks:
+        buffer += chunk
+        while True:
+            newline = buffer.find(b"\n")
+            if newline < 0:
+                break
+            line, buffer = buffer[:newline], buffer[newline + 1:]
+            if oversized or len(line) > max_line_bytes:
+                oversized = False
+                yield None
+            elif line.strip():
+                yield line
+        # Never hold more than one line's worth of an oversized line in memory
+        if len(buffer) > max_line_bytes:
+            buffer, oversized = b"", True
+    if oversized:
+        yield None
+    elif buffer.strip():
+        yield buffer
+
+class BatchItem(NamedTuple):
+    """One prompt of a generate() batch"""
+    # Prefix cache key of a static prefix
+    prefix_key: Tuple
+    # Static system prompt (prefilled once through the prefix cache) or a session snapshot
+    prefix: Union[str, CachedPrefix]
+    suffix: List[Segment]
+    # Reply cue; it doubles as a role marker that ends the reply
+    cue: str
+    # Return this prompt's key/value states with the reply
+    snapshot: bool = False
+    # Template lead the reply starts with; it is appended to the prompt and the reply
+    lead: str = ""
+    # Intent label of the lead, counted when the lead goes into a prompt
+    lead_label: str = ""
+
 class SmolLM2ChatModel:
     def __init__(self):
         self.model = None
@@ -38,32 +220,209 @@ class SmolLM2ChatModel:
         self.device = "cuda" if torch.cuda.is_available() else "cpu"
         self.max_length = 400  # Reduced for better context management
         self.temperature = 0.3  # Much lower for consistency
+        self.load_state = "not_loaded"
+        self.shared_weight_bytes = 0
+        self.backend_report = {"selected": "float16" if self.device == "cuda" else "float32"}
+        self.scheduler = FairScheduler(
+            priorities=SCHEDULER_PRIORITIES,
+            deadlines=SCHEDULER_DEADLINES,
+            weights=SCHEDULER_SELLER_WEIGHTS,
+            default_deadline=INFERENCE_TIMEOUT
+        )
+        self.executor = InferenceExecutor(
+            workers=INFERENCE_WORKERS,
+            max_queue=INFERENCE_MAX_QUEUE,
+            default_timeout=INFERENCE_TIMEOUT,
+            scheduler=self.scheduler
+        )
+        self.batcher = MicroBatcher(
+            self.executor,
+            self._generate_batch,
+            max_batch_size=BATCH_MAX_SIZE,
+            max_wait_ms=BATCH_MAX_WAIT_MS
+        )
+        self.prefix_cache = PrefixKVCache(max_entries=PREFIX_CACHE_SIZE)
+        self.prompt_builder = PromptBuilder()
+        self.response_cache = ResponseCache(
+            max_entries=RESPONSE_CACHE_SIZE,
+            max_bytes=RESPONSE_CACHE_MAX_BYTES,
+            ttl=RESPONSE_CACHE_TTL,
+            redis_url=RESPONSE_CACHE_REDIS_URL or None
+        )
+        self.intents = IntentClassifier()
+        self.postprocessor = PostProcessor()
+        self.constrained = ConstrainedAnswers(enabled=CONSTRAINED_ANSWERS)
+        self.catalog = CatalogIndex(
+            CATALOG_PATH, embedding_model=CATALOG_EMBEDDING_MODEL, min_similarity=CATALOG_MIN_SIMILARITY
+        )
+        self.single_flight = SingleFlight()
+        self.sessions = SessionStore(
+            max_sessions=CHAT_SESSIONS_MAX,
+            ttl=CHAT_SESSION_TTL,
+            # Until the model is loaded and the cap sized from it, only the total cap applies
+            max_session_bytes=int((CHAT_SESSION_MAX_MB or CHAT_SESSIONS_MAX_MB) * 1024 * 1024),
+            max_total_bytes=int(CHAT_SESSIONS_MAX_MB * 1024 * 1024),
+            max_turns=CHAT_SESSION_MAX_TURNS
+        )
+        self.speculative = SpeculativeDecoder(
+            PromptLookupDrafter(num_tokens=SPECULATIVE_DRAFT_TOKENS, max_ngram=SPECULATIVE_MAX_NGRAM)
+        )
+        self.load = LoadController(
+            lambda: self.executor.queue_depth,
+            LoadThresholds(
+                queue_wait=LOAD_SHED_QUEUE_WAIT_MS / 1000.0,
+                latency=LOAD_SHED_LATENCY_MS / 1000.0,
+                queue_depth=LOAD_SHED_QUEUE_DEPTH,
+                reduce_tokens_at=LOAD_SHED_REDUCE_TOKENS_AT,
+                low_value_at=LOAD_SHED_LOW_VALUE_AT,
+                shed_website_helper_at=LOAD_SHED_WEBSITE_HELPER_AT,
+                min_token_scale=LOAD_SHED_MIN_TOKEN_SCALE,
+            ),
+            low_value_intents=LOAD_SHED_LOW_VALUE_INTENTS,
+            half_life=LOAD_SHED_HALF_LIFE,
+            enabled=LOAD_SHEDDING
+        )
+        # Per-endpoint generation settings; batches are never mixed across endpoints
+        self.generation_configs = {
+            "chat": {
+                "max_length": 400,  # Reduced to keep context focused
+                "max_new_tokens": 50,  # Much shorter responses
+                "temperature": 0.3,    # Much lower temperature for consistency
+                "top_p": 0.7,         # Lower top_p for more focused responses
+                "repetition_penalty": 1.3,  # Higher repetition penalty
+                "no_repeat_ngram_size": 2,
+                # Stop decoding once the post-processor would cut: 2 sentences, a role marker or 200 chars
+                "reply_rules": REPLY_FORMATS["chat"].stopping_rules(),
+            },
+            "website_helper": {
+                "max_length": 300,  # Shorter for website help
+                "max_new_tokens": 25,  # Much shorter responses
+                "temperature": 0.1,    # Very low temperature for consistency
+                "top_p": 0.5,          # Much lower for focused responses
+                "repetition_penalty": 1.5,
+                "no_repeat_ngram_size": 3,
+                # Only the first "."-terminated sentence is kept
+                "reply_rules": REPLY_FORMATS["website_helper"].stopping_rules(),
+            },
+        }
         
+    @property
+    def ready(self) -> bool:
+        """True once the model is loaded and warmed up; until then requests get fallbacks"""
+        return self.load_state == "ready"
+    
     async def load_model(self):
-        """Load the SmolLM2-135M model from HuggingFace"""
+        """Load the SmolLM2-135M model off the event loop, preferring the local bundle"""
+        return await asyncio.get_running_loop().run_in_executor(None, self._load_model_sync)
+    
+    def _load_model_sync(self) -> bool:
+        """Load, optimize and warm up the model; the service is ready once this returns True"""
         try:
-            logger.info("Loading SmolLM2-135M model...")
-            model_name = "HuggingFaceTB/SmolLM2-135M"
+            self.load_state = "loading"
+            if bundle_ready(MODEL_BUNDLE_DIR):
+                # Offline load of the prepared safetensors bundle (memory-mapped, no hub lookups)
+                logger.info(f"Loading SmolLM2-135M model from bundle {MODEL_BUNDLE_DIR}...")
+                source, local_only = MODEL_BUNDLE_DIR, True
+            else:
+                logger.info("Loading SmolLM2-135M model...")
+                source, local_only = MODEL_NAME, False
             
-            self.tokenizer = AutoTokenizer.from_pretrained(model_name)
-            self.model = AutoModelForCausalLM.from_pretrained(
-                model_name,
+            tokenizer = AutoTokenizer.from_pretrained(source, local_files_only=local_only)
+            model = AutoModelForCausalLM.from_pretrained(
+                source,
                 torch_dtype=torch.float16 if self.device == "cuda" else torch.float32,
                 device_map="auto" if self.device == "cuda" else None,
-                trust_remote_code=True
+                trust_remote_code=True,
+                local_files_only=local_only,
+                low_cpu_mem_usage=True
             )
             
-            if self.tokenizer.pad_token is None:
-                self.tokenizer.pad_token = self.tokenizer.eos_token
-                
+            # Point the weights at the bundle's shared mapping instead of a private copy
+            if local_only and SHARE_WEIGHTS and self.device == "cpu":
+                self.shared_weight_bytes = share_weights(model, MODEL_BUNDLE_DIR)
+                gc.collect()
+            
+            # Write the bundle so the next restart skips the download and hub resolution
+            if not local_only and PREPARE_MODEL_BUNDLE and self.device == "cpu":
+                try:
+                    write_bundle(model, tokenizer, MODEL_BUNDLE_DIR, MODEL_NAME)
+                except Exception as e:
+                    logger.warning(f"Could not write model bundle: {e}")
+            
+            if tokenizer.pad_token is None:
+                tokenizer.pad_token = tokenizer.eos_token
+            # Left padding keeps every prompt flush against its generated tokens in a batch
+            tokenizer.padding_side = "left"
+            
+            # Swap in a quantized/bf16/compiled variant if it benchmarks well on this CPU
+            if self.device == "cpu":
+                probe_prompt = self.create_context_prompt(
+                    "Is this in stock?",
+                    {"name": "GeForce RTX 4070", "price": 599.99, "category": "Graphics Cards", "stock": 12},
+                    "Seller"
+                )
+                model, self.backend_report = select_backend(
+                    model,
+                    tokenizer,
+                    INFERENCE_BACKEND,
+                    probe_prompt,
+                    min_agreement=BACKEND_MIN_AGREEMENT
+                )
+                # Converted backends hold private weights; only float32/compile keep the mapping
+                if self.backend_report["selected"] not in ("float32", "compile"):
+                    self.shared_weight_bytes = 0
+                gc.collect()
+            
+            self.prefix_cache.clear()
+            self.prompt_builder.clear()
+            self.sessions.clear()
+            if not CHAT_SESSION_MAX_MB:
+                # A snapshot holds at most one full chat prompt's key/value states
+                self.sessions.max_session_bytes = kv_bytes_per_token(
+                    model.config, torch.empty(0, dtype=model.dtype).element_size()
+                ) * self.generation_configs["chat"]["max_length"]
+                logger.info(f"Chat session snapshots capped at {self.sessions.max_session_bytes / 1e6:.1f} MB")
+            # Requests wait for load_state "ready", so they never run alongside the warm-up
+            self.tokenizer = tokenizer
+            self.model = model
             logger.info(f"Model loaded successfully on {self.device}")
+            
+            self.load_state = "warming_up"
+            self._warm_up()
+            self.load_state = "ready"
             return True
         except Exception as e:
+            self.load_state = "failed"
             logger.error(f"Failed to load model: {e}")
             return False
     
-    def create_context_prompt(self, message: str, product_info: Dict, seller_name: str) -> str:
+    def _warm_up(self):
+        """Run one generation per endpoint so the first real request does not pay for lazy init"""
+        started = time.perf_counter()
+        prefix, suffix = self.create_context_prompt_parts("Hello, is this in stock?", {"name": "Graphics Card", "stock": 3}, "Seller")
+        self._generate_batch("chat", [BatchItem(("chat", "Seller"), prefix, suffix, "Seller:")])
+        prefix, suffix = self.create_website_helper_prompt_parts("How do I find a product?", {"currentPage": "/"})
+        self._generate_batch("website_helper", [BatchItem(("website_helper",), prefix, suffix, "Answer:")])
+        logger.info(f"Model warm-up finished in {time.perf_counter() - started:.2f}s")
+    
+    def create_context_prompt(self, message: str, product_info: Dict, seller_name: str, related: Sequence[str] = ()) -> str:
         """Create a highly structured prompt for professional seller behavior"""
+        prefix, suffix = self.create_context_prompt_parts(message, product_info, seller_name, related=related)
+        return prefix + render(suffix)
+    
+    def create_context_prompt_parts(
+        self,
+        message: str,
+        product_info: Dict,
+        seller_name: str,
+        history: Sequence[Tuple[str, str]] = (),
+        related: Sequence[str] = ()
+    ) -> Tuple[str, List[Segment]]:
+        """Split the seller prompt into its static system prefix and per-request suffix segments
+        
+        ``history`` holds earlier (customer message, reply) turns of a session and
+        ``related`` catalog snippets of other products the message mentions.
+        """
         
         # Start with clear role definition and constraints
         system_prompt = f"""You are {seller_name}, a professional customer service representative at Componentary, an e-commerce platform specializing in PC components and technology products.
@@ -76,422 +435,826 @@ STRICT GUIDELINES:
 - Always stay in character as a seller
 - Provide accurate information about products when available"""
 
-        # Add product context if available
-        product_context = ""
+        # Add product context if available; the description and the message are the
+        # only fields trimmed to fit the token budget, the description first
+        suffix = []
         if product_info:
-            product_context = "\nCURRENT PRODUCT CONTEXT:\n"
+            suffix.append(Segment("\nCURRENT PRODUCT CONTEXT:\n"))
             if product_info.get('name'):
-                product_context += f"Product: {product_info['name']}\n"
+                suffix.append(Segment(f"Product: {product_info['name']}\n"))
             if product_info.get('price'):
-                product_context += f"Price: ${product_info['price']}\n"
+                suffix.append(Segment(f"Price: ${product_info['price']}\n"))
             if product_info.get('category'):
-                product_context += f"Category: {product_info['category']}\n"
+                suffix.append(Segment(f"Category: {product_info['category']}\n"))
             if product_info.get('description'):
                 desc = product_info['description'][:150] + "..." if len(product_info['description']) > 150 else product_info['description']
-                product_context += f"Description: {desc}\n"
+                suffix += [Segment("Description:"), Segment(f" {desc}", trim="head", priority=0), Segment("\n")]
             if product_info.get('stock') is not None:
                 stock_status = "Available" if product_info['stock'] > 0 else "Out of stock"
-                product_context += f"Stock: {stock_status}\n"
+                suffix.append(Segment(f"Stock: {stock_status}\n"))
+        if related:
+            suffix.append(self._related_segment(related))
         
-        # Create the conversation format
-        conversation = f"""
-{system_prompt}{product_context}
-
-Customer: {message}
-{seller_name}: """
+        # Create the conversation format; the system prefix only varies by seller
+        # name, so its KV states are cached and shared between requests. The seller
+        # cue comes last so it is never trimmed; of a long message the end is kept
+        prefix = f"""
+{system_prompt}"""
+        if history:
+            # Earlier turns give way first; of a long history the latest turns are kept
+            transcript = "".join(f"\n\nCustomer: {question}\n{seller_name}: {answer}" for question, answer in history)
+            suffix.append(Segment(transcript, trim="tail", priority=-1))
+        suffix += [
+            Segment("\n\nCustomer:"),
+            Segment(f" {message}", trim="tail", priority=1, min_tokens=8),
+            Segment(f"\n{seller_name}: "),
+        ]
         
-        return conversation
+        return prefix, suffix
     
-    async def generate_response(self, message: str, product_info: Dict, seller_name: str) -> str:
+    async def generate_response(self, message: str, product_info: Dict, seller_name: str, chat_id: Optional[str] = None) -> str:
         """Generate AI response using SmolLM2 model with strict controls"""
+        response, _ = await self._answer_chat(message, product_info, seller_name, chat_id)
+        return response
+    
+    async def _answer_chat(self, message: str, product_info: Dict, seller_name: str, chat_id: Optional[str] = None, bulk: bool = False) -> Tuple[str, bool]:
+        """Seller reply and whether it is a fallback
+        
+        ``bulk`` requests (/chat/batch items) are generated in the CHAT_BATCH_CLASS
+        priority class and are never shed; they wait for a worker instead.
+        """
+        if chat_id and CHAT_SESSIONS:
+            return await self._generate_session_response(message, product_info, seller_name, str(chat_id), bulk)
         try:
-            if not self.model or not self.tokenizer:
-                return self._fallback_response(message, product_info)
+            routed = self._preroute("chat", message, reply_fields(product_info))
+            if routed:
+                return routed, False
             
-            # Create highly structured prompt
-            prompt = self.create_context_prompt(message, product_info, seller_name)
+            if not self.ready:
+                return self._fallback_response(message, product_info, reason="model_not_loaded"), True
             
-            # Tokenize input with careful length management
-            inputs = self.tokenizer(
-                prompt, 
-                return_tensors="pt", 
-                max_length=400,  # Reduced to keep context focused
-                truncation=True,
-                padding=True
-            )
-            inputs = {k: v.to(self.device) for k, v in inputs.items()}
-            
-            # Generate response with strict parameters
-            with torch.no_grad():
-                outputs = self.model.generate(
-                    **inputs,
-                    max_new_tokens=50,  # Much shorter responses
-                    temperature=0.3,    # Much lower temperature for consistency
-                    do_sample=True,
-                    pad_token_id=self.tokenizer.pad_token_id,
-                    eos_token_id=self.tokenizer.eos_token_id,
-                    top_p=0.7,         # Lower top_p for more focused responses
-                    repetition_penalty=1.3,  # Higher repetition penalty
-                    no_repeat_ngram_size=2,
-                    early_stopping=True
-                )
-            
-            # Decode and extract response
-            full_response = self.tokenizer.decode(outputs[0], skip_special_tokens=True)
-            logger.debug(f"Full model response: {full_response}")
-            
-            # Extract only the AI response part
-            if f"{seller_name}:" in full_response:
-                response = full_response.split(f"{seller_name}:")[-1].strip()
-            else:
-                # Fallback extraction
-                response = full_response[len(prompt):].strip()
+            # Repeated questions about the same product are answered from cache; factual questions
+            # start from a template lead, so its exact figures are part of the key
+            lead, lead_label = self._answer_lead(message, product_info)
+            cache_key = self._chat_cache_key(message, product_info, seller_name, lead)
+            with stage_timer("chat", "cache_lookup"):
+                cached = await self.response_cache.get(cache_key)
+            if cached:
+                RESPONSES.inc(endpoint="chat", source="cache")
+                return cached, False
             
-            logger.debug(f"Extracted response: {response}")
+            # Under overload low-value messages are not worth a slot on the pool
+            shed = "" if bulk else self._shed("chat", message)
+            if shed:
+                return self._fallback_response(message, product_info, reason=shed), True
             
-            # Strict response cleaning
-            response = self._clean_response_strict(response)
-            logger.debug(f"Cleaned response: {response}")
-            
-            # Validate response quality
-            if not self._is_valid_response(response, message):
-                logger.info(f"Generated response failed validation, using fallback")
-                return self._fallback_response(message, product_info)
-                
-            return response if response else self._fallback_response(message, product_info)
+            # A live request must not end up waiting on a bulk item's generation
+            return await self._coalesce(
+                "chat", f"{CHAT_BATCH_CLASS}:{cache_key}" if bulk else cache_key,
+                lambda: self._generate_chat_reply(message, product_info, seller_name, cache_key, lead, lead_label, bulk)
+            )
             
+        except InferenceRejectedError as e:
+            logger.warning(f"Chat generation rejected ({e.reason}): {e}")
+            if REJECT_ON_OVERLOAD:
+                RESPONSES.inc(endpoint="chat", source="rejected")
+                raise
+            return self._fallback_response(message, product_info, reason=e.reason), True
         except Exception as e:
             logger.error(f"Error generating response: {e}")
-            return self._fallback_response(message, product_info)
+            return self._fallback_response(message, product_info, reason="error"), True
     
-    def _clean_response_strict(self, response: str) -> str:
-        """Strictly clean and format the AI response"""
-        if not response:
-            return ""
-            
-        # Remove any unwanted tokens or artifacts
-        response = response.strip()
-        
-        # Remove any incomplete sentences or weird artifacts
-        lines = response.split('\n')
-        cleaned_lines = []
-        
-        for line in lines:
-            line = line.strip()
-            if line and not line.startswith(('Customer:', 'User:', 'Human:')):
-                # Stop at any role indicators that might leak through
-                if ':' in line and any(role in line.lower() for role in ['customer', 'user', 'human', 'assistant']):
-                    break
-                cleaned_lines.append(line)
+    async def _generate_session_response(self, message: str, product_info: Dict, seller_name: str, chat_id: str, bulk: bool = False) -> Tuple[str, bool]:
+        """Answer one turn of a conversation session and record it, returning the reply and whether it is a fallback
         
-        response = ' '.join(cleaned_lines).strip()
+        Session turns depend on the conversation so far, so they bypass the
+        response cache and request coalescing.
+        """
+        fingerprint = self._session_fingerprint(product_info, seller_name)
+        snapshot, lead = None, ""
+        is_fallback = False
+        try:
+            response = self._preroute("chat", message, reply_fields(product_info))
+            if not response and not self.ready:
+                response, is_fallback = self._fallback_response(message, product_info, reason="model_not_loaded"), True
+            if not response and not bulk:
+                shed = self._shed("chat", message)
+                if shed:
+                    response, is_fallback = self._fallback_response(message, product_info, reason=shed), True
+            if not response:
+                related = await self._related_products("chat", message, [product_info.get('name')])
+                item = self._session_item(chat_id, fingerprint, message, product_info, seller_name, related)
+                submitted = time.perf_counter()
+                response, generation = await self.batcher.submit(
+                    "chat", item, flow=seller_name, priority_class=CHAT_BATCH_CLASS if bulk else None
+                )
+                self._record_generation("chat", generation, time.perf_counter() - submitted, observe_load=not bulk)
+                snapshot, lead = generation["snapshot"], item.lead
+                
+                if generation["valid"]:
+                    RESPONSES.inc(endpoint="chat", source="model")
+                else:
+                    logger.info("Generated session response failed validation, using fallback")
+                    response, is_fallback = self._fallback_response(message, product_info, reason="validation_failed"), True
+                # The snapshot prompt ends with the template lead; only a reply that continues it fits
+                if not response.startswith(lead):
+                    snapshot = None
+        except InferenceRejectedError as e:
+            logger.warning(f"Session chat generation rejected ({e.reason}): {e}")
+            if REJECT_ON_OVERLOAD:
+                RESPONSES.inc(endpoint="chat", source="rejected")
+                raise
+            response, is_fallback = self._fallback_response(message, product_info, reason=e.reason), True
+        except Exception as e:
+            logger.error(f"Error generating session response: {e}")
+            response, is_fallback = self._fallback_response(message, product_info, reason="error"), True
         
-        # Ensure it's a complete sentence
-        if response:
-            # Take only the first complete sentence or two
-            sentences = []
-            current_sentence = ""
-            
-            for char in response:
-                current_sentence += char
-                if char in '.!?':
-                    sentences.append(current_sentence.strip())
-                    current_sentence = ""
-                    if len(sentences) >= 2:  # Max 2 sentences
-                        break
-            
-            # If we have incomplete sentence, add it if it's substantial
-            if current_sentence.strip() and len(current_sentence.strip()) > 10:
-                sentences.append(current_sentence.strip() + '.')
-            
-            response = ' '.join(sentences)
+        self._record_turn(chat_id, fingerprint, message, response, seller_name, snapshot, lead)
+        return response, is_fallback
+    
+    def _session_fingerprint(self, product_info: Dict, seller_name: str) -> Tuple:
+        """Prompt facts a session is bound to; a conversation about other facts starts over"""
+        facts = (seller_name, product_info.get('name'), product_info.get('price'), stock_status(product_info))
+        if self.constrained.enabled:
+            # Template leads quote the exact stock count and specifications
+            fields = template_fields(product_info)
+            facts += (fields.get('stock'), fields.get('specs'))
+        return facts
+    
+    def _session_item(self, chat_id: str, fingerprint: Tuple, message: str, product_info: Dict, seller_name: str, related: Sequence[str] = (), snapshot: bool = True) -> BatchItem:
+        """Batch item for the next turn of a session: its snapshot plus the new text, or a rebuilt prompt"""
+        session = self.sessions.get(chat_id, fingerprint)
+        cue = f"{seller_name}:"
+        lead, lead_label = self._answer_lead(message, product_info)
+        if session and session.snapshot and (
+            len(session.snapshot.ids) + CHAT_SESSION_TURN_TOKENS <= self.generation_configs["chat"]["max_length"]
+        ):
+            self.sessions.note_snapshot_hit()
+            return BatchItem(("session", chat_id), session.snapshot, [
+                Segment(session.pending, trim="head", priority=0),
+                *([self._related_segment(related)] if related else []),
+                Segment("\n\nCustomer:"),
+                Segment(f" {message}", trim="tail", priority=1, min_tokens=8),
+                Segment(f"\n{seller_name}: "),
+            ], cue, snapshot, lead, lead_label)
+        if session:
+            self.sessions.note_rebuild()
+        prefix, suffix = self.create_context_prompt_parts(
+            message, product_info, seller_name, history=session.turns if session else (), related=related
+        )
+        return BatchItem(("chat", seller_name), prefix, suffix, cue, snapshot, lead, lead_label)
+    
+    def _answer_lead(self, message: str, product_info: Dict) -> Tuple[str, str]:
+        """Fact template a price, stock or spec reply starts with, and its intent label; empty for a free-form reply"""
+        if not self.constrained.enabled:
+            return "", ""
+        match = self.intents.classify("chat", message)
+        lead = self.constrained.lead(match.label if match else None, product_info)
+        return lead, match.label if lead else ""
+    
+    def _record_turn(self, chat_id: str, fingerprint: Tuple, message: str, response: str, seller_name: str, snapshot: Optional[CachedPrefix] = None, lead: str = ""):
+        """Add a finished turn to its session"""
+        self.sessions.record(
+            chat_id, fingerprint, message, response,
+            f"\n\nCustomer: {message}\n{seller_name}: {response}", snapshot, lead
+        )
+    
+    async def _coalesce(self, endpoint: str, cache_key: str, generate: Callable[[], Awaitable[Any]]) -> Any:
+        """Run ``generate`` unless an identical request is already generating; then share its reply"""
+        if not COALESCE_REQUESTS:
+            return await generate()
+        response, shared = await self.single_flight.do(cache_key, generate)
+        if shared:
+            RESPONSES.inc(endpoint=endpoint, source="coalesced")
+        return response
+    
+    async def _generate_chat_reply(self, message: str, product_info: Dict, seller_name: str, cache_key: str, lead: str = "", lead_label: str = "", bulk: bool = False) -> Tuple[str, bool]:
+        """Generate one seller reply starting with ``lead``, caching it if it passes validation
         
-        # Final length check
-        if len(response) > 200:
-            response = response[:200].rsplit(' ', 1)[0] + '.'
+        Returns the reply and whether it is a fallback.
+        """
+        # Create highly structured prompt with the catalog facts of other products the message mentions
+        related = await self._related_products("chat", message, [product_info.get('name')])
+        prefix, suffix = self.create_context_prompt_parts(message, product_info, seller_name, related=related)
             
-        return response
+        # Batch with concurrent chat requests on the inference pool
+        submitted = time.perf_counter()
+        response, generation = await self.batcher.submit(
+            "chat", BatchItem(("chat", seller_name), prefix, suffix, f"{seller_name}:", lead=lead, lead_label=lead_label),
+            flow=seller_name, priority_class=CHAT_BATCH_CLASS if bulk else None
+        )
+        self._record_generation("chat", generation, time.perf_counter() - submitted, observe_load=not bulk)
+        logger.debug(f"Cleaned response: {response}")
+        
+        # The batch was cleaned and validated by the post-processor as it came off the model
+        if not generation["valid"]:
+            logger.info(f"Generated response failed validation, using fallback")
+            return self._fallback_response(message, product_info, reason="validation_failed"), True
+        
+        # Replies cut short under load are not worth keeping
+        if not generation["degraded"]:
+            await self.response_cache.set(cache_key, response)
+        RESPONSES.inc(endpoint="chat", source="model")
+        return response, False
     
-    def _is_valid_response(self, response: str, original_message: str) -> bool:
-        """Validate if the response is appropriate and on-topic"""
-        if not response or len(response.strip()) < 5:
-            return False
+    def _preroute(self, endpoint: str, message: str, fields: Dict[str, Any]) -> str:
+        """Template answer when the message is a confident FAQ intent, else an empty string
+        
+        Every request passes through here first, so this is where its intent match is counted.
+        """
+        match = self.intents.observe(endpoint, message)
+        if not INTENT_PREROUTE:
+            return ""
+        with stage_timer(endpoint, "preroute"):
+            routed = self.intents.preroute(endpoint, message, fields, INTENT_PREROUTE_MIN_SCORE, match) or ""
+        if routed:
+            RESPONSES.inc(endpoint=endpoint, source="preroute")
+        return routed
+    
+    def _shed(self, endpoint: str, message: str) -> str:
+        """Degradation step that answers this request from the fallback under load, else an empty string"""
+        action = self.load.shed(endpoint, lambda: getattr(self.intents.classify(endpoint, message), "label", None))
+        if action:
+            DEGRADATIONS.inc(endpoint=endpoint, action=action)
+        return action
+    
+    def _token_limit(self, endpoint: str) -> int:
+        """max_new_tokens for the next generate call of ``endpoint``, lowered under load"""
+        base = self.generation_configs[endpoint]["max_new_tokens"]
+        limit = self.load.max_new_tokens(base)
+        if limit < base:
+            DEGRADATIONS.inc(endpoint=endpoint, action="reduce_tokens")
+        return limit
+    
+    def _record_generation(self, endpoint: str, generation: Dict[str, Any], elapsed: float, observe_load: bool = True):
+        """Attribute a batch's stage timings to the current request; the rest of ``elapsed`` was queueing
+        
+        Bulk items pass ``observe_load=False``: they queue behind live traffic by design,
+        so their wait says nothing about overload.
+        """
+        timings = generation["timings"]
+        for stage, seconds in timings.items():
+            record_stage(endpoint, stage, seconds, observe=False)
+        queued = max(0.0, elapsed - sum(timings.values()))
+        record_stage(endpoint, "queue", queued)
+        if observe_load:
+            self.load.observe(queued, timings["prefill"] + timings["decode"])
+    
+    async def answer_jsonl(self, chunks: AsyncIterator[bytes]) -> AsyncIterator[str]:
+        """Answer a JSONL stream of ChatRequest items, yielding one JSONL result per item in input order
+        
+        Items go through the normal chat path (micro-batching, response cache), so a
+        batch run also pre-warms the cache, but in the lowest-priority CHAT_BATCH_CLASS
+        and without load shedding. Each result says whether its "response" is a
+        fallback. An optional "id" field is echoed back.
+        """
+        async def answer(numbered: Tuple[int, Optional[bytes]]) -> Dict[str, Any]:
+            index, line = numbered
+            if line is None:
+                return {"index": index, "error": f"line longer than {CHAT_BATCH_MAX_LINE_BYTES} bytes"}
+            try:
+                item = json.loads(line)
+                request = ChatRequest(**item)
+            except (ValueError, TypeError) as e:
+                return {"index": index, "error": f"invalid request: {e}"}
             
-        response_lower = response.lower()
+            result = {"index": index}
+            if "id" in item:
+                result["id"] = item["id"]
+            try:
+                result["response"], result["fallback"] = await self._answer_chat(
+                    request.message, request.product_info, request.seller_name, request.context.get("chat_id"), bulk=True
+                )
+            except InferenceRejectedError as e:
+                result["error"] = f"AI service overloaded: {e.reason}"
+            return result
         
-        # Check for inappropriate content or off-topic responses
-        inappropriate_indicators = [
-            'i am an ai', 'i am a language model', 'i cannot', 'i\'m sorry but',
-            'as an ai', 'i don\'t have access', 'i can\'t browse', 'i\'m not able to',
-            'my knowledge cutoff', 'training data', 'openai', 'chatgpt'
-        ]
+        async def numbered_lines():
+            index = 0
+            async for line in iter_jsonl_lines(chunks, CHAT_BATCH_MAX_LINE_BYTES):
+                yield index, line
+                index += 1
         
-        for indicator in inappropriate_indicators:
-            if indicator in response_lower:
-                return False
+        async for result in ordered_map(answer, numbered_lines(), CHAT_BATCH_WINDOW):
+            yield json.dumps(result) + "\n"
+    
+    def _chat_cache_key(self, message: str, product_info: Dict, seller_name: str, lead: str = "") -> str:
+        """Response cache key covering every prompt field that changes a seller reply
         
-        # Check if response is too repetitive
-        words = response_lower.split()
-        if len(words) > 3:
-            unique_words = set(words)
-            if len(unique_words) / len(words) < 0.6:  # Too repetitive
-                return False
+        ``lead`` is the template lead the reply starts with; it carries the exact
+        stock count or specifications the stock status alone does not.
+        """
+        return self.response_cache.make_key(
+            "chat", message,
+            seller_name=seller_name,
+            name=product_info.get('name'),
+            price=product_info.get('price'),
+            stock=stock_status(product_info),
+            lead=lead,
+            catalog=self.catalog.version
+        )
+    
+    def _prepare_inputs(
+        self,
+        endpoint: str,
+        items: List[BatchItem],
+        timings: Optional[Dict[str, float]] = None
+    ) -> Dict[str, Any]:
+        """Build generate() inputs for the batch items of one endpoint"""
+        config = self.generation_configs[endpoint]
+        timings = {} if timings is None else timings
         
-        return True
+        # Reuse the cached system prefix states and build the per-request suffix in token
+        # space, trimming its variable fields so prefix + suffix fit max_length
+        prefixes, suffixes = [], []
+        for item in items:
+            started = time.perf_counter()
+            if isinstance(item.prefix, CachedPrefix):
+                prefix_ids, prefix_states = item.prefix
+            else:
+                prefix_ids, prefix_states = self.prefix_cache.get(item.prefix_key, item.prefix, self.model, self.tokenizer)
+            tokenize_started = time.perf_counter()
+            # A template lead follows the reply cue and is never trimmed
+            suffix = item.suffix + [Segment(item.lead)] if item.lead else item.suffix
+            if item.lead:
+                self.constrained.record(item.lead_label)
+            suffix_ids = self.prompt_builder.build(suffix, self.tokenizer, config["max_length"] - len(prefix_ids))
+            timings["prefix_cache"] = timings.get("prefix_cache", 0.0) + tokenize_started - started
+            timings["tokenize"] = timings.get("tokenize", 0.0) + time.perf_counter() - tokenize_started
+            prefixes.append((prefix_ids, prefix_states))
+            suffixes.append(suffix_ids)
+        input_ids, attention_mask, past_key_values = assemble_prefixed_batch(
+            prefixes, suffixes, self.tokenizer.pad_token_id
+        )
+        return {"input_ids": input_ids, "attention_mask": attention_mask, "past_key_values": past_key_values}
     
-    def _fallback_response(self, message: str, product_info: Dict) -> str:
-        """Professional fallback responses based on message context"""
-        message_lower = message.lower().strip()
+    def _sampling_kwargs(self, endpoint: str, max_new_tokens: Optional[int] = None) -> Dict[str, Any]:
+        """Sampling parameters for the endpoint's generate() calls"""
+        config = self.generation_configs[endpoint]
+        return {
+            "max_new_tokens": max_new_tokens or config["max_new_tokens"],
+            "temperature": config["temperature"],
+            "do_sample": True,
+            "pad_token_id": self.tokenizer.pad_token_id,
+            "eos_token_id": self.tokenizer.eos_token_id,
+            "top_p": config["top_p"],
+            "repetition_penalty": config["repetition_penalty"],
+            "no_repeat_ngram_size": config["no_repeat_ngram_size"],
+            "early_stopping": True,
+        }
+    
+    def _generate_batch(self, endpoint: str, items: List[BatchItem]) -> List[Tuple[str, Dict[str, Any]]]:
+        """Run one left-padded generate call for the batch items of one endpoint
         
-        # Greeting responses
-        if any(word in message_lower for word in ['hello', 'hi', 'hey', 'good morning', 'good afternoon']):
-            if product_info.get('name'):
-                return f"Hello! I see you're interested in the {product_info['name']}. How can I help you with this product today?"
-            return "Hello! Welcome to Componentary. How can I assist you with your tech needs today?"
+        Returns (cleaned reply, generation info) per item; the info holds the batch's stage
+        timings, the row's generated token count, whether max_new_tokens was lowered under
+        load, whether the reply passed validation and, for items that asked for it, the
+        prompt's key/value snapshot.
+        """
+        config = self.generation_configs[endpoint]
+        max_new_tokens = self._token_limit(endpoint)
+        timings: Dict[str, float] = {}
         
-        # Pricing inquiries
-        if any(word in message_lower for word in ['price', 'cost', 'expensive', 'cheap', 'how much']):
-            if product_info.get('price'):
-                return f"This product is priced at ${product_info['price']}. It offers excellent value for its features. Would you like to know more about what's included?"
-            return "I'd be happy to discuss pricing. Which specific product are you interested in?"
+        # Each row stops as soon as its reply is complete; the reply cue doubles as a role marker
+        rules = [config["reply_rules"].with_markers(item.cue) for item in items]
+        leads = [item.lead for item in items]
+        snapshots: List[Optional[CachedPrefix]] = [None] * len(items)
+        if SPECULATIVE_DECODING:
+            generated_rows = self._generate_speculative(endpoint, items, rules, max_new_tokens, timings, snapshots)
+        else:
+            inputs = self._prepare_inputs(endpoint, items, timings)
+            prompt_length = inputs["input_ids"].shape[1]
+            stopping_criteria = ReplyStoppingCriteria(self.tokenizer, prompt_length, rules, leads)
+            timer = GenerationTimer()
+            # Rows continuing a template lead may not write numbers of their own
+            constraint = self.constrained.processor(self.tokenizer, [row for row, lead in enumerate(leads) if lead])
+            
+            # Generate responses with the endpoint's sampling parameters
+            with torch.no_grad():
+                outputs = self.model.generate(
+                    **inputs,
+                    **self._sampling_kwargs(endpoint, max_new_tokens),
+                    logits_processor=LogitsProcessorList([constraint] if constraint else []),
+                    stopping_criteria=StoppingCriteriaList([stopping_criteria, timer]),
+                    return_dict_in_generate=True
+                )
+            timings["prefill"] = timer.prefill_seconds
+            timings["decode"] = timer.decode_seconds
+            generated_rows = [output[prompt_length:] for output in outputs.sequences]
+            for row, item in enumerate(items):
+                if item.snapshot:
+                    snapshots[row] = snapshot_row(
+                        outputs.past_key_values, inputs["input_ids"], inputs["attention_mask"], row
+                    )
         
-        # Stock/availability
-        if any(word in message_lower for word in ['stock', 'available', 'in stock', 'out of stock']):
-            if product_info.get('stock') is not None:
-                stock = product_info['stock']
-                if stock > 0:
-                    return f"Good news! This item is currently in stock with {stock} units available. Would you like to place an order?"
-                else:
-                    return "This item is currently out of stock. I can notify you when it becomes available again. Would you like me to do that?"
-            return "Let me check our current inventory for you. Which product are you asking about?"
+        # Decode only the generated ids of each row and cut them with the same rules,
+        # so a trailing role marker that triggered the stop is never returned
+        started = time.perf_counter()
+        replies, token_counts = [], []
+        for generated, row_rules, lead in zip(generated_rows, rules, leads):
+            token_counts.append(int((generated != self.tokenizer.pad_token_id).sum()))
+            reply = lead + self.tokenizer.decode(generated, skip_special_tokens=True)
+            logger.debug(f"Generated reply: {reply}")
+            replies.append(row_rules.cut(reply, final=True)[0].strip())
+        timings["detokenize"] = time.perf_counter() - started
         
-        # Shipping inquiries
-        if any(word in message_lower for word in ['shipping', 'delivery', 'ship', 'when will it arrive']):
-            return "We offer fast shipping! Most orders ship within 1-2 business days and arrive within 2-5 business days. Free shipping is available on orders over $50."
+        # Clean and validate the whole batch in one pass of the endpoint's compiled rules
+        started = time.perf_counter()
+        processed = self.postprocessor.process(endpoint, replies)
+        timings["postprocess"] = time.perf_counter() - started
         
-        # Product quality/specifications
-        if any(word in message_lower for word in ['quality', 'good', 'best', 'spec', 'feature']):
-            if product_info.get('name'):
-                return f"The {product_info['name']} is a high-quality product. Would you like me to explain its key features and specifications?"
-            return "All our products are carefully selected for quality. What specific features are you looking for?"
+        self._observe_generation(endpoint, timings, token_counts)
+        degraded = max_new_tokens < config["max_new_tokens"]
+        return [
+            (result.text, {
+                "timings": timings, "tokens": tokens, "degraded": degraded, "snapshot": snapshot, "valid": result.valid
+            })
+            for result, tokens, snapshot in zip(processed, token_counts, snapshots)
+        ]
+    
+    def _generate_speculative(
+        self,
+        endpoint: str,
+        items: List[BatchItem],
+        rules: List[ReplyRules],
+        max_new_tokens: int,
+        timings: Dict[str, float],
+        snapshots: List[Optional[CachedPrefix]]
+    ) -> List[torch.Tensor]:
+        """Draft-and-verify decode each item on its own, returning the generated ids per item"""
+        config = self.generation_configs[endpoint]
+        processors = sampling_processors(
+            config["temperature"], config["top_p"], config["repetition_penalty"], config["no_repeat_ngram_size"]
+        )
+        generated_rows = []
+        for row, (item, row_rules) in enumerate(zip(items, rules)):
+            inputs = self._prepare_inputs(endpoint, [item], timings)
+            prompt_length = inputs["input_ids"].shape[1]
+            stopping_criteria = ReplyStoppingCriteria(self.tokenizer, prompt_length, [row_rules], [item.lead])
+            constraint = self.constrained.processor(self.tokenizer, [0] if item.lead else [])
+            with torch.no_grad():
+                output, info = self.speculative.generate(
+                    self.model,
+                    inputs["input_ids"],
+                    inputs["past_key_values"],
+                    # The digit ban runs before the warpers, as in generate(), so top-p never sees an all -inf row
+                    LogitsProcessorList([constraint] + processors) if constraint else processors,
+                    [stopping_criteria],
+                    max_new_tokens,
+                    self.tokenizer.eos_token_id
+                )
+            timings["prefill"] = timings.get("prefill", 0.0) + info["prefill"]
+            timings["decode"] = timings.get("decode", 0.0) + info["decode"]
+            DRAFT_TOKENS.inc(info["accepted"], endpoint=endpoint, outcome="accepted")
+            DRAFT_TOKENS.inc(info["drafted"] - info["accepted"], endpoint=endpoint, outcome="rejected")
+            generated_rows.append(output[0, prompt_length:])
+            if item.snapshot:
+                # The decoder extended the cache in place; its first columns are the prompt
+                snapshots[row] = snapshot_row(inputs["past_key_values"], inputs["input_ids"], inputs["attention_mask"], 0)
+        return generated_rows
+    
+    def _observe_generation(self, endpoint: str, timings: Dict[str, float], token_counts: List[int]):
+        """Record one generate() call's stage timings and token throughput"""
+        for stage, seconds in timings.items():
+            STAGE_SECONDS.observe(seconds, endpoint=endpoint, stage=stage)
+        for tokens in token_counts:
+            GENERATED_TOKENS.observe(tokens, endpoint=endpoint)
+        generation_seconds = timings["prefill"] + timings["decode"]
+        if generation_seconds > 0:
+            TOKENS_PER_SECOND.observe(sum(token_counts) / generation_seconds, endpoint=endpoint)
+    
+    def _generate_streaming(self, endpoint: str, item: BatchItem, streamer: AsyncTextStreamer, stop_event: threading.Event, max_new_tokens: int):
+        """Generate a single reply, pushing tokens to ``streamer`` until ``stop_event`` is set"""
+        timings: Dict[str, float] = {}
+        inputs = self._prepare_inputs(endpoint, [item], timings)
+        timer = GenerationTimer()
+        constraint = self.constrained.processor(self.tokenizer, [0] if item.lead else [])
+        with torch.no_grad():
+            self.model.generate(
+                **inputs,
+                **self._sampling_kwargs(endpoint, max_new_tokens),
+                logits_processor=LogitsProcessorList([constraint] if constraint else []),
+                streamer=streamer,
+                stopping_criteria=StoppingCriteriaList([StopOnEvent(stop_event), timer])
+            )
+        timings["prefill"] = timer.prefill_seconds
+        timings["decode"] = timer.decode_seconds
+        self._observe_generation(endpoint, timings, [timer.steps])
+    
+    async def _stream_generation(self, endpoint: str, item: BatchItem, reply_filter: StreamingReplyFilter, max_new_tokens: int, flow: str = "") -> AsyncIterator[str]:
+        """Yield filtered reply text while generation runs on the pool, stopping it once the reply is complete
         
-        # Returns/warranty
-        if any(word in message_lower for word in ['return', 'refund', 'warranty', 'guarantee']):
-            return "We offer a 30-day return policy and full manufacturer warranty on all products. Your satisfaction is guaranteed!"
+        The job is scheduled in the endpoint's priority class under ``flow`` (the seller).
+        """
+        streamer = AsyncTextStreamer(self.tokenizer, asyncio.get_running_loop())
+        stop_event = threading.Event()
+        task = asyncio.ensure_future(
+            self.executor.run(
+                self._generate_streaming, endpoint, item, streamer, stop_event, max_new_tokens,
+                priority_class=endpoint, flow=flow
+            )
+        )
+        # Rejected or failed jobs never reach streamer.end(), so close the stream here too
+        task.add_done_callback(lambda _: streamer.queue.put_nowait(None))
+        try:
+            # A template lead is part of the prompt, so it is sent before the first generated token
+            text = reply_filter.feed(item.lead)
+            if text:
+                yield text
+            while True:
+                delta = await streamer.queue.get()
+                if delta is None:
+                    break
+                text = reply_filter.feed(delta)
+                if text:
+                    yield text
+                if reply_filter.done:
+                    break
+            stop_event.set()
+            await task
+            text = reply_filter.finish()
+            if text:
+                yield text
+        finally:
+            # Also stops generation when the client disconnects mid-stream
+            stop_event.set()
+    
+    async def stream_response(self, message: str, product_info: Dict, seller_name: str, chat_id: Optional[str] = None) -> AsyncIterator[str]:
+        """Stream a seller reply as Server-Sent Events, ending with the cleaned final response
         
-        # Comparison questions
-        if any(word in message_lower for word in ['compare', 'difference', 'better', 'versus', 'vs']):
-            return "I'd be happy to help you compare products. What specific items are you considering, and what features matter most to you?"
+        Session turns reuse the session's snapshot but do not take a new one.
+        """
+        in_session = bool(chat_id and CHAT_SESSIONS)
+        chat_id = str(chat_id) if in_session else None
+        fingerprint = self._session_fingerprint(product_info, seller_name) if in_session else None
+        routed = self._preroute("chat", message, reply_fields(product_info))
+        if routed:
+            if in_session:
+                self._record_turn(chat_id, fingerprint, message, routed, seller_name)
+            yield format_sse("token", {"text": routed})
+            yield format_sse("done", {"response": routed, "fallback": False})
+            return
         
-        # Thank you responses
-        if any(word in message_lower for word in ['thank', 'thanks']):
-            return "You're very welcome! Is there anything else I can help you with today?"
+        if not self.ready:
+            response = self._fallback_response(message, product_info, reason="model_not_loaded")
+            if in_session:
+                self._record_turn(chat_id, fingerprint, message, response, seller_name)
+            yield format_sse("done", {"response": response, "fallback": True})
+            return
         
-        # Default professional response
-        if product_info.get('name'):
-            return f"Thanks for your interest in the {product_info['name']}! How can I help you learn more about this product?"
+        is_fallback = False
+        try:
+            lead, lead_label = ("", "") if in_session else self._answer_lead(message, product_info)
+            cache_key = None if in_session else self._chat_cache_key(message, product_info, seller_name, lead)
+            response = await self.response_cache.get(cache_key) if cache_key else None
+            shed = "" if response else self._shed("chat", message)
+            if response:
+                RESPONSES.inc(endpoint="chat", source="cache")
+                yield format_sse("token", {"text": response})
+            elif shed:
+                response, is_fallback = self._fallback_response(message, product_info, reason=shed), True
+            else:
+                related = await self._related_products("chat", message, [product_info.get('name')])
+                if in_session:
+                    item = self._session_item(chat_id, fingerprint, message, product_info, seller_name, related, snapshot=False)
+                else:
+                    prefix, suffix = self.create_context_prompt_parts(message, product_info, seller_name, related=related)
+                    item = BatchItem(("chat", seller_name), prefix, suffix, f"{seller_name}:", lead=lead, lead_label=lead_label)
+                reply_filter = StreamingReplyFilter(
+                    self.generation_configs["chat"]["reply_rules"].with_markers(f"{seller_name}:")
+                )
+                max_new_tokens = self._token_limit("chat")
+                async for text in self._stream_generation("chat", item, reply_filter, max_new_tokens, seller_name):
+                    yield format_sse("token", {"text": text})
+                
+                with stage_timer("chat", "postprocess"):
+                    response, valid, _ = self.postprocessor.process("chat", [reply_filter.reply])[0]
+                if valid:
+                    if cache_key and max_new_tokens == self.generation_configs["chat"]["max_new_tokens"]:
+                        await self.response_cache.set(cache_key, response)
+                    RESPONSES.inc(endpoint="chat", source="model")
+                else:
+                    logger.info("Streamed response failed validation, using fallback")
+                    response = self._fallback_response(message, product_info, reason="validation_failed")
+                    is_fallback = True
+        except InferenceRejectedError as e:
+            logger.warning(f"Streamed chat generation rejected ({e.reason}): {e}")
+            response, is_fallback = self._fallback_response(message, product_info, reason=e.reason), True
+        except Exception as e:
+            logger.error(f"Error streaming response: {e}")
+            response, is_fallback = self._fallback_response(message, product_info, reason="error"), True
         
-        return "Thank you for contacting Componentary! I'm here to help with any questions about our tech products. What can I assist you with?"
+        if in_session:
+            self._record_turn(chat_id, fingerprint, message, response, seller_name)
+        yield format_sse("done", {"response": response, "fallback": is_fallback})
+    
+    def _fallback_response(self, message: str, product_info: Dict, reason: str = "error") -> str:
+        """Professional fallback responses based on message context"""
+        FALLBACKS.inc(endpoint="chat", reason=reason)
+        RESPONSES.inc(endpoint="chat", source="fallback")
+        match = self.intents.classify("chat", message)
+        return self.intents.reply("chat", match.label if match else None, reply_fields(product_info))
 
-    def create_website_helper_prompt(self, message: str, page_context: Dict) -> str:
+    def _related_segment(self, related: Sequence[str]) -> Segment:
+        """Catalog snippets for a prompt; the lowest-priority text, so the first to give way to the budget"""
+        return Segment("\nRELATED PRODUCTS:\n" + "".join(f"- {line}\n" for line in related), trim="head", priority=-2)
+    
+    async def _related_products(self, endpoint: str, message: str, exclude: Sequence[str] = ()) -> List[str]:
+        """Catalog snippets of the products ``message`` is about, other than ``exclude`` (product names)"""
+        if not self.catalog.size or CATALOG_TOP_K <= 0:
+            return []
+        with stage_timer(endpoint, "catalog_lookup"):
+            if self.catalog.embeddings:
+                # Encoding the question is model work; keep it off the event loop
+                hits = await asyncio.get_running_loop().run_in_executor(
+                    None, self.catalog.related, message, CATALOG_TOP_K, exclude
+                )
+            else:
+                hits = self.catalog.related(message, CATALOG_TOP_K, exclude)
+        return [snippet(hit.product) for hit in hits]
+    
+    def create_website_helper_prompt(self, message: str, page_context: Dict, related: Sequence[str] = ()) -> str:
         """Create a specialized prompt for website assistance"""
+        prefix, suffix = self.create_website_helper_prompt_parts(message, page_context, related)
+        return prefix + render(suffix)
+    
+    def create_website_helper_prompt_parts(self, message: str, page_context: Dict, related: Sequence[str] = ()) -> Tuple[str, List[Segment]]:
+        """Split the website helper prompt into its static rules prefix and per-request suffix segments
+        
+        ``related`` holds catalog snippets of the products the message mentions.
+        """
         
         # Extract relevant context
         current_page = page_context.get('currentPage', '')
         page_title = page_context.get('pageTitle', '')
         page_content = page_context.get('pageContent', '')[:300]  # Shorter content
-        product_info = page_context.get('productInfo', {})
+        product_info = page_context.get('productInfo') or {}
         
-        # Create a much more constrained prompt
-        conversation = f"""You are a professional customer service assistant for Componentary. 
+        # Create a much more constrained prompt; the rules block is static and KV cached
+        prefix = """You are a professional customer service assistant for Componentary. 
 
 Rules:
 - Give helpful, short answers (1 sentence only)
 - Stay focused on the user's question
 - Be polite and professional
-- Don't make up information
-
-Current page: {current_page}
-
-Question: {message}
-Answer:"""
+- Don't make up information"""
+        suffix = [
+            Segment("\n\nCurrent page:"),
+            Segment(f" {current_page}", trim="head", priority=0, min_tokens=4),
+        ]
+        # Page details give way before the page and the question; catalog snippets go first
+        if page_title:
+            suffix += [Segment("\nPage title:"), Segment(f" {page_title}", trim="head", priority=-1)]
+        if product_info.get('name'):
+            suffix += [Segment("\nProduct:"), Segment(f" {snippet(product_info)}", trim="head", priority=0)]
+        if page_content:
+            suffix += [Segment("\nPage content:"), Segment(f" {page_content}", trim="head", priority=-1)]
+        if related:
+            suffix.append(self._related_segment(related))
+        suffix += [
+            Segment("\n\nQuestion:"),
+            Segment(f" {message}", trim="tail", priority=1, min_tokens=8),
+            Segment("\nAnswer:"),
+        ]
         
-        return conversation
+        return prefix, suffix
 
     async def generate_website_helper_response(self, message: str, page_context: Dict) -> str:
         """Generate website helper response using SmolLM2 model"""
         try:
-            if not self.model or not self.tokenizer:
-                return self._website_helper_fallback(message, page_context)
+            routed = self._preroute("website_helper", message, reply_fields(page_context.get('productInfo')))
+            if routed:
+                return routed
             
-            # Create specialized prompt for website help
-            prompt = self.create_website_helper_prompt(message, page_context)
+            if not self.ready:
+                return self._website_helper_fallback(message, page_context, reason="model_not_loaded")
             
-            # Tokenize input
-            inputs = self.tokenizer(
-                prompt, 
-                return_tensors="pt", 
-                max_length=300,  # Shorter for website help
-                truncation=True,
-                padding=True
-            )
-            inputs = {k: v.to(self.device) for k, v in inputs.items()}
+            cache_key = self._website_helper_cache_key(message, page_context)
+            with stage_timer("website_helper", "cache_lookup"):
+                cached = await self.response_cache.get(cache_key)
+            if cached:
+                RESPONSES.inc(endpoint="website_helper", source="cache")
+                return cached
             
-            # Generate response with website-appropriate parameters
-            with torch.no_grad():
-                outputs = self.model.generate(
-                    **inputs,
-                    max_new_tokens=25,  # Much shorter responses
-                    temperature=0.1,    # Very low temperature for consistency
-                    do_sample=True,
-                    pad_token_id=self.tokenizer.pad_token_id,
-                    eos_token_id=self.tokenizer.eos_token_id,
-                    top_p=0.5,          # Much lower for focused responses
-                    repetition_penalty=1.5,
-                    no_repeat_ngram_size=3,
-                    early_stopping=True
-                )
+            # The website helper is shed before seller chat under overload
+            shed = self._shed("website_helper", message)
+            if shed:
+                return self._website_helper_fallback(message, page_context, reason=shed)
             
-            # Decode and extract response
-            full_response = self.tokenizer.decode(outputs[0], skip_special_tokens=True)
-            
-            # Extract only the response part after "Answer:"
-            if "Answer:" in full_response:
-                response = full_response.split("Answer:", 1)[-1].strip()
-            else:
-                response = full_response[len(prompt):].strip()
-            
-            # Take only the first sentence
-            sentences = response.split('.')
-            if sentences:
-                response = sentences[0].strip() + ('.' if sentences[0].strip() and not sentences[0].strip().endswith('.') else '')
-            
-            # Clean and validate response
-            response = self._clean_website_helper_response(response)
-            
-            if not self._is_valid_website_helper_response(response, message):
-                return self._website_helper_fallback(message, page_context)
-                
-            return response if response else self._website_helper_fallback(message, page_context)
+            return await self._coalesce(
+                "website_helper", cache_key,
+                lambda: self._generate_website_helper_reply(message, page_context, cache_key)
+            )
             
+        except InferenceRejectedError as e:
+            logger.warning(f"Website helper generation rejected ({e.reason}): {e}")
+            if REJECT_ON_OVERLOAD:
+                RESPONSES.inc(endpoint="website_helper", source="rejected")
+                raise
+            return self._website_helper_fallback(message, page_context, reason=e.reason)
         except Exception as e:
             logger.error(f"Error generating website helper response: {e}")
-            return self._website_helper_fallback(message, page_context)
+            return self._website_helper_fallback(message, page_context, reason="error")
     
-    def _clean_website_helper_response(self, response: str) -> str:
-        """Clean and format website helper response"""
-        if not response:
-            return ""
-            
-        # Remove any unwanted tokens or artifacts
-        response = response.strip()
+    async def _generate_website_helper_reply(self, message: str, page_context: Dict, cache_key: str) -> str:
+        """Generate one website helper answer, caching it if it passes validation"""
+        # Create specialized prompt for website help, with catalog facts of the products it mentions
+        related = await self._related_products(
+            "website_helper", message, [(page_context.get('productInfo') or {}).get('name')]
+        )
+        prefix, suffix = self.create_website_helper_prompt_parts(message, page_context, related)
         
-        # Remove common model artifacts
-        artifacts = ['<|endoftext|>', '<|end|>', '\n', 'User:', 'Assistant:', 'Question:', 'Answer:']
-        for artifact in artifacts:
-            response = response.replace(artifact, ' ')
+        # Batch with concurrent website helper requests on the inference pool
+        submitted = time.perf_counter()
+        response, generation = await self.batcher.submit(
+            "website_helper", BatchItem(("website_helper",), prefix, suffix, "Answer:")
+        )
+        self._record_generation("website_helper", generation, time.perf_counter() - submitted)
         
-        response = response.strip()
-        
-        # Ensure it ends with proper punctuation
-        if response and not response.endswith(('.', '!', '?')):
-            response += '.'
-            
-        # Limit to reasonable length
-        if len(response) > 200:
-            # Cut at sentence boundary
-            sentences = response.split('.')
-            if len(sentences) > 1:
-                response = sentences[0] + '.'
-            else:
-                response = response[:200] + '...'
+        # The post-processor already kept the first sentence and validated it
+        if not generation["valid"]:
+            return self._website_helper_fallback(message, page_context, reason="validation_failed")
         
+        if not generation["degraded"]:
+            await self.response_cache.set(cache_key, response)
+        RESPONSES.inc(endpoint="website_helper", source="model")
         return response
     
-    def _is_valid_website_helper_response(self, response: str, original_message: str) -> bool:
-        """Validate website helper response quality"""
-        if not response or len(response.strip()) < 5:
-            return False
-            
-        # Check for repetitive or nonsensical content
-        words = response.lower().split()
-        if len(set(words)) / len(words) < 0.5 and len(words) > 10:  # Too repetitive
-            return False
-            
-        # Check for inappropriate content
-        inappropriate = ['sorry', 'cannot', "can't", 'unable', 'error', 'problem']
-        if any(word in response.lower() for word in inappropriate):
-            return False
-            
-        return True
-            
-        response = response.strip()
-        
-        # Remove unwanted artifacts
-        lines = response.split('\n')
-        cleaned_lines = []
-        
-        for line in lines:
-            line = line.strip()
-            if line and not line.startswith(('User:', 'Human:', 'Customer:')):
-                if ':' in line and any(role in line.lower() for role in ['user', 'human', 'customer']):
-                    break
-                cleaned_lines.append(line)
-        
-        response = ' '.join(cleaned_lines).strip()
-        
-        # Ensure complete sentences, max 2 sentences
-        if response:
-            sentences = []
-            current_sentence = ""
-            
-            for char in response:
-                current_sentence += char
-                if char in '.!?':
-                    sentences.append(current_sentence.strip())
-                    current_sentence = ""
-                    if len(sentences) >= 2:
-                        break
-            
-            if current_sentence.strip() and len(current_sentence.strip()) > 8:
-                sentences.append(current_sentence.strip() + '.')
-            
-            response = ' '.join(sentences)
-        
-        # Length limit for website helper
-        if len(response) > 150:
-            response = response[:150].rsplit(' ', 1)[0] + '.'
-            
-        return response
+    def _website_helper_cache_key(self, message: str, page_context: Dict) -> str:
+        """Response cache key covering every page field and catalog state the website helper prompt uses"""
+        product_info = page_context.get('productInfo') or {}
+        return self.response_cache.make_key(
+            "website_helper", message,
+            current_page=page_context.get('currentPage', ''),
+            page_title=page_context.get('pageTitle', ''),
+            page_content=page_context.get('pageContent', '')[:300],
+            product=snippet(product_info) if product_info.get('name') else None,
+            catalog=self.catalog.version
+        )
     
-    def _is_valid_website_helper_response(self, response: str, original_message: str) -> bool:
-        """Validate website helper response"""
-        if not response or len(response.strip()) < 3:
-            return False
-            
-        response_lower = response.lower()
+    async def stream_website_helper_response(self, message: str, page_context: Dict) -> AsyncIterator[str]:
+        """Stream a website helper answer as Server-Sent Events, ending with the cleaned final response"""
+        routed = self._preroute("website_helper", message, reply_fields(page_context.get('productInfo')))
+        if routed:
+            yield format_sse("token", {"text": routed})
+            yield format_sse("done", {"response": routed, "fallback": False})
+            return
         
-        # Check for inappropriate responses
-        inappropriate = [
-            'i am an ai', 'language model', 'i cannot', 'i don\'t know',
-            'training data', 'as an ai'
-        ]
+        if not self.ready:
+            yield format_sse("done", {"response": self._website_helper_fallback(message, page_context, reason="model_not_loaded"), "fallback": True})
+            return
         
-        for phrase in inappropriate:
-            if phrase in response_lower:
-                return False
+        is_fallback = False
+        try:
+            cache_key = self._website_helper_cache_key(message, page_context)
+            response = await self.response_cache.get(cache_key)
+            shed = "" if response else self._shed("website_helper", message)
+            if response:
+                RESPONSES.inc(endpoint="website_helper", source="cache")
+                yield format_sse("token", {"text": response})
+            elif shed:
+                response, is_fallback = self._website_helper_fallback(message, page_context, reason=shed), True
+            else:
+                related = await self._related_products(
+                    "website_helper", message, [(page_context.get('productInfo') or {}).get('name')]
+                )
+                prefix, suffix = self.create_website_helper_prompt_parts(message, page_context, related)
+                reply_filter = StreamingReplyFilter(self.generation_configs["website_helper"]["reply_rules"])
+                max_new_tokens = self._token_limit("website_helper")
+                async for text in self._stream_generation(
+                    "website_helper", BatchItem(("website_helper",), prefix, suffix, "Answer:"), reply_filter, max_new_tokens
+                ):
+                    yield format_sse("token", {"text": text})
+                
+                with stage_timer("website_helper", "postprocess"):
+                    response, valid, _ = self.postprocessor.process("website_helper", [reply_filter.reply])[0]
+                if valid:
+                    if max_new_tokens == self.generation_configs["website_helper"]["max_new_tokens"]:
+                        await self.response_cache.set(cache_key, response)
+                    RESPONSES.inc(endpoint="website_helper", source="model")
+                else:
+                    response = self._website_helper_fallback(message, page_context, reason="validation_failed")
+                    is_fallback = True
+        except InferenceRejectedError as e:
+            logger.warning(f"Streamed website helper generation rejected ({e.reason}): {e}")
+            response, is_fallback = self._website_helper_fallback(message, page_context, reason=e.reason), True
+        except Exception as e:
+            logger.error(f"Error streaming website helper response: {e}")
+            response, is_fallback = self._website_helper_fallback(message, page_context, reason="error"), True
         
-        return True
+        yield format_sse("done", {"response": response, "fallback": is_fallback})
     
-    def _website_helper_fallback(self, message: str, page_context: Dict) -> str:
+    def _website_helper_fallback(self, message: str, page_context: Dict, reason: str = "error") -> str:
         """Fallback responses for website helper"""
+        FALLBACKS.inc(endpoint="website_helper", reason=reason)
+        RESPONSES.inc(endpoint="website_helper", source="fallback")
         current_page = page_context.get('currentPage', '')
-        message_lower = message.lower()
+        match = self.intents.classify("website_helper", message)
         
         # Page-specific help
         if current_page == '/' or 'home' in current_page:
-            if any(word in message_lower for word in ['navigate', 'help', 'how']):
-                return "Welcome to Componentary! Use the navigation menu to browse products, manage your account, or access seller tools. What are you looking for?"
+            if match and match.label == "navigate":
+                return self.intents.reply("website_helper", "navigate", {})
             return "I can help you navigate our homepage. Browse our featured products or use the search to find specific PC components."
         
         if 'product' in current_page:
@@ -502,25 +1265,81 @@ Answer:"""
         if 'checkout' in current_page:
             return "On the checkout page, review your items and enter shipping details. Need help with the checkout process?"
         
-        # General responses
-        if any(word in message_lower for word in ['search', 'find', 'product']):
-            return "Use the search bar at the top or browse by categories. I can help you find specific PC components or tech products."
-        
-        if any(word in message_lower for word in ['account', 'profile', 'login']):
-            return "Access your account through the login button in the top right. You can manage orders, profile, and preferences there."
-        
-        return "I'm here to help you navigate Componentary! Ask me about products, account features, or how to use the website."
+        # General responses; navigation questions off the homepage get the generic answer
+        if match and match.label in ("search", "account"):
+            return self.intents.reply("website_helper", match.label, {})
+        return self.intents.reply("website_helper", None, {})
 
 # Initialize the model
 chat_model = SmolLM2ChatModel()
 
-@app.on_event("startup")
-async def startup_event():
-    """Load the model on startup"""
+# Scrape-time gauges for model state, queue depth and the components' own counters
+MODEL_STATES = ("not_loaded", "loading", "warming_up", "ready", "failed")
+REGISTRY.gauge("ai_model_loaded", "1 once the model is loaded and warmed up", collect=lambda: float(chat_model.load_state == "ready"))
+REGISTRY.gauge(
+    "ai_model_state", "Current model load state", ("state",),
+    collect=lambda: {(state,): float(chat_model.load_state == state) for state in MODEL_STATES}
+)
+REGISTRY.gauge("ai_inference_queue_depth", "Inference jobs waiting for a worker", collect=lambda: chat_model.executor.queue_depth)
+REGISTRY.stats("ai_inference", chat_model.executor.stats, "Inference pool")
+REGISTRY.stats("ai_batching", chat_model.batcher.stats, "Micro-batching")
+REGISTRY.stats("ai_prefix_cache", chat_model.prefix_cache.stats, "Prefix KV cache")
+REGISTRY.stats("ai_prompt_builder", chat_model.prompt_builder.stats, "Prompt builder")
+REGISTRY.stats("ai_response_cache", chat_model.response_cache.stats, "Response cache")
+REGISTRY.stats("ai_intents", chat_model.intents.stats, "Intent classifier")
+REGISTRY.stats("ai_coalescing", chat_model.single_flight.stats, "Request coalescing")
+REGISTRY.stats("ai_load_shedding", chat_model.load.stats, "Load shedding")
+REGISTRY.stats("ai_speculative", chat_model.speculative.stats, "Speculative decoding")
+REGISTRY.stats("ai_sessions", chat_model.sessions.stats, "Chat sessions")
+REGISTRY.stats("ai_postprocess", chat_model.postprocessor.stats, "Reply post-processing")
+REGISTRY.stats("ai_constrained", chat_model.constrained.stats, "Constrained answers")
+REGISTRY.stats("ai_catalog", chat_model.catalog.stats, "Catalog index")
+REGISTRY.stats("ai_scheduler", chat_model.scheduler.stats, "Request scheduler")
+
+@app.middleware("http")
+async def timing_middleware(request: Request, call_next):
+    """Time every request; clients sending ``X-Request-Timing: true`` get a Server-Timing breakdown"""
+    timings = begin_request()
+    response = await call_next(request)
+    route = request.scope.get("route")
+    REQUEST_SECONDS.observe(time.perf_counter() - timings.started, path=getattr(route, "path", "other"))
+    if request.headers.get("x-request-timing", "").lower() in ("1", "true"):
+        response.headers["Server-Timing"] = timings.server_timing()
+    return response
+
+async def load_model_in_background():
+    """Load the model while the service already answers with fallbacks"""
     success = await chat_model.load_model()
     if not success:
         logger.warning("Model failed to load, using fallback responses")
 
+async def refresh_catalog_periodically():
+    """Load the catalog export, then re-index whatever changed in it every CATALOG_REFRESH_SECONDS"""
+    loop = asyncio.get_running_loop()
+    while True:
+        try:
+            await loop.run_in_executor(None, chat_model.catalog.refresh)
+        except Exception as e:
+            logger.error(f"Catalog refresh failed: {e}")
+        if CATALOG_REFRESH_SECONDS <= 0:
+            return
+        await asyncio.sleep(CATALOG_REFRESH_SECONDS)
+
+@app.on_event("startup")
+async def startup_event():
+    """Start loading the model (and the catalog index) on startup; /ready reports when the model is done"""
+    threads = configure_threads(SERVER_WORKERS, INFERENCE_WORKERS)
+    logger.info(f"Worker {os.getpid()} using {threads} intra-op threads")
+    app.state.model_loader = asyncio.ensure_future(load_model_in_background())
+    if CATALOG_PATH:
+        app.state.catalog_refresher = asyncio.ensure_future(refresh_catalog_periodically())
+
+@app.on_event("shutdown")
+async def shutdown_event():
+    """Release the inference worker pool and cache connections"""
+    chat_model.executor.shutdown()
+    await chat_model.response_cache.close()
+
 @app.post("/chat", response_model=ChatResponse)
 async def chat_endpoint(request: ChatRequest):
     """Chat endpoint for generating AI responses"""
@@ -528,15 +1347,36 @@ async def chat_endpoint(request: ChatRequest):
         response = await chat_model.generate_response(
             request.message,
             request.product_info,
-            request.seller_name
+            request.seller_name,
+            request.context.get("chat_id")
         )
         
         return ChatResponse(response=response, confidence=0.9)
     
+    except InferenceRejectedError as e:
+        raise HTTPException(status_code=503, detail=f"AI service overloaded: {e.reason}", headers={"Retry-After": "1"})
     except Exception as e:
         logger.error(f"Chat endpoint error: {e}")
         raise HTTPException(status_code=500, detail="Internal server error")
 
+@app.post("/chat/stream")
+async def chat_stream_endpoint(request: ChatRequest):
+    """Stream the chat reply as Server-Sent Events ("token" events, then a final "done" event)"""
+    return StreamingResponse(
+        chat_model.stream_response(request.message, request.product_info, request.seller_name, request.context.get("chat_id")),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
+
+@app.post("/chat/batch")
+async def chat_batch_endpoint(request: Request):
+    """Answer a JSONL body of ChatRequest items, streaming JSONL results back in input order"""
+    return DuplexStreamingResponse(
+        chat_model.answer_jsonl(request.stream()),
+        media_type="application/x-ndjson",
+        headers={"X-Accel-Buffering": "no"}
+    )
+
 @app.post("/website-helper", response_model=WebsiteHelperResponse)
 async def website_helper_endpoint(request: WebsiteHelperRequest):
     """Website helper endpoint for page-aware assistance"""
@@ -548,19 +1388,113 @@ async def website_helper_endpoint(request: WebsiteHelperRequest):
         
         return WebsiteHelperResponse(response=response, confidence=0.9)
     
+    except InferenceRejectedError as e:
+        raise HTTPException(status_code=503, detail=f"AI service overloaded: {e.reason}", headers={"Retry-After": "1"})
     except Exception as e:
         logger.error(f"Website helper endpoint error: {e}")
         raise HTTPException(status_code=500, detail="Internal server error")
 
+@app.post("/website-helper/stream")
+async def website_helper_stream_endpoint(request: WebsiteHelperRequest):
+    """Stream the website helper answer as Server-Sent Events ("token" events, then a final "done" event)"""
+    return StreamingResponse(
+        chat_model.stream_website_helper_response(request.message, request.page_context),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
+
+@app.get("/ready")
+async def readiness_check():
+    """Readiness endpoint: 503 until the model is loaded and warmed up"""
+    if chat_model.load_state != "ready":
+        return JSONResponse(status_code=503, content={"status": chat_model.load_state})
+    return {"status": "ready"}
+
 @app.get("/health")
 async def health_check():
     """Health check endpoint"""
-    return {"status": "healthy", "model_loaded": chat_model.model is not None}
+    return {
+        "status": "healthy",
+        "model_loaded": chat_model.model is not None,
+        "load_state": chat_model.load_state,
+        "inference": chat_model.executor.stats(),
+        "batching": chat_model.batcher.stats(),
+        "prefix_cache": chat_model.prefix_cache.stats(),
+        "prompt_builder": chat_model.prompt_builder.stats(),
+        "response_cache": chat_model.response_cache.stats(),
+        "intents": chat_model.intents.stats(),
+        "coalescing": chat_model.single_flight.stats(),
+        "load_shedding": chat_model.load.stats(),
+        "speculative": {"enabled": SPECULATIVE_DECODING, **chat_model.speculative.stats()},
+        "sessions": chat_model.sessions.stats(),
+        "postprocess": chat_model.postprocessor.stats(),
+        "constrained": chat_model.constrained.stats(),
+        "catalog": chat_model.catalog.stats(),
+        "scheduler": chat_model.scheduler.stats(),
+        "backend": chat_model.backend_report,
+        "worker": worker_layout(SERVER_WORKERS, INFERENCE_WORKERS, chat_model.shared_weight_bytes)
+    }
+
+@app.get("/metrics")
+async def metrics():
+    """Prometheus metrics for this worker process"""
+    return PlainTextResponse(REGISTRY.render(), media_type="text/plain; version=0.0.4")
 
 @app.get("/")
 async def root():
     """Root endpoint"""
-    return {"message": "SmolLM2 AI Chat Service", "version": "1.0.0", "model": "HuggingFaceTB/SmolLM2-135M"}
+    return {"message": "SmolLM2 AI Chat Service", "version": "1.0.0", "model": MODEL_NAME}
+
+async def run_batch_file(input_path: str, output_path: str):
+    """Offline mode: answer a JSONL file of ChatRequest items without starting the server"""
+    configure_threads(1, INFERENCE_WORKERS)
+    if not await chat_model.load_model():
+        logger.warning("Model failed to load, batch answers will be fallbacks")
+    
+    async def read_chunks():
+        source = sys.stdin.buffer if input_path == "-" else open(input_path, "rb")
+        try:
+            while True:
+                chunk = await asyncio.get_running_loop().run_in_executor(None, source.read, 64 * 1024)
+                if not chunk:
+                    break
+                yield chunk
+        finally:
+            if source is not sys.stdin.buffer:
+                source.close()
+    
+    output = sys.stdout if output_path == "-" else open(output_path, "w")
+    try:
+        async for line in chat_model.answer_jsonl(read_chunks()):
+            output.write(line)
+        output.flush()
+    finally:
+        if output is not sys.stdout:
+            output.close()
+        chat_model.executor.shutdown()
+        await chat_model.response_cache.close()
 
 if __name__ == "__main__":
-    uvicorn.run(app, host="0.0.0.0", port=8000)
\ No newline at end of file
+    parser = argparse.ArgumentParser(description="SmolLM2 AI chat service")
+    parser.add_argument("--batch", metavar="INPUT", help="Answer a JSONL file of chat requests ('-' for stdin) and exit")
+    parser.add_argument("--output", default="-", help="Where --batch writes JSONL results ('-' for stdout)")
+    args = parser.parse_args()
+    
+    if args.batch:
+        asyncio.run(run_batch_file(args.batch, args.output))
+    elif SERVER_WORKERS > 1:
+        # Prepare the bundle once up front so the workers map one file instead of
+        # each downloading and writing their own copy
+        if not bundle_ready(MODEL_BUNDLE_DIR):
+            try:
+                prepare(MODEL_NAME, MODEL_BUNDLE_DIR)
+            except Exception as e:
+                logger.warning(f"Could not prepare model bundle before starting workers: {e}")
+        # Hand over to the uvicorn CLI: spawned workers then import only app:app instead of
+        # re-running this script, which would import torch twice and miss the worker healthcheck
+        os.execvp(sys.executable, [
+            sys.executable, "-m", "uvicorn", "app:app",
+            "--host", "0.0.0.0", "--port", "8000", "--workers", str(SERVER_WORKERS)
+        ])
+    else:
+        uvicorn.run(app, host="0.0.0.0", port=8000)
\ No newline at end of file
@@ -0,0 +1,148 @@
+"""Selectable CPU inference backends with a startup self-benchmark.
+
+SmolLM2 loads in float32 on CPU. A backend converts that model into a faster
+or smaller variant: dynamic int8 quantization of the linear layers, bfloat16
+weights (only where the CPU has native bf16 support) or a ``torch.compile``d
+forward. Every candidate is benchmarked at startup for tokens/sec and checked
+against the float32 model; a candidate whose greedy predictions diverge, or
+that fails outright, is discarded and the service keeps float32.
+"""
+import copy
+import gc
+import logging
+import resource
+import time
+from typing import Any, Dict, List, Tuple
+
+import torch
+
+logger = logging.getLogger(__name__)
+
+SUPPORTED_BACKENDS = ("float32", "int8", "bfloat16", "compile")
+# "auto" benchmarks these and keeps the fastest one that passes the divergence check
+AUTO_CANDIDATES = ("float32", "int8", "bfloat16")
+
+
+def bf16_supported() -> bool:
+    """Whether the CPU runs bfloat16 matmuls natively (AVX512-BF16 or AMX)"""
+    checks = ("_is_avx512_bf16_supported", "_is_amx_tile_supported")
+    return any(getattr(torch.cpu, check, lambda: False)() for check in checks)
+
+
+def convert(model, backend: str):
+    """Return ``model`` converted to ``backend``; the float32 model is left untouched"""
+    if backend == "float32":
+        return model
+    if backend == "int8":
+        from torch.ao.quantization import quantize_dynamic
+        return quantize_dynamic(model, {torch.nn.Linear}, dtype=torch.qint8, inplace=False)
+    if backend == "bfloat16":
+        if not bf16_supported():
+            raise RuntimeError("CPU has no native bfloat16 support")
+        return copy.deepcopy(model).to(torch.bfloat16)
+    if backend == "compile":
+        # Shallow copy shares the weights; only the copy gets the compiled forward
+        compiled = copy.copy(model)
+        compiled.forward = torch.compile(model.forward, dynamic=True)
+        return compiled
+    raise ValueError(f"Unknown inference backend: {backend}")
+
+
+def _greedy(model, tokenizer, input_ids: torch.Tensor, new_tokens: int) -> torch.Tensor:
+    with torch.no_grad():
+        return model.generate(
+            input_ids=input_ids,
+            attention_mask=torch.ones_like(input_ids),
+            max_new_tokens=new_tokens,
+            min_new_tokens=new_tokens,
+            do_sample=False,
+            pad_token_id=tokenizer.pad_token_id
+        )
+
+
+def benchmark(model, tokenizer, input_ids: torch.Tensor, new_tokens: int) -> Tuple[float, torch.Tensor]:
+    """Greedy-generate ``new_tokens`` after one warm-up run; return (tokens/sec, output ids)"""
+    _greedy(model, tokenizer, input_ids, 2)
+    started = time.perf_counter()
+    output = _greedy(model, tokenizer, input_ids, new_tokens)
+    return new_tokens / (time.perf_counter() - started), output
+
+
+def agreement(model, reference_logits: torch.Tensor, sequence: torch.Tensor) -> float:
+    """Fraction of positions where ``model`` predicts the same next token as the reference"""
+    with torch.no_grad():
+        logits = model(input_ids=sequence).logits
+    return (logits.argmax(-1) == reference_logits.argmax(-1)).float().mean().item()
+
+
+def peak_rss_mb() -> float:
+    """Peak resident set size of this process (Linux reports KiB)"""
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0
+
+
+def select_backend(
+    model,
+    tokenizer,
+    requested: str,
+    probe_prompt: str,
+    bench_tokens: int = 24,
+    min_agreement: float = 0.9
+) -> Tuple[Any, Dict[str, Any]]:
+    """Benchmark the requested backend(s) against float32 and return the model to serve with
+
+    ``requested`` is one of ``SUPPORTED_BACKENDS`` or ``"auto"``. The returned
+    report lists tokens/sec, agreement with float32 and any failure for every
+    candidate that was tried. A plain float32 request is returned as is, unbenchmarked.
+    """
+    candidates: List[str] = list(AUTO_CANDIDATES) if requested == "auto" else [requested]
+    if requested != "auto" and requested not in SUPPORTED_BACKENDS:
+        logger.warning(f"Unknown INFERENCE_BACKEND '{requested}', using float32")
+        candidates = ["float32"]
+    if candidates == ["float32"]:
+        # Nothing to compare against; the reference benchmark would only delay startup
+        logger.info("Serving with inference backend 'float32'")
+        return model, {"requested": requested, "selected": "float32"}
+
+    input_ids = tokenizer(probe_prompt, return_tensors="pt")["input_ids"]
+    reference_speed, reference_output = benchmark(model, tokenizer, input_ids, bench_tokens)
+    with torch.no_grad():
+        reference_logits = model(input_ids=reference_output).logits
+
+    results: Dict[str, Dict[str, Any]] = {
+        "float32": {"tokens_per_sec": round(reference_speed, 1), "agreement": 1.0}
+    }
+    best_name, best_model, best_speed = "float32", model, reference_speed
+    for name in candidates:
+        if name == "float32":
+            continue
+        try:
+            candidate = convert(model, name)
+            speed, _ = benchmark(candidate, tokenizer, input_ids, bench_tokens)
+            score = agreement(candidate, reference_logits, reference_output)
+            results[name] = {"tokens_per_sec": round(speed, 1), "agreement": round(score, 3)}
+        except Exception as e:
+            logger.warning(f"Inference backend '{name}' failed its self-benchmark: {e}")
+            results[name] = {"error": str(e)}
+            continue
+
+        if score < min_agreement:
+            logger.warning(f"Inference backend '{name}' diverges from float32 (agreement {score:.2f}), skipping")
+            results[name]["diverged"] = True
+        elif requested != "auto" or speed > best_speed:
+            best_name, best_model, best_speed = name, candidate, speed
+        candidate = None
+        gc.collect()
+
+    for name, result in results.items():
+        logger.info(f"Inference backend {name}: {result}")
+    logger.info(f"Serving with inference backend '{best_name}' ({best_speed:.1f} tokens/sec)")
+
+    report = {
+        "requested": requested,
+        "selected": best_name,
+        "tokens_per_sec": round(best_speed, 1),
+        "candidates": results,
+        "peak_rss_mb": round(peak_rss_mb(), 1),
+    }
+    return best_model, report
+
@@ -0,0 +1,336 @@
+"""Offline load test and benchmark harness for the AI service.
+
+Runs the FastAPI app in-process against a tiny random-weight stand-in for
+SmolLM2 (same Llama architecture, a BPE tokenizer trained on the service's
+own prompts), so the numbers are reproducible without network access or the
+real checkpoint. Pass ``--model-dir`` to benchmark a prepared model bundle
+instead.
+
+For each endpoint, cache path (every request a miss, or replayed hits) and
+concurrency level it reports p50/p95/p99 latency, request and token
+throughput, fallbacks, replies rejected by the output validation rules and
+the prompt-length distribution of the payloads, which are built from the seed
+catalogue in ``docker/mongo-init.js``. Results are written as JSON;
+``--baseline`` compares them with an earlier run and exits non-zero when p95
+latency, throughput or the validation failure count regress past
+``--threshold``. Run once with ``SPECULATIVE_DECODING=true`` against a
+baseline without it to check speculative decoding end to end.
+
+Usage:
+    python benchmark.py [--concurrency 1,4,8] [--requests 32] [--output benchmark_results.json]
+    python benchmark.py --baseline benchmark_baseline.json [--threshold 0.2] [--update-baseline]
+"""
+import argparse
+import asyncio
+import json
+import logging
+import os
+import platform
+import random
+import sys
+import tempfile
+import time
+from typing import Any, Dict, List, Tuple
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+# Seed products from docker/mongo-init.js, as the Node server sends them in product_info
+CATALOG = [
+    {"name": "Intel Core i9-13900K Processor", "price": 589.99, "category": "CPU", "stock": 50,
+     "description": "24 Cores (8P + 16E) & 32 Threads, up to 5.8 GHz, LGA1700 Socket, Unlocked."},
+    {"name": "AMD Ryzen 9 7950X Processor", "price": 549.00, "category": "CPU", "stock": 40,
+     "description": "16 Cores & 32 Threads, up to 5.7 GHz, AM5 Socket, Unlocked."},
+    {"name": "NVIDIA GeForce RTX 4090", "price": 1599.99, "category": "GPU", "stock": 15,
+     "description": "24GB GDDR6X, PCIe 4.0, Ultimate Gaming Performance."},
+    {"name": "AMD Radeon RX 7900 XTX", "price": 999.00, "category": "GPU", "stock": 25,
+     "description": "24GB GDDR6, RDNA 3 Architecture, High-end Gaming GPU."},
+    {"name": "ASUS ROG Strix Z790-E Gaming WiFi", "price": 499.99, "category": "Motherboard", "stock": 30,
+     "description": "LGA1700 Socket, DDR5, PCIe 5.0, WiFi 6E, ATX Motherboard for Intel 13th Gen."},
+    {"name": "Gigabyte X670 AORUS Elite AX", "price": 289.99, "category": "Motherboard", "stock": 35,
+     "description": "AM5 Socket, DDR5, PCIe 5.0, WiFi 6E, ATX Motherboard for AMD Ryzen 7000 Series."},
+    {"name": "Corsair Vengeance LPX 32GB (2x16GB) DDR4 3200MHz", "price": 94.99, "category": "RAM", "stock": 100,
+     "description": "High-performance DDR4 memory kit for Intel and AMD motherboards."},
+    {"name": "G.Skill Trident Z5 RGB 32GB (2x16GB) DDR5 6000MHz", "price": 149.99, "category": "RAM", "stock": 0,
+     "description": "Extreme performance DDR5 memory with RGB lighting."},
+    {"name": "Samsung 980 Pro 2TB NVMe SSD", "price": 169.99, "category": "Storage", "stock": 80,
+     "description": "PCIe 4.0 NVMe M.2 SSD for high-speed storage and gaming."},
+]
+
+CHAT_MESSAGES = [
+    "Is this compatible with my current build?",
+    "How does this perform for 4K gaming?",
+    "Can you tell me more about this product?",
+    "Is it worth upgrading from last generation?",
+    "What kind of power supply would I need with this?",
+    "Does it come with everything needed to install it, or do I have to buy extra cables and brackets separately?",
+]
+
+HELPER_QUESTIONS = [
+    ("/", "How do I find graphics cards?"),
+    ("/products", "Can I filter by price?"),
+    ("/product/rtx-4090", "Where are the reviews?"),
+    ("/checkout", "Can I change my delivery address?"),
+    ("/seller/dashboard", "Where do I add a new listing?"),
+]
+
+# Share of requests per prompt-length profile: no product, a catalogue product,
+# or a product with a description past the 150-character cut and a long question
+PROMPT_MIX = (("bare", 0.2), ("catalog", 0.6), ("long", 0.2))
+
+
+def chat_payloads(count: int, rng: random.Random) -> List[Tuple[str, Dict[str, Any]]]:
+    """(profile, /chat body) pairs following ``PROMPT_MIX``"""
+    profiles, weights = zip(*PROMPT_MIX)
+    payloads = []
+    for _ in range(count):
+        profile = rng.choices(profiles, weights)[0]
+        product = dict(rng.choice(CATALOG))
+        message = rng.choice(CHAT_MESSAGES)
+        if profile == "bare":
+            product = {}
+        elif profile == "long":
+            product["description"] = " ".join([product["description"]] * 4)
+            message = " ".join(rng.sample(CHAT_MESSAGES, 3))
+        payloads.append((profile, {"message": message, "product_info": product, "seller_name": "TechStore"}))
+    return payloads
+
+
+def helper_payloads(count: int, rng: random.Random) -> List[Tuple[str, Dict[str, Any]]]:
+    """(profile, /website-helper body) pairs; the profile is the page kind"""
+    payloads = []
+    for _ in range(count):
+        page, question = rng.choice(HELPER_QUESTIONS)
+        page_context = {"currentPage": page, "pageTitle": "Componentary", "pageContent": "", "productInfo": {}}
+        if page.startswith("/product/"):
+            page_context["productInfo"] = {"name": CATALOG[2]["name"], "price": str(CATALOG[2]["price"])}
+        payloads.append((page.split("/")[1] or "home", {"message": question, "page_context": page_context}))
+    return payloads
+
+
+def unique(body: Dict[str, Any], ref: str) -> Dict[str, Any]:
+    """Copy of ``body`` whose message no response cache entry can match"""
+    return {**body, "message": f"{body['message']} (ref {ref})"}
+
+
+def build_stand_in(bundle_dir: str, seed: int = 0):
+    """Write a tiny random-weight Llama model and a BPE tokenizer trained on service prompts as a bundle"""
+    import torch
+    from tokenizers import Tokenizer, decoders, models, pre_tokenizers, trainers
+    from transformers import LlamaConfig, LlamaForCausalLM, PreTrainedTokenizerFast
+    from prepare_model import write_bundle
+
+    rng = random.Random(seed)
+    corpus = [json.dumps(body) for _, body in chat_payloads(200, rng) + helper_payloads(50, rng)]
+    with open(os.path.join(os.path.dirname(os.path.abspath(__file__)), "app.py")) as f:
+        corpus.extend(f.read().splitlines())
+
+    bpe = Tokenizer(models.BPE())
+    bpe.pre_tokenizer = pre_tokenizers.ByteLevel(add_prefix_space=False)
+    bpe.decoder = decoders.ByteLevel()
+    bpe.train_from_iterator(corpus, trainers.BpeTrainer(
+        vocab_size=2048, special_tokens=["<|endoftext|>"], initial_alphabet=pre_tokenizers.ByteLevel.alphabet()
+    ))
+    tokenizer = PreTrainedTokenizerFast(tokenizer_object=bpe, eos_token="<|endoftext|>", bos_token="<|endoftext|>")
+
+    torch.manual_seed(seed)
+    config = LlamaConfig(
+        vocab_size=len(tokenizer), hidden_size=128, intermediate_size=256, num_hidden_layers=4,
+        num_attention_heads=4, num_key_value_heads=2, max_position_embeddings=2048,
+        eos_token_id=tokenizer.eos_token_id, bos_token_id=tokenizer.bos_token_id, tie_word_embeddings=True
+    )
+    write_bundle(LlamaForCausalLM(config), tokenizer, bundle_dir, "stand-in/tiny-random-llama")
+
+
+def percentiles(values: List[float]) -> Dict[str, float]:
+    if not values:
+        return {"p50": 0.0, "p95": 0.0, "p99": 0.0, "mean": 0.0}
+    p50, p95, p99 = (float(value) for value in np.percentile(values, [50, 95, 99]))
+    return {"p50": round(p50, 2), "p95": round(p95, 2), "p99": round(p99, 2), "mean": round(float(np.mean(values)), 2)}
+
+
+async def run_load(client, path: str, bodies: List[Dict[str, Any]], concurrency: int) -> Tuple[List[float], Dict[int, int], float]:
+    """Closed-loop load: ``concurrency`` clients send ``bodies`` back to back; returns latencies (ms), status counts, wall time"""
+    pending = iter(bodies)
+    latencies: List[float] = []
+    statuses: Dict[int, int] = {}
+
+    async def client_loop():
+        for body in pending:
+            started = time.perf_counter()
+            response = await client.post(path, json=body)
+            latencies.append((time.perf_counter() - started) * 1000)
+            statuses[response.status_code] = statuses.get(response.status_code, 0) + 1
+
+    started = time.perf_counter()
+    await asyncio.gather(*(client_loop() for _ in range(concurrency)))
+    return latencies, statuses, time.perf_counter() - started
+
+
+async def run_benchmark(args) -> Dict[str, Any]:
+    import httpx
+    import torch
+    import app as svc
+    from metrics import FALLBACKS, GENERATED_TOKENS, RESPONSES
+    from multiprocess import configure_threads
+
+    configure_threads(1, svc.INFERENCE_WORKERS)
+    if not await svc.chat_model.load_model():
+        raise RuntimeError("Model failed to load")
+    tokenizer = svc.chat_model.tokenizer
+
+    def generated_tokens(endpoint: str) -> float:
+        return sum(sample[2] for sample in GENERATED_TOKENS.samples()
+                   if sample[0].endswith("_sum") and f'endpoint="{endpoint}"' in sample[1])
+
+    rng = random.Random(args.seed)
+    workloads = {
+        "chat": ("/chat", chat_payloads(args.requests, rng)),
+        "website_helper": ("/website-helper", helper_payloads(args.requests, rng)),
+    }
+    results: Dict[str, Any] = {}
+    transport = httpx.ASGITransport(app=svc.app)
+    async with httpx.AsyncClient(transport=transport, base_url="http://benchmark", timeout=120) as client:
+        for endpoint, (path, payloads) in workloads.items():
+            if endpoint == "chat":
+                prompts = [svc.chat_model.create_context_prompt(b["message"], b["product_info"], b["seller_name"]) for _, b in payloads]
+            else:
+                prompts = [svc.chat_model.create_website_helper_prompt(b["message"], b["page_context"]) for _, b in payloads]
+            lengths = [len(tokenizer(prompt)["input_ids"]) for prompt in prompts]
+            profiles = {}
+            for (profile, _), length in zip(payloads, lengths):
+                profiles.setdefault(profile, []).append(length)
+            prompt_tokens = {
+                profile: {"count": len(values), **percentiles(values)} for profile, values in sorted(profiles.items())
+            }
+
+            for concurrency in args.concurrency:
+                for cache_path in ("miss", "hit"):
+                    torch.manual_seed(args.seed)
+                    if cache_path == "miss":
+                        bodies = [unique(body, f"{concurrency}-{index}") for index, (_, body) in enumerate(payloads)]
+                    else:
+                        # Prime the cache with the payloads, then measure the replay only
+                        bodies = [body for _, body in payloads]
+                        await run_load(client, path, bodies, concurrency)
+
+                    before = {source: RESPONSES.value(endpoint=endpoint, source=source)
+                              for source in ("model", "cache", "fallback", "rejected")}
+                    tokens_before = generated_tokens(endpoint)
+                    invalid_before = FALLBACKS.value(endpoint=endpoint, reason="validation_failed")
+                    latencies, statuses, elapsed = await run_load(client, path, bodies, concurrency)
+                    sources = {source: int(RESPONSES.value(endpoint=endpoint, source=source) - count)
+                               for source, count in before.items()}
+
+                    key = f"{endpoint}/{cache_path}/c{concurrency}"
+                    results[key] = {
+                        "endpoint": endpoint,
+                        "cache": cache_path,
+                        "concurrency": concurrency,
+                        "requests": len(bodies),
+                        "latency_ms": percentiles(latencies),
+                        "throughput_rps": round(len(latencies) / elapsed, 2),
+                        "tokens_per_sec": round((generated_tokens(endpoint) - tokens_before) / elapsed, 1),
+                        "statuses": {str(status): count for status, count in sorted(statuses.items())},
+                        "sources": sources,
+                        "validation_failed": int(FALLBACKS.value(endpoint=endpoint, reason="validation_failed") - invalid_before),
+                        "prompt_tokens": prompt_tokens,
+                    }
+                    logger.info(f"{key}: {results[key]['latency_ms']} {results[key]['throughput_rps']} req/s")
+
+    svc.chat_model.executor.shutdown()
+    await svc.chat_model.response_cache.close()
+    return {
+        "meta": {
+            "created_at": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
+            "model": args.model_dir or "stand-in",
+            "backend": svc.chat_model.backend_report.get("selected"),
+            "speculative": svc.SPECULATIVE_DECODING,
+            "draft_acceptance_rate": svc.chat_model.speculative.stats()["acceptance_rate"],
+            "seed": args.seed,
+            "requests": args.requests,
+            "python": platform.python_version(),
+            "torch": torch.__version__,
+            "torch_threads": torch.get_num_threads(),
+            "machine": platform.machine(),
+        },
+        "results": results,
+    }
+
+
+def compare(results: Dict[str, Any], baseline: Dict[str, Any], threshold: float) -> List[str]:
+    """Regressions of p95 latency, request throughput or validation failures beyond ``threshold`` (a fraction) versus ``baseline``"""
+    regressions = []
+    for key, current in results["results"].items():
+        previous = baseline.get("results", {}).get(key)
+        if not previous:
+            continue
+        p95, previous_p95 = current["latency_ms"]["p95"], previous["latency_ms"]["p95"]
+        if previous_p95 and p95 > previous_p95 * (1 + threshold):
+            regressions.append(f"{key}: p95 {previous_p95}ms -> {p95}ms")
+        rps, previous_rps = current["throughput_rps"], previous["throughput_rps"]
+        if previous_rps and rps < previous_rps * (1 - threshold):
+            regressions.append(f"{key}: throughput {previous_rps} -> {rps} req/s")
+        invalid, previous_invalid = current.get("validation_failed", 0), previous.get("validation_failed", 0)
+        if invalid > previous_invalid * (1 + threshold) + 1:
+            regressions.append(f"{key}: validation failures {previous_invalid} -> {invalid}")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Offline benchmark of the SmolLM2 AI service")
+    parser.add_argument("--model-dir", help="Prepared model bundle to benchmark instead of the random stand-in")
+    parser.add_argument("--concurrency", default="1,4,8", help="Comma-separated concurrency levels")
+    parser.add_argument("--requests", type=int, default=32, help="Requests per endpoint, cache path and concurrency level")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", default="benchmark_results.json")
+    parser.add_argument("--baseline", help="Earlier results to compare against")
+    parser.add_argument("--threshold", type=float, default=0.2, help="Allowed regression as a fraction (0.2 = 20%%)")
+    parser.add_argument("--update-baseline", action="store_true", help="Write these results to --baseline")
+    args = parser.parse_args()
+    args.concurrency = [int(level) for level in args.concurrency.split(",")]
+
+    logging.basicConfig(level=logging.INFO)
+    logging.getLogger("httpx").setLevel(logging.WARNING)
+    model_dir = args.model_dir or os.path.join(tempfile.gettempdir(), f"smollm-benchmark-stand-in-{args.seed}")
+    if not args.model_dir:
+        build_stand_in(model_dir, args.seed)
+
+    # The app reads its configuration at import time; pin everything that changes the
+    # measured path, leaving the tuning knobs (batching, workers, caches) to the caller
+    os.environ["MODEL_BUNDLE_DIR"] = model_dir
+    os.environ["HF_HUB_OFFLINE"] = "1"
+    os.environ["PREPARE_MODEL_BUNDLE"] = "false"
+    os.environ["RESPONSE_CACHE_REDIS_URL"] = ""
+    os.environ["INTENT_PREROUTE"] = "false"
+    # Load shedding cuts max_new_tokens by measured pressure, coalescing and sessions change
+    # how many generations a request costs, and leads and catalog snippets change the prompts
+    os.environ["LOAD_SHEDDING"] = "false"
+    os.environ["COALESCE_REQUESTS"] = "false"
+    os.environ["CHAT_SESSIONS"] = "false"
+    os.environ["CONSTRAINED_ANSWERS"] = "false"
+    os.environ["CATALOG_PATH"] = ""
+    os.environ.setdefault("INFERENCE_BACKEND", "float32")
+
+    results = asyncio.run(run_benchmark(args))
+    with open(args.output, "w") as f:
+        json.dump(results, f, indent=2)
+    logger.info(f"Wrote benchmark results to {args.output}")
+
+    if args.baseline and args.update_baseline:
+        with open(args.baseline, "w") as f:
+            json.dump(results, f, indent=2)
+        logger.info(f"Updated baseline {args.baseline}")
+    elif args.baseline:
+        with open(args.baseline) as f:
+            regressions = compare(results, json.load(f), args.threshold)
+        for regression in regressions:
+            logger.error(f"Regression: {regression}")
+        if regressions:
+            sys.exit(1)
+        logger.info(f"No regressions beyond {args.threshold:.0%} against {args.baseline}")
+
+
+if __name__ == "__main__":
+    main()
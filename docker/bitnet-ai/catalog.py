@@ -0,0 +1,353 @@
+"""Local product catalog index for grounded answers.
+
+Prompts used to know only the product the Node server sent with the
+request. ``CatalogIndex`` keeps an in-memory copy of the whole catalog,
+loaded from a JSON or JSONL export: a list of products, ``{"products": [...]}``
+or one product per line. Products are searched with BM25 over their name,
+manufacturer, category, tags, features, specifications and description.
+Name-like fields are weighted higher.
+
+Refreshes are incremental. The file is only read again when its mtime or
+size changed. Then only products whose content changed are re-tokenized
+(and re-embedded); products missing from the export are dropped.
+``version`` is a hash of the indexed content, the same in every worker
+process, so response cache keys can include it.
+
+Optionally, when ``sentence-transformers`` is installed and an embedding
+model is configured, products are also embedded. Lexical and semantic
+rankings are then merged with reciprocal rank fusion.
+
+``related`` returns the products a question is about: lexical hits must
+share a name term with the question, embedding hits need a minimum cosine
+similarity. A "X vs Y" question asked on X's page therefore brings Y's
+facts into the prompt without another round-trip to the Node server.
+"""
+import hashlib
+import heapq
+import json
+import logging
+import math
+import os
+import re
+import threading
+import time
+from collections import Counter
+from typing import Any, Dict, Iterable, List, NamedTuple, Optional, Sequence, Tuple
+
+import numpy as np
+
+try:
+    from sentence_transformers import SentenceTransformer
+except ImportError:  # optional dependency
+    SentenceTransformer = None
+
+logger = logging.getLogger(__name__)
+
+_TOKEN = re.compile(r"[a-z0-9]+")
+# Words that never make a question "about" a product on their own
+_STOPWORDS = frozenset(("a", "an", "and", "for", "in", "is", "it", "of", "on", "or", "the", "to", "vs", "with"))
+# Field weights: repeating a field's terms is the usual way to boost it in single-field BM25
+_FIELD_WEIGHTS = (
+    ("name", 3), ("manufacturer", 2), ("modelNumber", 2), ("category", 2), ("subcategory", 2),
+    ("tags", 1), ("features", 1), ("specifications", 1), ("description", 1),
+)
+
+
+def tokenize(text: str) -> List[str]:
+    """Lowercase alphanumeric terms"""
+    return _TOKEN.findall(text.lower())
+
+
+def product_id(product: Dict[str, Any]) -> Optional[str]:
+    """Stable id of an exported product (Mongo ``_id``, ``id``, ``sku`` or the name)"""
+    value = product.get("_id") or product.get("id") or product.get("sku") or product.get("name")
+    if isinstance(value, dict):
+        value = value.get("$oid")
+    return str(value) if value else None
+
+
+def _field_text(value: Any) -> str:
+    if isinstance(value, dict):
+        return " ".join(f"{key} {item}" for key, item in value.items())
+    if isinstance(value, (list, tuple)):
+        return " ".join(str(item) for item in value)
+    return "" if value is None else str(value)
+
+
+def product_text(product: Dict[str, Any]) -> str:
+    """Plain text of the searchable fields, for embedding"""
+    return ". ".join(text for text in (_field_text(product.get(field)) for field, _ in _FIELD_WEIGHTS) if text)
+
+
+def snippet(product: Dict[str, Any], max_specs: int = 3) -> str:
+    """One-line fact summary of a product for a prompt"""
+    name = product.get("name", "")
+    kind = " ".join(str(product[field]) for field in ("manufacturer", "category") if product.get(field))
+    facts = []
+    if product.get("price") is not None:
+        facts.append(f"${product['price']}")
+    stock = product.get("stock")
+    if isinstance(stock, (int, float)):
+        facts.append("in stock" if stock > 0 else "out of stock")
+    specifications = product.get("specifications")
+    if isinstance(specifications, dict):
+        facts.extend(f"{key} {value}" for key, value in list(specifications.items())[:max_specs])
+    return f"{name} ({kind}): {', '.join(facts)}" if kind else f"{name}: {', '.join(facts)}"
+
+
+def read_catalog(path: str) -> List[Dict[str, Any]]:
+    """Products of a JSON (list or {"products": [...]}) or JSONL export"""
+    with open(path, "r", encoding="utf-8") as f:
+        if path.endswith(".jsonl"):
+            products = [json.loads(line) for line in f if line.strip()]
+        else:
+            data = json.load(f)
+            products = data.get("products", []) if isinstance(data, dict) else data
+    return [product for product in products if isinstance(product, dict)]
+
+
+class _Document(NamedTuple):
+    product: Dict[str, Any]
+    terms: Counter
+    length: int
+    name_terms: frozenset
+    fingerprint: str
+
+
+class CatalogHit(NamedTuple):
+    """A product and its (BM25 or fused) relevance score"""
+    product: Dict[str, Any]
+    score: float
+
+
+class CatalogIndex:
+    """In-memory BM25 (and optional embedding) index over the product catalog"""
+
+    def __init__(
+        self,
+        path: str = "",
+        embedding_model: str = "",
+        min_similarity: float = 0.5,
+        k1: float = 1.2,
+        b: float = 0.75
+    ):
+        self.path = path
+        self.min_similarity = min_similarity
+        self.k1 = k1
+        self.b = b
+        self._lock = threading.Lock()
+        self._docs: Dict[str, _Document] = {}
+        self._postings: Dict[str, Dict[str, int]] = {}
+        self._total_length = 0
+        self._file_state: Optional[Tuple[float, int]] = None
+        self.version = ""
+
+        self._embedder = None
+        self._vectors: Dict[str, np.ndarray] = {}
+        self._matrix: Optional[Tuple[List[str], np.ndarray]] = None
+        if embedding_model:
+            if SentenceTransformer is None:
+                logger.warning("CATALOG_EMBEDDING_MODEL is set but sentence-transformers is not installed")
+            else:
+                self._embedder = SentenceTransformer(embedding_model)
+
+        self.refreshes = 0
+        self.updated = 0
+        self.removed = 0
+        self.load_errors = 0
+        self.lookups = 0
+        self.lookup_hits = 0
+        self.lookup_seconds = 0.0
+
+    @property
+    def size(self) -> int:
+        return len(self._docs)
+
+    @property
+    def embeddings(self) -> bool:
+        return self._embedder is not None
+
+    def refresh(self, force: bool = False) -> bool:
+        """Re-read the export if it changed on disk; returns whether the index changed"""
+        if not self.path:
+            return False
+        try:
+            stat = os.stat(self.path)
+        except OSError:
+            return False
+        state = (stat.st_mtime, stat.st_size)
+        if state == self._file_state and not force:
+            return False
+        try:
+            products = read_catalog(self.path)
+        except (OSError, ValueError) as e:
+            self.load_errors += 1
+            logger.warning(f"Could not read catalog {self.path}: {e}")
+            return False
+        self._file_state = state
+        return self.sync(products)
+
+    def sync(self, products: Iterable[Dict[str, Any]]) -> bool:
+        """Make the index hold exactly ``products``, re-indexing only those that changed"""
+        incoming: Dict[str, Tuple[Dict[str, Any], str]] = {}
+        for product in products:
+            doc_id = product_id(product)
+            if doc_id and product.get("isActive", True):
+                incoming[doc_id] = (product, hashlib.sha1(json.dumps(product, sort_keys=True, default=str).encode("utf-8")).hexdigest())
+
+        with self._lock:
+            removed = [doc_id for doc_id in self._docs if doc_id not in incoming]
+            changed = [
+                doc_id for doc_id, (_, fingerprint) in incoming.items()
+                if doc_id not in self._docs or self._docs[doc_id].fingerprint != fingerprint
+            ]
+        # Tokenizing and embedding happen outside the lock so searches keep running
+        documents = {doc_id: self._document(*incoming[doc_id]) for doc_id in changed}
+        vectors = self._embed([product_text(documents[doc_id].product) for doc_id in changed]) if changed else None
+
+        with self._lock:
+            for doc_id in removed:
+                self._remove(doc_id)
+            for row, doc_id in enumerate(changed):
+                self._remove(doc_id)
+                self._add(doc_id, documents[doc_id])
+                if vectors is not None:
+                    self._vectors[doc_id] = vectors[row]
+            if removed or changed:
+                self._matrix = None
+                self.version = hashlib.sha1(
+                    "".join(f"{doc_id}:{doc.fingerprint}" for doc_id, doc in sorted(self._docs.items())).encode("utf-8")
+                ).hexdigest()[:16]
+            self.refreshes += 1
+            self.updated += len(changed)
+            self.removed += len(removed)
+        if removed or changed:
+            logger.info(f"Catalog index: {len(changed)} products updated, {len(removed)} removed, {len(self._docs)} total")
+        return bool(removed or changed)
+
+    def _document(self, product: Dict[str, Any], fingerprint: str) -> _Document:
+        terms: Counter = Counter()
+        for field, weight in _FIELD_WEIGHTS:
+            for term in tokenize(_field_text(product.get(field))):
+                terms[term] += weight
+        # Short terms ("7", "rx") are too common across names to tie a question to a product alone
+        name_terms = frozenset(
+            term for term in tokenize(str(product.get("name", ""))) if len(term) >= 3 and term not in _STOPWORDS
+        )
+        return _Document(product, terms, sum(terms.values()), name_terms, fingerprint)
+
+    def _embed(self, texts: List[str]) -> Optional[np.ndarray]:
+        if self._embedder is None:
+            return None
+        vectors = np.asarray(self._embedder.encode(texts), dtype=np.float32)
+        return vectors / np.maximum(np.linalg.norm(vectors, axis=1, keepdims=True), 1e-12)
+
+    def _add(self, doc_id: str, document: _Document):
+        self._docs[doc_id] = document
+        self._total_length += document.length
+        for term, count in document.terms.items():
+            self._postings.setdefault(term, {})[doc_id] = count
+
+    def _remove(self, doc_id: str):
+        document = self._docs.pop(doc_id, None)
+        self._vectors.pop(doc_id, None)
+        if document is None:
+            return
+        self._total_length -= document.length
+        for term in document.terms:
+            postings = self._postings.get(term)
+            if postings is not None:
+                postings.pop(doc_id, None)
+                if not postings:
+                    del self._postings[term]
+
+    def _bm25(self, terms: Sequence[str]) -> Dict[str, float]:
+        count = len(self._docs)
+        average_length = self._total_length / count if count else 0.0
+        scores: Dict[str, float] = {}
+        for term in set(terms):
+            postings = self._postings.get(term)
+            if not postings:
+                continue
+            idf = math.log(1.0 + (count - len(postings) + 0.5) / (len(postings) + 0.5))
+            for doc_id, frequency in postings.items():
+                norm = self.k1 * (1.0 - self.b + self.b * self._docs[doc_id].length / average_length)
+                scores[doc_id] = scores.get(doc_id, 0.0) + idf * frequency * (self.k1 + 1.0) / (frequency + norm)
+        return scores
+
+    def _similarities(self, query: str) -> Dict[str, float]:
+        # Encoding the query needs no lock; the matrix is rebuilt after refreshes
+        vector = self._embed([query])[0]
+        with self._lock:
+            if self._matrix is None and self._vectors:
+                ids = list(self._vectors)
+                self._matrix = (ids, np.stack([self._vectors[doc_id] for doc_id in ids]))
+            matrix = self._matrix
+        if matrix is None:
+            return {}
+        ids, vectors = matrix
+        return dict(zip(ids, (vectors @ vector).tolist()))
+
+    def search(self, query: str, k: int = 5) -> List[CatalogHit]:
+        """Top ``k`` products for ``query`` by BM25, fused with embedding similarity when enabled"""
+        return self._lookup(query, k, related=False, exclude=())
+
+    def related(self, query: str, k: int = 2, exclude: Sequence[str] = ()) -> List[CatalogHit]:
+        """Products ``query`` is about: lexical hits naming them or close embedding hits
+
+        ``exclude`` holds product names (e.g. the product the prompt already
+        describes) to leave out.
+        """
+        return self._lookup(query, k, related=True, exclude=exclude)
+
+    def _lookup(self, query: str, k: int, related: bool, exclude: Sequence[str]) -> List[CatalogHit]:
+        started = time.perf_counter()
+        terms = tokenize(query)
+        hits: List[CatalogHit] = []
+        if terms and self._docs and k > 0:
+            similarities = self._similarities(query) if self._embedder is not None else {}
+            excluded = {name.lower() for name in exclude if name}
+            query_terms = frozenset(terms) - _STOPWORDS
+            with self._lock:
+                lexical = self._bm25(terms)
+                if related:
+                    lexical = {doc_id: score for doc_id, score in lexical.items() if self._docs[doc_id].name_terms & query_terms}
+                    similarities = {doc_id: score for doc_id, score in similarities.items() if score >= self.min_similarity}
+                if similarities:
+                    # Reciprocal rank fusion of the lexical and semantic rankings
+                    fused: Dict[str, float] = {}
+                    for ranking in (lexical, similarities):
+                        for rank, doc_id in enumerate(sorted(ranking, key=ranking.get, reverse=True)):
+                            fused[doc_id] = fused.get(doc_id, 0.0) + 1.0 / (60 + rank)
+                    scores = fused
+                else:
+                    scores = lexical
+                candidates = (
+                    (score, doc_id) for doc_id, score in scores.items()
+                    if doc_id in self._docs and str(self._docs[doc_id].product.get("name", "")).lower() not in excluded
+                )
+                hits = [CatalogHit(self._docs[doc_id].product, score) for score, doc_id in heapq.nlargest(k, candidates)]
+
+        elapsed = time.perf_counter() - started
+        with self._lock:
+            self.lookups += 1
+            self.lookup_hits += 1 if hits else 0
+            self.lookup_seconds += elapsed
+        return hits
+
+    def stats(self) -> Dict[str, Any]:
+        """Catalog index counters for health reporting"""
+        with self._lock:
+            return {
+                "products": len(self._docs),
+                "terms": len(self._postings),
+                "version": self.version,
+                "embeddings": self._embedder is not None,
+                "refreshes": self.refreshes,
+                "updated": self.updated,
+                "removed": self.removed,
+                "load_errors": self.load_errors,
+                "lookups": self.lookups,
+                "lookup_hits": self.lookup_hits,
+                "avg_lookup_ms": round(self.lookup_seconds / self.lookups * 1000.0, 3) if self.lookups else 0.0,
+            }
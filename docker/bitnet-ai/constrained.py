@@ -0,0 +1,122 @@
+"""Template-constrained answers to price, stock and spec questions.
+
+Free-form answers to factual questions often state a wrong price or stock
+count. They then fail validation or, worse, pass with the wrong fact. For
+these intents the seller reply is started from an ``AnswerTemplate`` filled
+from ``product_info`` ("The RTX 4070 is priced at $599"). That lead is
+appended to the prompt right after the seller cue, so it costs one prefill
+instead of a decode step per token. The model only writes the rest of the
+sentence. ``DigitBanLogitsProcessor`` masks every token containing a digit
+while it does, so the continuation cannot state a different number.
+"""
+import logging
+import threading
+from typing import Any, Dict, NamedTuple, Optional, Sequence, Tuple
+
+import torch
+from transformers import LogitsProcessor
+
+from intents import reply_fields
+
+logger = logging.getLogger(__name__)
+
+
+class AnswerTemplate(NamedTuple):
+    """Fact-filled start of a reply for one chat intent"""
+    label: str
+    # Fields that must all be present; the first matching template of a label is used
+    required: Tuple[str, ...]
+    lead: str
+
+
+ANSWER_TEMPLATES: Tuple[AnswerTemplate, ...] = (
+    AnswerTemplate("price", ("name", "price"), "The {name} is priced at ${price}"),
+    AnswerTemplate("price", ("price",), "This product is priced at ${price}"),
+    AnswerTemplate("stock", ("in_stock", "name"), "We have {stock} units of the {name} in stock"),
+    AnswerTemplate("stock", ("in_stock",), "We have {stock} units in stock"),
+    AnswerTemplate("stock", ("out_of_stock", "name"), "The {name} is currently out of stock"),
+    AnswerTemplate("stock", ("out_of_stock",), "This item is currently out of stock"),
+    # Spec questions are classified as "quality" ("spec*", "feature*")
+    AnswerTemplate("quality", ("name", "specs"), "The {name} comes with {specs}"),
+)
+
+
+def template_fields(product_info: Optional[Dict], max_specs: int = 3) -> Dict[str, Any]:
+    """Reply fields plus the first ``max_specs`` specifications as "key value" pairs"""
+    fields = reply_fields(product_info)
+    specifications = (product_info or {}).get("specifications")
+    if isinstance(specifications, dict):
+        specs = [f"{key} {value}" for key, value in specifications.items() if value not in (None, "")]
+        if specs:
+            fields["specs"] = ", ".join(specs[:max_specs])
+    return fields
+
+
+class DigitBanLogitsProcessor(LogitsProcessor):
+    """Masks tokens that contain a digit in the given batch rows"""
+
+    def __init__(self, banned_ids: torch.LongTensor, rows: Sequence[int]):
+        self.banned_ids = banned_ids
+        self.rows = list(rows)
+
+    def __call__(self, input_ids: torch.LongTensor, scores: torch.FloatTensor) -> torch.FloatTensor:
+        rows = torch.tensor(self.rows, device=scores.device).unsqueeze(1)
+        scores[rows, self.banned_ids.to(scores.device)] = -float("inf")
+        return scores
+
+
+class ConstrainedAnswers:
+    """Picks the template lead for a chat message and builds the matching logits processor"""
+
+    def __init__(self, templates: Sequence[AnswerTemplate] = ANSWER_TEMPLATES, enabled: bool = True):
+        self._templates: Dict[str, Tuple[AnswerTemplate, ...]] = {}
+        for template in templates:
+            self._templates[template.label] = self._templates.get(template.label, ()) + (template,)
+        self.enabled = enabled
+        self._lock = threading.Lock()
+        self._banned_ids: Optional[torch.LongTensor] = None
+        self._banned_for = None
+        self._leads: Dict[str, int] = {}
+
+    def lead(self, label: Optional[str], product_info: Optional[Dict]) -> str:
+        """Filled template lead for an intent label, or "" to let the model answer freely"""
+        if not self.enabled or label not in self._templates:
+            return ""
+        fields = template_fields(product_info)
+        for template in self._templates[label]:
+            if all(fields.get(name) not in (None, "") for name in template.required):
+                return template.lead.format(**fields)
+        return ""
+
+    def record(self, label: str):
+        """Count a generation that started from a lead of intent ``label``"""
+        with self._lock:
+            self._leads[label] = self._leads.get(label, 0) + 1
+
+    def processor(self, tokenizer, rows: Sequence[int]) -> Optional[DigitBanLogitsProcessor]:
+        """Processor that keeps ``rows`` from generating numbers, or None when no row is constrained"""
+        if not rows:
+            return None
+        return DigitBanLogitsProcessor(self._digit_ids(tokenizer), rows)
+
+    def _digit_ids(self, tokenizer) -> torch.LongTensor:
+        # One pass over the vocabulary per tokenizer; token strings are enough to spot digits
+        with self._lock:
+            if self._banned_for is not tokenizer:
+                tokens = tokenizer.convert_ids_to_tokens(list(range(len(tokenizer))))
+                self._banned_ids = torch.tensor(
+                    [index for index, token in enumerate(tokens) if token and any(char.isdigit() for char in token)],
+                    dtype=torch.long
+                )
+                self._banned_for = tokenizer
+                logger.info(f"Constrained answers ban {len(self._banned_ids)} digit tokens")
+            return self._banned_ids
+
+    def stats(self) -> Dict[str, Any]:
+        """Template lead counters for health reporting"""
+        with self._lock:
+            return {
+                "enabled": self.enabled,
+                "leads": dict(self._leads),
+                "banned_tokens": 0 if self._banned_ids is None else len(self._banned_ids),
+            }
@@ -0,0 +1,370 @@
+"""Inference worker pool and micro-batching for the SmolLM2 chat service.
+
+Model generation is CPU bound and blocking, so it must never run on the
+uvicorn event loop. Requests are admitted into a bounded queue in front of a
+dedicated thread pool; anything beyond the queue is rejected immediately and
+anything that waits past its deadline is dropped before it reaches the model.
+The queue is a ``FairScheduler``: a free worker takes the waiting job of the
+highest priority class, shared fairly across sellers within the class.
+
+Concurrent requests for the same endpoint are collected for a few
+milliseconds by ``MicroBatcher`` and handed to the pool as a single batch, so
+one padded ``generate`` call serves several callers. A batch is only filled
+when a worker starts it, fairly across sellers, so requests queued behind a
+busy seller's burst still get into the next batch. ``ordered_map`` feeds a
+long stream of requests through the same path with a fixed number in flight.
+"""
+import asyncio
+import collections
+import functools
+import logging
+import math
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, AsyncIterable, AsyncIterator, Awaitable, Callable, Dict, Hashable, List, NamedTuple, Optional, Tuple
+
+from scheduler import FairQueue, FairScheduler
+
+logger = logging.getLogger(__name__)
+
+
+class InferenceRejectedError(Exception):
+    """Raised when a generation request cannot be served by the worker pool"""
+
+    reason = "rejected"
+
+
+class QueueFullError(InferenceRejectedError):
+    """The admission queue is full"""
+
+    reason = "queue_full"
+
+
+class DeadlineExceededError(InferenceRejectedError):
+    """The request was not completed before its deadline"""
+
+    reason = "deadline_exceeded"
+
+
+class _Job(NamedTuple):
+    """A call waiting in the scheduler and where to deliver its outcome"""
+    call: Callable[[], Any]
+    deadline: float
+    future: asyncio.Future
+    loop: asyncio.AbstractEventLoop
+
+
+def _resolve(future: asyncio.Future, result: Any, error: Optional[BaseException]):
+    if future.done():
+        return
+    if error is not None:
+        future.set_exception(error)
+    else:
+        future.set_result(result)
+
+
+class InferenceExecutor:
+    """Bounded thread pool that runs blocking model calls off the event loop
+
+    Admitted jobs wait in ``scheduler``. Each job submits one step to the pool,
+    and that step runs whichever job the scheduler picks when a thread frees up.
+    """
+
+    def __init__(
+        self,
+        workers: int = 1,
+        max_queue: int = 16,
+        default_timeout: float = 15.0,
+        scheduler: Optional[FairScheduler] = None
+    ):
+        self.workers = max(1, workers)
+        self.max_queue = max(0, max_queue)
+        self.default_timeout = default_timeout
+        self.scheduler = scheduler or FairScheduler(default_deadline=default_timeout)
+        self._pool = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="inference")
+        self._lock = threading.Lock()
+        self._admitted = 0  # queued + running
+        self._running = 0
+        self.completed = 0
+        self.rejected = 0
+        self.expired = 0
+
+    @property
+    def queue_depth(self) -> int:
+        """Number of admitted jobs still waiting for a worker"""
+        return self._admitted - self._running
+
+    async def run(
+        self,
+        fn: Callable[..., Any],
+        *args,
+        timeout: Optional[float] = None,
+        priority_class: str = "",
+        flow: Hashable = "",
+        **kwargs
+    ) -> Any:
+        """Run ``fn`` on the pool, enforcing admission limits and a deadline
+
+        ``timeout`` defaults to the deadline of ``priority_class``; ``math.inf``
+        disables it for jobs that enforce deadlines themselves.
+        """
+        timeout = self.scheduler.deadline(priority_class) if timeout is None else timeout
+        deadline = time.monotonic() + timeout
+
+        with self._lock:
+            if self._admitted >= self.workers + self.max_queue:
+                self.rejected += 1
+                raise QueueFullError(f"Inference queue is full ({self.max_queue} waiting)")
+            self._admitted += 1
+
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        self.scheduler.push(_Job(functools.partial(fn, *args, **kwargs), deadline, future, loop), priority_class, flow)
+        self._pool.submit(self._step)
+        if math.isinf(timeout):
+            return await future
+        try:
+            # Shield the job future: a job that has not started yet is dropped by
+            # the worker that picks it, keeping the counters exact.
+            return await asyncio.wait_for(asyncio.shield(future), timeout=max(0.0, deadline - time.monotonic()))
+        except asyncio.TimeoutError:
+            with self._lock:
+                self.expired += 1
+            # Nobody waits for the outcome any more; retrieve it so it is not logged as lost
+            future.add_done_callback(lambda done: done.cancelled() or done.exception())
+            raise DeadlineExceededError(f"Inference did not finish within {timeout:.1f}s")
+
+    def _step(self):
+        """Worker-side body: run the job the scheduler picks next, or drop it if its deadline passed"""
+        picked = self.scheduler.pop()
+        if picked is None:
+            return
+        name, job = picked
+        result, error = None, None
+        try:
+            if time.monotonic() >= job.deadline:
+                self.scheduler.record_drop(name)
+                raise DeadlineExceededError("Deadline passed while queued")
+            with self._lock:
+                self._running += 1
+            try:
+                result = job.call()
+            finally:
+                with self._lock:
+                    self._running -= 1
+                    self.completed += 1
+        except Exception as e:
+            error = e
+        finally:
+            with self._lock:
+                self._admitted -= 1
+        try:
+            job.loop.call_soon_threadsafe(_resolve, job.future, result, error)
+        except RuntimeError:
+            # The event loop closed while the job ran (shutdown)
+            pass
+
+    def stats(self) -> Dict[str, Any]:
+        """Snapshot of pool state for health reporting"""
+        with self._lock:
+            return {
+                "workers": self.workers,
+                "max_queue": self.max_queue,
+                "running": self._running,
+                "queued": self._admitted - self._running,
+                "completed": self.completed,
+                "rejected": self.rejected,
+                "expired": self.expired,
+            }
+
+    def shutdown(self):
+        """Stop accepting work and release the worker threads"""
+        self._pool.shutdown(wait=False)
+
+
+class _Pending(NamedTuple):
+    """A request waiting to be put into a batch"""
+    item: Any
+    future: asyncio.Future
+    deadline: float
+
+
+class MicroBatcher:
+    """Groups concurrent requests by key and runs each group as one batch job
+
+    ``runner(key, items)`` is called on the inference pool and must return one
+    result per item, in order. Requests with different keys (e.g. endpoints
+    with different sampling settings) or priority classes are never mixed in
+    a batch. The priority class defaults to the key, and ``flow`` (the seller)
+    decides whose requests fill a batch first.
+    """
+
+    def __init__(
+        self,
+        executor: InferenceExecutor,
+        runner: Callable[[Hashable, List[Any]], List[Any]],
+        max_batch_size: int = 4,
+        max_wait_ms: float = 10.0
+    ):
+        self.executor = executor
+        self.runner = runner
+        self.max_batch_size = max(1, max_batch_size)
+        self.max_wait = max(0.0, max_wait_ms) / 1000.0
+        self._lock = threading.Lock()
+        # Keyed by (key, priority class)
+        self._pending: Dict[Tuple[Hashable, str], FairQueue] = {}
+        # Batch jobs per group that are queued but have not filled their batch yet
+        self._jobs: Dict[Tuple[Hashable, str], int] = {}
+        self._timers: Dict[Tuple[Hashable, str], asyncio.TimerHandle] = {}
+        self.batches = 0
+        self.batched_items = 0
+
+    async def submit(
+        self,
+        key: Hashable,
+        item: Any,
+        timeout: Optional[float] = None,
+        flow: Hashable = "",
+        priority_class: Optional[str] = None
+    ) -> Any:
+        """Queue ``item`` under ``key`` and wait for its share of the batch result
+
+        ``timeout`` defaults to the deadline of ``priority_class``, which defaults to ``key``.
+        """
+        group = (key, key if priority_class is None else priority_class)
+        timeout = self.executor.scheduler.deadline(group[1]) if timeout is None else timeout
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        with self._lock:
+            if group not in self._pending:
+                self._pending[group] = self.executor.scheduler.fair_queue()
+            pending = self._pending[group]
+            pending.push(_Pending(item, future, time.monotonic() + timeout), flow)
+            unclaimed = len(pending) - self._jobs.get(group, 0) * self.max_batch_size
+
+        if unclaimed >= self.max_batch_size:
+            self._flush(group)
+        elif group not in self._timers:
+            self._timers[group] = loop.call_later(self.max_wait, self._flush, group)
+
+        try:
+            # Timing out cancels our future, so the batch skips this item if it
+            # has not been filled yet
+            return await asyncio.wait_for(future, timeout=timeout)
+        except asyncio.TimeoutError:
+            raise DeadlineExceededError(f"Batched inference did not finish within {timeout:.1f}s")
+
+    def _flush(self, group: Tuple[Hashable, str]):
+        """Queue enough batch jobs to cover everything collected under ``group``"""
+        timer = self._timers.pop(group, None)
+        if timer is not None:
+            timer.cancel()
+        with self._lock:
+            jobs = self._jobs.get(group, 0)
+            needed = -(-len(self._pending.get(group, ())) // self.max_batch_size) - jobs
+            if needed > 0:
+                self._jobs[group] = jobs + needed
+        for _ in range(needed):
+            asyncio.ensure_future(self._run_batch(group))
+
+    async def _run_batch(self, group: Tuple[Hashable, str]):
+        """Run one batch job on the pool and fan the results back out to the callers"""
+        key, priority_class = group
+        try:
+            # The requests carry their own deadlines, so the job itself never expires
+            batch, expired, results, error = await self.executor.run(
+                self._fill_and_run, group, timeout=math.inf, priority_class=priority_class, flow=("batch", key)
+            )
+        except Exception as e:
+            # Rejected before it was queued: fail the requests this job would have served
+            with self._lock:
+                self._jobs[group] -= 1
+                batch = self._take(group)[0]
+            for pending in batch:
+                if not pending.future.done():
+                    pending.future.set_exception(e)
+            return
+
+        for pending in expired:
+            if not pending.future.done():
+                pending.future.set_exception(DeadlineExceededError("Deadline passed while queued"))
+        if error is not None:
+            for pending in batch:
+                if not pending.future.done():
+                    pending.future.set_exception(error)
+            return
+        for pending, result in zip(batch, results):
+            if not pending.future.done():
+                pending.future.set_result(result)
+
+    def _take(self, group: Tuple[Hashable, str]) -> Tuple[List[_Pending], List[_Pending]]:
+        """Pop up to a batch of live requests in fair order, plus the expired ones passed over
+
+        Called with the lock held.
+        """
+        queue = self._pending.get(group)
+        batch, expired = [], []
+        now = time.monotonic()
+        while queue and len(batch) < self.max_batch_size:
+            pending = queue.pop()
+            # Callers that already gave up waiting are not worth a slot in the batch either
+            if pending.future.done() or now >= pending.deadline:
+                expired.append(pending)
+            else:
+                batch.append(pending)
+        if queue is not None and not queue:
+            del self._pending[group]
+        return batch, expired
+
+    def _fill_and_run(self, group: Tuple[Hashable, str]) -> Tuple[List[_Pending], List[_Pending], List[Any], Optional[Exception]]:
+        """Worker-side body of a batch job: fill the batch now and run it"""
+        key, priority_class = group
+        with self._lock:
+            self._jobs[group] -= 1
+            batch, expired = self._take(group)
+            if batch:
+                self.batches += 1
+                self.batched_items += len(batch)
+        if expired:
+            self.executor.scheduler.record_drop(priority_class, len(expired))
+        if not batch:
+            return batch, expired, [], None
+        try:
+            return batch, expired, self.runner(key, [pending.item for pending in batch]), None
+        except Exception as e:
+            return batch, expired, [], e
+
+    def stats(self) -> Dict[str, Any]:
+        """Batching counters for health reporting"""
+        with self._lock:
+            pending: Dict[str, int] = {}
+            for (_, priority_class), queue in self._pending.items():
+                pending[priority_class] = pending.get(priority_class, 0) + len(queue)
+            return {
+                "max_batch_size": self.max_batch_size,
+                "max_wait_ms": self.max_wait * 1000.0,
+                "batches": self.batches,
+                "avg_batch_size": round(self.batched_items / self.batches, 2) if self.batches else 0.0,
+                "pending": pending,
+            }
+
+
+async def ordered_map(fn: Callable[[Any], Awaitable[Any]], items: AsyncIterable[Any], window: int) -> AsyncIterator[Any]:
+    """Yield ``await fn(item)`` for each item in input order, with at most ``window`` calls in flight
+
+    Items are only pulled from ``items`` as results are handed out, so memory
+    stays bounded however long the input stream is.
+    """
+    pending = collections.deque()
+    try:
+        async for item in items:
+            pending.append(asyncio.ensure_future(fn(item)))
+            if len(pending) >= max(1, window):
+                yield await pending.popleft()
+        while pending:
+            yield await pending.popleft()
+    finally:
+        # The consumer went away (e.g. client disconnect); drop the work still in flight
+        for task in pending:
+            task.cancel()
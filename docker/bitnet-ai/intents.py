@@ -0,0 +1,221 @@
+"""Compiled intent classifier for fallback replies and FAQ pre-routing.
+
+Every canned reply the service can give lives in ``INTENTS``, one
+declarative table of trigger phrases and reply templates per endpoint. The
+phrases of an endpoint are compiled into a single regex that only matches on
+word boundaries, so one pass over the message finds every trigger ("hi" no
+longer fires inside "shipping"). Each intent scores the share of trigger
+evidence it collected; a confident match on an FAQ intent can be answered
+straight from its template without running the model, unless the message
+is negated ("no thanks").
+"""
+import logging
+import re
+import threading
+from typing import Any, Dict, List, NamedTuple, Optional, Sequence, Tuple
+
+logger = logging.getLogger(__name__)
+
+
+class Intent(NamedTuple):
+    """One row of the intent table"""
+    endpoint: str
+    label: str
+    # Lowercase trigger phrases; a trailing "*" also matches longer words ("spec*" -> "specs")
+    phrases: Tuple[str, ...]
+    # (required fields, template) pairs; the first whose fields are all present is used
+    replies: Tuple[Tuple[Tuple[str, ...], str], ...]
+    weight: float = 1.0
+    # Static answers that are safe to give without the model
+    faq: bool = False
+
+
+class IntentMatch(NamedTuple):
+    """Best intent for a message and its share of the trigger evidence (0-1)"""
+    label: str
+    score: float
+    faq: bool
+
+
+INTENTS: Tuple[Intent, ...] = (
+    # Seller chat
+    Intent("chat", "greeting", ("hello", "hi", "hey", "good morning", "good afternoon"), (
+        (("name",), "Hello! I see you're interested in the {name}. How can I help you with this product today?"),
+        ((), "Hello! Welcome to Componentary. How can I assist you with your tech needs today?"),
+    ), weight=0.5),
+    Intent("chat", "price", ("price*", "cost*", "expensive", "cheap*", "how much"), (
+        (("price",), "This product is priced at ${price}. It offers excellent value for its features. Would you like to know more about what's included?"),
+        ((), "I'd be happy to discuss pricing. Which specific product are you interested in?"),
+    )),
+    Intent("chat", "stock", ("stock", "available", "availability", "in stock", "out of stock"), (
+        (("in_stock",), "Good news! This item is currently in stock with {stock} units available. Would you like to place an order?"),
+        (("out_of_stock",), "This item is currently out of stock. I can notify you when it becomes available again. Would you like me to do that?"),
+        ((), "Let me check our current inventory for you. Which product are you asking about?"),
+    )),
+    Intent("chat", "shipping", ("shipping", "delivery", "deliver", "ship", "ships", "when will it arrive"), (
+        ((), "We offer fast shipping! Most orders ship within 1-2 business days and arrive within 2-5 business days. Free shipping is available on orders over $50."),
+    ), faq=True),
+    Intent("chat", "quality", ("quality", "good", "best", "spec*", "feature*"), (
+        (("name",), "The {name} is a high-quality product. Would you like me to explain its key features and specifications?"),
+        ((), "All our products are carefully selected for quality. What specific features are you looking for?"),
+    )),
+    Intent("chat", "returns", ("return", "returns", "refund*", "warranty", "guarantee*"), (
+        ((), "We offer a 30-day return policy and full manufacturer warranty on all products. Your satisfaction is guaranteed!"),
+    ), faq=True),
+    Intent("chat", "comparison", ("compare", "comparison", "difference", "better", "versus", "vs"), (
+        ((), "I'd be happy to help you compare products. What specific items are you considering, and what features matter most to you?"),
+    )),
+    Intent("chat", "thanks", ("thank*",), (
+        ((), "You're very welcome! Is there anything else I can help you with today?"),
+    ), faq=True),
+    Intent("chat", "default", (), (
+        (("name",), "Thanks for your interest in the {name}! How can I help you learn more about this product?"),
+        ((), "Thank you for contacting Componentary! I'm here to help with any questions about our tech products. What can I assist you with?"),
+    )),
+
+    # Website helper
+    Intent("website_helper", "navigate", ("navigate", "navigation", "help", "how"), (
+        ((), "Welcome to Componentary! Use the navigation menu to browse products, manage your account, or access seller tools. What are you looking for?"),
+    ), weight=0.5),
+    Intent("website_helper", "search", ("search", "find", "product*"), (
+        ((), "Use the search bar at the top or browse by categories. I can help you find specific PC components or tech products."),
+    )),
+    Intent("website_helper", "account", ("account", "profile", "login", "log in", "sign in"), (
+        ((), "Access your account through the login button in the top right. You can manage orders, profile, and preferences there."),
+    ), faq=True),
+    Intent("website_helper", "default", (), (
+        ((), "I'm here to help you navigate Componentary! Ask me about products, account features, or how to use the website."),
+    )),
+)
+
+
+# A negation anywhere in the message ("no thanks", "I don't need a refund") turns a canned
+# FAQ answer around, so such messages are never pre-routed
+NEGATION = re.compile(r"(?<!\w)(?:no|not|nope|never|cannot|\w+n't)(?!\w)")
+
+
+def _phrase_pattern(phrase: str) -> str:
+    words = phrase.rstrip("*").split()
+    pattern = r"\s+".join(re.escape(word) for word in words)
+    return pattern + r"\w*" if phrase.endswith("*") else pattern
+
+
+def reply_fields(product_info: Optional[Dict]) -> Dict[str, Any]:
+    """Template fields for a product; stock is split into in/out flags for template selection"""
+    product_info = product_info or {}
+    fields: Dict[str, Any] = {
+        "name": product_info.get("name"),
+        "price": product_info.get("price"),
+        "stock": product_info.get("stock"),
+    }
+    stock = fields["stock"]
+    if isinstance(stock, (int, float)):
+        fields["in_stock" if stock > 0 else "out_of_stock"] = True
+    return fields
+
+
+class IntentClassifier:
+    """Single-pass, word-boundary intent matcher over the intent table"""
+
+    def __init__(self, intents: Sequence[Intent] = INTENTS):
+        self._intents: Dict[Tuple[str, str], Intent] = {}
+        # Table position of each intent, for breaking score ties
+        self._order: Dict[Tuple[str, str], int] = {}
+        self._patterns: Dict[str, re.Pattern] = {}
+        # endpoint -> regex group name -> (intent label, evidence weight)
+        self._groups: Dict[str, Dict[str, Tuple[str, float]]] = {}
+
+        phrases_by_endpoint: Dict[str, List[Tuple[str, Intent]]] = {}
+        for index, intent in enumerate(intents):
+            self._intents[(intent.endpoint, intent.label)] = intent
+            self._order.setdefault((intent.endpoint, intent.label), index)
+            for phrase in intent.phrases:
+                phrases_by_endpoint.setdefault(intent.endpoint, []).append((phrase, intent))
+
+        for endpoint, phrases in phrases_by_endpoint.items():
+            # Longest phrases first so "out of stock" wins over "stock" at the same position
+            phrases.sort(key=lambda item: len(item[0]), reverse=True)
+            groups, alternatives = {}, []
+            for index, (phrase, intent) in enumerate(phrases):
+                name = f"p{index}"
+                groups[name] = (intent.label, intent.weight * len(phrase.split()))
+                alternatives.append(f"(?P<{name}>{_phrase_pattern(phrase)})")
+            self._patterns[endpoint] = re.compile(rf"(?<!\w)(?:{'|'.join(alternatives)})(?!\w)")
+            self._groups[endpoint] = groups
+
+        self._lock = threading.Lock()
+        self._matches: Dict[str, int] = {}
+        self._prerouted = 0
+
+    def classify(self, endpoint: str, message: str) -> Optional[IntentMatch]:
+        """Best matching intent for ``message``, or None when no trigger phrase occurs
+
+        Not counted in the match statistics; see ``observe``.
+        """
+        pattern = self._patterns.get(endpoint)
+        if pattern is None or not message:
+            return None
+
+        scores: Dict[str, float] = {}
+        seen = set()
+        for match in pattern.finditer(message.lower()):
+            # Repeating a phrase ("hi hi hi") adds no extra evidence
+            if match.lastgroup in seen:
+                continue
+            seen.add(match.lastgroup)
+            label, weight = self._groups[endpoint][match.lastgroup]
+            scores[label] = scores.get(label, 0.0) + weight
+        if not scores:
+            return None
+
+        # Ties go to the intent listed first in the table
+        label = max(scores, key=lambda label: (scores[label], -self._order[(endpoint, label)]))
+        intent = self._intents[(endpoint, label)]
+        return IntentMatch(label, round(scores[label] / sum(scores.values()), 3), intent.faq)
+
+    def observe(self, endpoint: str, message: str) -> Optional[IntentMatch]:
+        """``classify`` and count the match; called once per request"""
+        match = self.classify(endpoint, message)
+        if match is not None:
+            with self._lock:
+                self._matches[f"{endpoint}.{match.label}"] = self._matches.get(f"{endpoint}.{match.label}", 0) + 1
+        return match
+
+    def reply(self, endpoint: str, label: Optional[str], fields: Dict[str, Any]) -> str:
+        """Render the reply template of ``label`` (or the endpoint default) for ``fields``"""
+        intent = self._intents.get((endpoint, label or "default")) or self._intents[(endpoint, "default")]
+        for required, template in intent.replies:
+            if all(fields.get(name) not in (None, "") for name in required):
+                return template.format(**fields)
+        return ""
+
+    def preroute(
+        self,
+        endpoint: str,
+        message: str,
+        fields: Dict[str, Any],
+        min_score: float,
+        match: Optional[IntentMatch] = None
+    ) -> Optional[str]:
+        """Template answer for a confident FAQ intent, or None when the model should answer
+
+        ``match`` is the message's classification when the caller already has it.
+        """
+        match = match or self.classify(endpoint, message)
+        if match is None or not match.faq or match.score < min_score:
+            return None
+        if NEGATION.search(message.lower().replace("\u2019", "'")):
+            return None
+        with self._lock:
+            self._prerouted += 1
+        logger.debug(f"Pre-routed {endpoint} message to intent {match.label} ({match.score})")
+        return self.reply(endpoint, match.label, fields)
+
+    def stats(self) -> Dict[str, Any]:
+        """Classifier counters for health reporting"""
+        with self._lock:
+            return {
+                "intents": len(self._intents),
+                "matches": dict(self._matches),
+                "prerouted": self._prerouted,
+            }
@@ -0,0 +1,155 @@
+"""Adaptive load shedding for the inference pool.
+
+Under saturation every request used to wait for the model even though a
+template fallback answers in microseconds. ``LoadController`` turns the
+signals the service already measures (queue wait of recent generations,
+their prefill+decode latency and the current inference queue depth) into one
+pressure number, where 1.0 means "at target". Rising pressure degrades
+service in steps:
+
+1. ``reduce_tokens``: ``max_new_tokens`` is scaled down by 1/pressure (never
+   below ``min_token_scale``).
+2. ``low_value_fallback``: low-value intents such as greetings and thanks get
+   the template fallback without queueing for the model.
+3. ``shed_website_helper``: the website helper is answered from its fallback
+   so the pool is left to seller chat. Chat itself is never shed here; it is
+   still bounded by the pool's admission queue.
+
+Latency signals are exponentially weighted and decay with a half-life once
+samples stop, so the controller recovers after a burst without needing new
+requests to prove the load is gone.
+"""
+import logging
+import threading
+import time
+from typing import Any, Callable, Dict, NamedTuple, Sequence
+
+logger = logging.getLogger(__name__)
+
+LEVELS = ("normal", "reduce_tokens", "low_value_fallback", "shed_website_helper")
+
+
+class LoadThresholds(NamedTuple):
+    """Targets and the pressure at which each degradation step starts"""
+    queue_wait: float = 0.5  # seconds
+    latency: float = 4.0  # seconds of prefill + decode
+    queue_depth: int = 8  # jobs waiting for a worker
+    reduce_tokens_at: float = 1.0
+    low_value_at: float = 1.5
+    shed_website_helper_at: float = 2.0
+    min_token_scale: float = 0.5
+
+
+class _DecayingAverage:
+    """Exponentially weighted average that halves every ``half_life`` seconds without samples"""
+
+    def __init__(self, alpha: float, half_life: float):
+        self.alpha = alpha
+        self.half_life = half_life
+        self._value = 0.0
+        self._updated = time.monotonic()
+
+    def value(self, now: float) -> float:
+        if self.half_life <= 0:
+            return self._value
+        return self._value * 0.5 ** ((now - self._updated) / self.half_life)
+
+    def add(self, sample: float, now: float):
+        current = self.value(now)
+        self._value = current + self.alpha * (sample - current)
+        self._updated = now
+
+
+class LoadController:
+    """Decides per request and per generate call how far to degrade service"""
+
+    def __init__(
+        self,
+        depth: Callable[[], int],
+        thresholds: LoadThresholds = LoadThresholds(),
+        low_value_intents: Sequence[str] = ("greeting", "thanks"),
+        half_life: float = 5.0,
+        enabled: bool = True
+    ):
+        self.depth = depth
+        self.thresholds = thresholds
+        self.low_value_intents = frozenset(low_value_intents)
+        self.enabled = enabled
+        self._lock = threading.Lock()
+        self._queue_wait = _DecayingAverage(0.3, half_life)
+        self._latency = _DecayingAverage(0.3, half_life)
+        self._decisions: Dict[str, int] = {}
+
+    def observe(self, queue_seconds: float, generation_seconds: float):
+        """Feed one finished generation's queue wait and prefill+decode time"""
+        now = time.monotonic()
+        with self._lock:
+            self._queue_wait.add(queue_seconds, now)
+            self._latency.add(generation_seconds, now)
+
+    def pressure(self) -> float:
+        """Load relative to the targets; 1.0 is the point where degradation starts by default"""
+        now = time.monotonic()
+        thresholds = self.thresholds
+        with self._lock:
+            queue_wait = self._queue_wait.value(now)
+            latency = self._latency.value(now)
+        return max(
+            queue_wait / thresholds.queue_wait if thresholds.queue_wait > 0 else 0.0,
+            latency / thresholds.latency if thresholds.latency > 0 else 0.0,
+            self.depth() / thresholds.queue_depth if thresholds.queue_depth > 0 else 0.0,
+        )
+
+    def level(self) -> int:
+        """Index into ``LEVELS`` for the current pressure"""
+        if not self.enabled:
+            return 0
+        pressure = self.pressure()
+        thresholds = self.thresholds
+        starts = (thresholds.reduce_tokens_at, thresholds.low_value_at, thresholds.shed_website_helper_at)
+        return sum(1 for start in starts if pressure >= start)
+
+    def max_new_tokens(self, base: int) -> int:
+        """Token limit for the next generate call; below ``base`` only under pressure"""
+        if self.level() < 1:
+            return base
+        scale = max(self.thresholds.min_token_scale, min(1.0, 1.0 / self.pressure()))
+        limit = max(1, int(base * scale))
+        if limit < base:
+            self._record("reduce_tokens")
+        return limit
+
+    def shed(self, endpoint: str, intent: Callable[[], Any]) -> str:
+        """Degradation step that answers this request from the fallback, or "" to use the model
+
+        ``intent`` is only called (to classify the message) once low-value
+        intents are being shed.
+        """
+        level = self.level()
+        if level >= 3 and endpoint == "website_helper":
+            self._record("shed_website_helper")
+            return "shed_website_helper"
+        if level >= 2 and intent() in self.low_value_intents:
+            self._record("low_value_fallback")
+            return "low_value_fallback"
+        return ""
+
+    def _record(self, action: str):
+        with self._lock:
+            self._decisions[action] = self._decisions.get(action, 0) + 1
+
+    def stats(self) -> Dict[str, Any]:
+        """Load signals and degradation counters for health reporting"""
+        now = time.monotonic()
+        pressure = self.pressure()
+        level = self.level()
+        with self._lock:
+            return {
+                "enabled": self.enabled,
+                "pressure": round(pressure, 3),
+                "level": level,
+                "level_name": LEVELS[level],
+                "queue_wait_ms": round(self._queue_wait.value(now) * 1000.0, 1),
+                "generation_ms": round(self._latency.value(now) * 1000.0, 1),
+                "decisions": dict(self._decisions),
+            }
@@ -0,0 +1,318 @@
+"""Prometheus metrics and per-request stage timings.
+
+A small in-process registry of counters, gauges and histograms rendered in
+the Prometheus text exposition format for ``/metrics``; the service has no
+other use for ``prometheus_client``. Gauges can be backed by a callback so
+queue depth, model state and the existing ``stats()`` dicts are read at
+scrape time. Every worker process keeps its own registry.
+
+Stage durations (tokenization, prefill, decode, detokenization,
+post-processing, ...) go into one histogram labelled by endpoint and stage. The
+same durations are collected per request in a ``RequestTimings`` held in a
+context variable, which the HTTP middleware turns into a ``Server-Timing``
+header when the client asks for it.
+"""
+import math
+import threading
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Any, Callable, Dict, Iterator, List, Optional, Sequence, Tuple
+
+LATENCY_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+TOKEN_BUCKETS = (1, 2, 4, 8, 16, 32, 64, 128, 256)
+THROUGHPUT_BUCKETS = (5, 10, 20, 50, 100, 200, 500, 1000)
+
+
+def _format_value(value: float) -> str:
+    if math.isinf(value):
+        return "+Inf" if value > 0 else "-Inf"
+    return repr(float(value)) if not float(value).is_integer() else str(int(value))
+
+
+def _format_labels(names: Sequence[str], values: Sequence[str]) -> str:
+    if not names:
+        return ""
+    escaped = (str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"') for value in values)
+    return "{" + ",".join(f'{name}="{value}"' for name, value in zip(names, escaped)) + "}"
+
+
+class _Metric:
+    kind = "untyped"
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._lock = threading.Lock()
+
+    def _key(self, labels: Dict[str, Any]) -> Tuple[str, ...]:
+        if set(labels) != set(self.labelnames):
+            raise ValueError(f"{self.name} expects labels {self.labelnames}, got {tuple(labels)}")
+        return tuple(str(labels[name]) for name in self.labelnames)
+
+    def samples(self) -> List[Tuple[str, str, float]]:
+        raise NotImplementedError
+
+    def render(self) -> str:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}"]
+        lines.extend(f"{name}{labels} {_format_value(value)}" for name, labels, value in self.samples())
+        return "\n".join(lines)
+
+
+class Counter(_Metric):
+    """Monotonic counter"""
+    kind = "counter"
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = ()):
+        super().__init__(name, documentation, labelnames)
+        self._values: Dict[Tuple[str, ...], float] = {}
+
+    def inc(self, amount: float = 1.0, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0.0) + amount
+
+    def value(self, **labels) -> float:
+        with self._lock:
+            return self._values.get(self._key(labels), 0.0)
+
+    def samples(self) -> List[Tuple[str, str, float]]:
+        with self._lock:
+            return [
+                (self.name, _format_labels(self.labelnames, key), value)
+                for key, value in sorted(self._values.items())
+            ]
+
+
+class Gauge(_Metric):
+    """Gauge set directly or read from ``collect`` at scrape time
+
+    ``collect`` returns a single value, or a dict of label value tuples to
+    values for labelled gauges.
+    """
+    kind = "gauge"
+
+    def __init__(
+        self,
+        name: str,
+        documentation: str,
+        labelnames: Sequence[str] = (),
+        collect: Optional[Callable[[], Any]] = None
+    ):
+        super().__init__(name, documentation, labelnames)
+        self.collect = collect
+        self._values: Dict[Tuple[str, ...], float] = {}
+
+    def set(self, value: float, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = float(value)
+
+    def samples(self) -> List[Tuple[str, str, float]]:
+        if self.collect is not None:
+            collected = self.collect()
+            values = collected if isinstance(collected, dict) else {(): collected}
+        else:
+            with self._lock:
+                values = dict(self._values)
+        return [
+            (self.name, _format_labels(self.labelnames, key), float(value))
+            for key, value in sorted(values.items())
+        ]
+
+
+class Histogram(_Metric):
+    """Cumulative-bucket histogram"""
+    kind = "histogram"
+
+    def __init__(
+        self,
+        name: str,
+        documentation: str,
+        labelnames: Sequence[str] = (),
+        buckets: Sequence[float] = LATENCY_BUCKETS
+    ):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets)) + (math.inf,)
+        # label values -> [per-bucket counts, sum, count]
+        self._values: Dict[Tuple[str, ...], List[Any]] = {}
+
+    def observe(self, value: float, **labels):
+        key = self._key(labels)
+        with self._lock:
+            state = self._values.setdefault(key, [[0] * len(self.buckets), 0.0, 0])
+            for index, bound in enumerate(self.buckets):
+                if value <= bound:
+                    state[0][index] += 1
+                    break
+            state[1] += value
+            state[2] += 1
+
+    def samples(self) -> List[Tuple[str, str, float]]:
+        samples = []
+        names = self.labelnames + ("le",)
+        with self._lock:
+            for key, (counts, total, count) in sorted(self._values.items()):
+                cumulative = 0
+                for bound, bucket_count in zip(self.buckets, counts):
+                    cumulative += bucket_count
+                    samples.append((f"{self.name}_bucket", _format_labels(names, key + (_format_value(bound),)), cumulative))
+                labels = _format_labels(self.labelnames, key)
+                samples.append((f"{self.name}_sum", labels, total))
+                samples.append((f"{self.name}_count", labels, count))
+        return samples
+
+
+class StatsCollector:
+    """Exposes the numeric fields of a ``stats()`` dict as gauges named ``<prefix>_<field>``
+
+    One level of nested dicts becomes a ``key`` label, e.g. intent match
+    counts per label.
+    """
+
+    def __init__(self, prefix: str, stats: Callable[[], Dict[str, Any]], documentation: str):
+        self.prefix = prefix
+        self.stats = stats
+        self.documentation = documentation
+
+    def render(self) -> str:
+        lines = []
+        for field, value in self.stats().items():
+            name = f"{self.prefix}_{field}"
+            if isinstance(value, dict):
+                samples = [
+                    (_format_labels(("key",), (key,)), item) for key, item in sorted(value.items())
+                    if isinstance(item, (int, float))
+                ]
+            elif isinstance(value, (int, float)):
+                samples = [("", value)]
+            else:
+                continue
+            if samples:
+                lines.append(f"# HELP {name} {self.documentation}: {field}")
+                lines.append(f"# TYPE {name} gauge")
+                lines.extend(f"{name}{labels} {_format_value(float(item))}" for labels, item in samples)
+        return "\n".join(lines)
+
+
+class MetricsRegistry:
+    """Ordered collection of metrics rendered together for a scrape"""
+
+    def __init__(self):
+        self._metrics: Dict[str, Any] = {}
+        self._lock = threading.Lock()
+
+    def register(self, metric):
+        with self._lock:
+            name = getattr(metric, "name", None) or getattr(metric, "prefix")
+            if name in self._metrics:
+                raise ValueError(f"Metric {name} is already registered")
+            self._metrics[name] = metric
+        return metric
+
+    def counter(self, name: str, documentation: str, labelnames: Sequence[str] = ()) -> Counter:
+        return self.register(Counter(name, documentation, labelnames))
+
+    def gauge(
+        self,
+        name: str,
+        documentation: str,
+        labelnames: Sequence[str] = (),
+        collect: Optional[Callable[[], Any]] = None
+    ) -> Gauge:
+        return self.register(Gauge(name, documentation, labelnames, collect))
+
+    def histogram(
+        self,
+        name: str,
+        documentation: str,
+        labelnames: Sequence[str] = (),
+        buckets: Sequence[float] = LATENCY_BUCKETS
+    ) -> Histogram:
+        return self.register(Histogram(name, documentation, labelnames, buckets))
+
+    def stats(self, prefix: str, stats: Callable[[], Dict[str, Any]], documentation: str) -> StatsCollector:
+        return self.register(StatsCollector(prefix, stats, documentation))
+
+    def render(self) -> str:
+        with self._lock:
+            metrics = list(self._metrics.values())
+        blocks = [metric.render() for metric in metrics]
+        return "\n".join(block for block in blocks if block) + "\n"
+
+
+REGISTRY = MetricsRegistry()
+
+REQUEST_SECONDS = REGISTRY.histogram(
+    "ai_request_duration_seconds", "Time from request to response headers", ("path",)
+)
+STAGE_SECONDS = REGISTRY.histogram(
+    "ai_stage_duration_seconds", "Time spent in each request processing stage", ("endpoint", "stage")
+)
+GENERATED_TOKENS = REGISTRY.histogram(
+    "ai_generated_tokens", "Tokens generated per reply", ("endpoint",), buckets=TOKEN_BUCKETS
+)
+TOKENS_PER_SECOND = REGISTRY.histogram(
+    "ai_generation_tokens_per_second", "Generated tokens per second of each generate() call",
+    ("endpoint",), buckets=THROUGHPUT_BUCKETS
+)
+RESPONSES = REGISTRY.counter(
+    "ai_responses_total", "Replies by source (model, cache, coalesced, preroute, fallback, rejected)", ("endpoint", "source")
+)
+FALLBACKS = REGISTRY.counter(
+    "ai_fallbacks_total", "Fallback replies by reason", ("endpoint", "reason")
+)
+DRAFT_TOKENS = REGISTRY.counter(
+    "ai_draft_tokens_total", "Speculative decoding draft tokens by outcome (accepted, rejected)", ("endpoint", "outcome")
+)
+DEGRADATIONS = REGISTRY.counter(
+    "ai_degradations_total", "Load-shedding decisions by action (reduce_tokens, low_value_fallback, shed_website_helper)",
+    ("endpoint", "action")
+)
+
+
+class RequestTimings:
+    """Stage durations of one HTTP request"""
+
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.stages: Dict[str, float] = {}
+
+    def add(self, stage: str, seconds: float):
+        self.stages[stage] = self.stages.get(stage, 0.0) + seconds
+
+    def server_timing(self) -> str:
+        """``Server-Timing`` header value in milliseconds, ending with the total"""
+        entries = [f"{stage};dur={seconds * 1000:.1f}" for stage, seconds in self.stages.items()]
+        entries.append(f"total;dur={(time.perf_counter() - self.started) * 1000:.1f}")
+        return ", ".join(entries)
+
+
+_request_timings: ContextVar[Optional[RequestTimings]] = ContextVar("request_timings", default=None)
+
+
+def begin_request() -> RequestTimings:
+    """Start collecting stage timings for the request handled in this context"""
+    timings = RequestTimings()
+    _request_timings.set(timings)
+    return timings
+
+
+def record_stage(endpoint: str, stage: str, seconds: float, observe: bool = True):
+    """Add a stage duration to the current request and, unless already observed, the histogram"""
+    if observe:
+        STAGE_SECONDS.observe(seconds, endpoint=endpoint, stage=stage)
+    timings = _request_timings.get()
+    if timings is not None:
+        timings.add(stage, seconds)
+
+
+@contextmanager
+def stage_timer(endpoint: str, stage: str) -> Iterator[None]:
+    """Time the enclosed block as ``stage`` of ``endpoint``"""
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        record_stage(endpoint, stage, time.perf_counter() - started)
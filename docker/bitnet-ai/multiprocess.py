@@ -0,0 +1,102 @@
+"""Multi-process serving helpers.
+
+Running several uvicorn workers normally means every process holds a private
+copy of the weights. Instead, each worker maps the prepared safetensors
+bundle copy-on-write and points the model parameters straight at the
+mapping, so all workers share one set of physical pages through the page
+cache. Intra-op thread counts are split between the workers so they do not
+oversubscribe the container's CPUs.
+"""
+import json
+import logging
+import os
+import struct
+from typing import Any, Dict
+
+import numpy as np
+import torch
+
+logger = logging.getLogger(__name__)
+
+# safetensors dtype -> (numpy storage dtype, torch dtype)
+_SAFETENSORS_DTYPES = {
+    "F32": (np.float32, torch.float32),
+    "F16": (np.float16, torch.float16),
+    "BF16": (np.int16, torch.bfloat16),
+    "I64": (np.int64, torch.int64),
+}
+
+
+def available_cpus() -> int:
+    """CPUs this container may use, honouring cgroup quotas and CPU affinity"""
+    cpus = len(os.sched_getaffinity(0)) if hasattr(os, "sched_getaffinity") else (os.cpu_count() or 1)
+    try:
+        # cgroup v2: "<quota> <period>" or "max <period>"
+        with open("/sys/fs/cgroup/cpu.max") as f:
+            quota, period = f.read().split()
+        if quota != "max":
+            cpus = min(cpus, max(1, int(int(quota) / int(period))))
+    except (OSError, ValueError):
+        pass
+    return max(1, cpus)
+
+
+def configure_threads(server_workers: int, inference_workers: int) -> int:
+    """Give each inference thread of each process an equal share of the CPUs"""
+    threads = max(1, available_cpus() // max(1, server_workers * inference_workers))
+    torch.set_num_threads(threads)
+    try:
+        torch.set_num_interop_threads(1)
+    except RuntimeError:
+        # Can only be set before the first parallel op; keep the default in that case
+        pass
+    return threads
+
+
+def mmap_safetensors(path: str) -> Dict[str, torch.Tensor]:
+    """Map every tensor of a safetensors file copy-on-write, without reading it into memory"""
+    with open(path, "rb") as f:
+        header_size = struct.unpack("<Q", f.read(8))[0]
+        header = json.loads(f.read(header_size))
+    data_start = 8 + header_size
+
+    tensors = {}
+    for name, info in header.items():
+        if name == "__metadata__":
+            continue
+        np_dtype, torch_dtype = _SAFETENSORS_DTYPES[info["dtype"]]
+        begin, end = info["data_offsets"]
+        count = (end - begin) // np.dtype(np_dtype).itemsize
+        array = np.memmap(path, dtype=np_dtype, mode="c", offset=data_start + begin, shape=(count,))
+        tensor = torch.from_numpy(array).view(torch_dtype).reshape(info["shape"])
+        tensors[name] = tensor
+    return tensors
+
+
+def share_weights(model, bundle_dir: str) -> int:
+    """Point ``model``'s parameters at the mapped bundle; returns the number of mapped bytes"""
+    path = os.path.join(bundle_dir, "model.safetensors")
+    state = mmap_safetensors(path)
+    model_dtype = next(model.parameters()).dtype
+    state = {name: tensor for name, tensor in state.items() if tensor.dtype == model_dtype}
+    missing, unexpected = model.load_state_dict(state, strict=False, assign=True)
+    # Tied embeddings (lm_head) are not stored separately; re-tie to the mapped tensor
+    model.tie_weights()
+    if unexpected:
+        logger.warning(f"Ignoring unexpected tensors in bundle: {unexpected}")
+    unmapped = [name for name in missing if not name.endswith("lm_head.weight")]
+    if unmapped:
+        logger.warning(f"Tensors not found in bundle, kept private: {unmapped}")
+    return sum(tensor.numel() * tensor.element_size() for tensor in state.values())
+
+
+def worker_layout(server_workers: int, inference_workers: int, shared_bytes: int) -> Dict[str, Any]:
+    """Describe this worker process for /health"""
+    return {
+        "pid": os.getpid(),
+        "server_workers": server_workers,
+        "inference_workers": inference_workers,
+        "cpus": available_cpus(),
+        "torch_threads": torch.get_num_threads(),
+        "shared_weights_mb": round(shared_bytes / (1024 * 1024), 1),
+    }
@@ -0,0 +1,180 @@
+"""Table-driven reply post-processing and validation.
+
+Each endpoint has one ``ReplyFormat`` row in ``REPLY_FORMATS`` describing
+how a generated reply is cleaned and when it is rejected. ``PostProcessor``
+compiles every row once into a few regexes and applies them in order:
+- cut at the first leaked role marker;
+- strip tokenizer artifacts and collapse whitespace;
+- segment sentences, closing a long enough unfinished last sentence;
+- cap the length on a word boundary;
+- validate the result: minimum length, banned phrases and the share of
+  distinct words.
+It takes a whole batch of replies at once, so the generation worker cleans
+a batch right after decoding it.
+
+The same rows also build the ``ReplyRules`` that stop generation early, so
+the stop rules and the cleaner cannot drift apart.
+"""
+import logging
+import re
+import threading
+from typing import Any, Dict, List, NamedTuple, Sequence, Tuple
+
+from stopping import ReplyRules
+
+logger = logging.getLogger(__name__)
+
+
+class ReplyFormat(NamedTuple):
+    """Cleaning and validation rules of one endpoint"""
+    max_sentences: int
+    sentence_end: str = ".!?"
+    # An unfinished last sentence longer than this is kept and closed with "."
+    min_fragment_chars: int = 0
+    max_chars: int = 200
+    # A leaked conversation turn ends the reply where its marker appears (case-insensitive)
+    role_markers: Tuple[str, ...] = ()
+    # Tokenizer/format artifacts removed wherever they appear
+    artifacts: Tuple[str, ...] = ()
+    min_chars: int = 1
+    # Lowercase phrases that make a reply unusable (off-topic or model self-talk)
+    banned_phrases: Tuple[str, ...] = ()
+    # Replies of more than ``repetition_min_words`` words need this share of distinct words
+    min_unique_ratio: float = 0.0
+    repetition_min_words: int = 0
+
+    def stopping_rules(self) -> ReplyRules:
+        """Early-stop rules that end generation where this format would cut the reply"""
+        return ReplyRules(self.max_sentences, self.max_chars, self.role_markers, self.sentence_end)
+
+
+class Processed(NamedTuple):
+    """A cleaned reply and, when it failed validation, the rule it broke"""
+    text: str
+    valid: bool
+    reason: str = ""
+
+
+REPLY_FORMATS: Dict[str, ReplyFormat] = {
+    "chat": ReplyFormat(
+        max_sentences=2,
+        min_fragment_chars=10,
+        max_chars=200,
+        role_markers=("Customer:", "User:", "Human:", "Assistant:"),
+        artifacts=("<|endoftext|>", "<|end|>", "<|im_end|>"),
+        min_chars=5,
+        banned_phrases=(
+            "i am an ai", "i am a language model", "i cannot", "i'm sorry but",
+            "as an ai", "i don't have access", "i can't browse", "i'm not able to",
+            "my knowledge cutoff", "training data", "openai", "chatgpt",
+        ),
+        min_unique_ratio=0.6,
+        repetition_min_words=3,
+    ),
+    "website_helper": ReplyFormat(
+        max_sentences=1,
+        sentence_end=".",
+        max_chars=200,
+        role_markers=("User:", "Assistant:", "Question:", "Answer:"),
+        artifacts=("<|endoftext|>", "<|end|>", "<|im_end|>"),
+        min_chars=3,
+        banned_phrases=(
+            "i am an ai", "language model", "i cannot", "i don't know",
+            "training data", "as an ai",
+        ),
+        min_unique_ratio=0.5,
+        repetition_min_words=10,
+    ),
+}
+
+
+def _alternation(phrases: Sequence[str]) -> str:
+    # Longest first so a phrase never loses to one of its own prefixes
+    return "|".join(re.escape(phrase) for phrase in sorted(phrases, key=len, reverse=True))
+
+
+class _CompiledFormat:
+    def __init__(self, reply_format: ReplyFormat):
+        self.format = reply_format
+        never = r"(?!x)x"
+        self.role = re.compile(_alternation(reply_format.role_markers) or never, re.IGNORECASE)
+        # An artifact and the whitespace around it collapse into one space, like a whitespace run
+        self.noise = re.compile(
+            rf"(?:\s*(?:{_alternation(reply_format.artifacts)}))+\s*|\s+" if reply_format.artifacts else r"\s+"
+        )
+        end = re.escape(reply_format.sentence_end)
+        # A terminator followed by a digit is a decimal point ("$599.99") inside the sentence
+        self.sentence = re.compile(rf"(?:[^{end}]|[{end}](?=\d))*[{end}](?!\d)")
+        self.banned = re.compile(_alternation(reply_format.banned_phrases) or never)
+
+    def clean(self, text: str) -> str:
+        reply_format = self.format
+        leak = self.role.search(text)
+        if leak:
+            text = text[:leak.start()]
+        text = self.noise.sub(" ", text).strip()
+        if not text:
+            return ""
+
+        sentences, end = [], 0
+        for match in self.sentence.finditer(text):
+            sentences.append(match.group().strip())
+            end = match.end()
+            if len(sentences) >= reply_format.max_sentences:
+                break
+        else:
+            fragment = text[end:].strip()
+            if len(fragment) > reply_format.min_fragment_chars:
+                sentences.append(fragment if fragment.endswith((".", "!", "?")) else fragment + ".")
+        text = " ".join(sentence for sentence in sentences if sentence)
+
+        if len(text) > reply_format.max_chars:
+            text = text[:reply_format.max_chars].rsplit(" ", 1)[0] + "."
+        return text
+
+    def validate(self, text: str) -> str:
+        reply_format = self.format
+        if len(text) < reply_format.min_chars:
+            return "too_short"
+        lowered = text.lower()
+        if self.banned.search(lowered):
+            return "banned_phrase"
+        words = lowered.split()
+        if len(words) > reply_format.repetition_min_words and len(set(words)) / len(words) < reply_format.min_unique_ratio:
+            return "repetitive"
+        return ""
+
+
+class PostProcessor:
+    """Cleans and validates batches of generated replies with the compiled format table"""
+
+    def __init__(self, formats: Dict[str, ReplyFormat] = REPLY_FORMATS):
+        self._formats = {endpoint: _CompiledFormat(reply_format) for endpoint, reply_format in formats.items()}
+        self._lock = threading.Lock()
+        self.processed = 0
+        self._rejected: Dict[str, int] = {}
+
+    def process(self, endpoint: str, replies: Sequence[str]) -> List[Processed]:
+        """Clean and validate ``replies`` of ``endpoint``, one result per reply in order"""
+        compiled = self._formats[endpoint]
+        results = []
+        for reply in replies:
+            text = compiled.clean(reply or "")
+            reason = compiled.validate(text)
+            results.append(Processed(text, not reason, reason))
+
+        with self._lock:
+            self.processed += len(results)
+            for result in results:
+                if result.reason:
+                    key = f"{endpoint}.{result.reason}"
+                    self._rejected[key] = self._rejected.get(key, 0) + 1
+        return results
+
+    def stats(self) -> Dict[str, Any]:
+        """Post-processing counters for health reporting"""
+        with self._lock:
+            return {
+                "processed": self.processed,
+                "rejected": dict(self._rejected),
+            }
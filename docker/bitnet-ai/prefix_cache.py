@@ -0,0 +1,144 @@
+"""Shared-prefix KV cache for the fixed system prompts.
+
+Every /chat prompt starts with the same STRICT GUIDELINES block (only the
+seller name changes) and every /website-helper prompt starts with the same
+Rules block. Their key/value states are computed once per prefix, kept in a
+small LRU and stitched in front of each batch, so a request only prefills its
+own product context and message. A conversation session's earlier turns are
+stitched in the same way from a ``CachedPrefix`` snapshot.
+"""
+import logging
+import threading
+from collections import OrderedDict
+from typing import Any, Dict, Hashable, List, NamedTuple, Sequence, Tuple
+
+import torch
+from transformers import DynamicCache
+
+logger = logging.getLogger(__name__)
+
+# Per-layer (key, value) tensors shaped [1, kv_heads, prefix_len, head_dim]
+LayerStates = List[Tuple[torch.Tensor, torch.Tensor]]
+
+
+class CachedPrefix(NamedTuple):
+    """Token ids of a prompt start and the key/value states an earlier request computed for them"""
+    ids: List[int]
+    states: LayerStates
+
+
+def _cache_layers(past_key_values) -> LayerStates:
+    """Extract per-layer (key, value) pairs from any cache representation"""
+    return [(layer[0].detach(), layer[1].detach()) for layer in past_key_values]
+
+
+def _to_dynamic_cache(layers: LayerStates) -> DynamicCache:
+    """Build a DynamicCache across transformers versions"""
+    if hasattr(DynamicCache, "from_legacy_cache"):
+        return DynamicCache.from_legacy_cache(tuple(layers))
+    return DynamicCache(layers)
+
+
+class PrefixKVCache:
+    """Bounded LRU of prefilled key/value states for static prompt prefixes"""
+
+    def __init__(self, max_entries: int = 16):
+        self.max_entries = max(0, max_entries)
+        self._entries: "OrderedDict[Hashable, Tuple[str, List[int], LayerStates]]" = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key: Hashable, text: str, model, tokenizer) -> Tuple[List[int], LayerStates]:
+        """Return the token ids and key/value states for ``text``, prefilling on a miss"""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[0] == text:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return entry[1], entry[2]
+            self.misses += 1
+
+        # Prefill outside the lock; a concurrent miss on the same key only costs a duplicate forward
+        ids = tokenizer(text)["input_ids"]
+        device = next(model.parameters()).device
+        with torch.no_grad():
+            outputs = model(input_ids=torch.tensor([ids], device=device), use_cache=True)
+        layers = _cache_layers(outputs.past_key_values)
+
+        with self._lock:
+            if self.max_entries:
+                self._entries[key] = (text, ids, layers)
+                self._entries.move_to_end(key)
+                while len(self._entries) > self.max_entries:
+                    self._entries.popitem(last=False)
+        return ids, layers
+
+    def clear(self):
+        """Drop all cached prefixes (e.g. after the model is replaced)"""
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self) -> Dict[str, Any]:
+        """Cache counters for health reporting"""
+        with self._lock:
+            return {
+                "entries": len(self._entries),
+                "max_entries": self.max_entries,
+                "hits": self.hits,
+                "misses": self.misses,
+            }
+
+
+def assemble_prefixed_batch(
+    prefixes: Sequence[Tuple[List[int], LayerStates]],
+    suffixes: Sequence[List[int]],
+    pad_token_id: int
+) -> Tuple[torch.Tensor, torch.Tensor, DynamicCache]:
+    """Lay out cached prefixes and fresh suffixes as one left-aligned batch
+
+    Each row becomes ``[pad..., prefix, pad..., suffix]`` so every prompt ends
+    in the same column. Prefix states are left-padded with zeros to a common
+    length; the attention mask hides every pad, and because position ids are
+    derived from the mask the cached states line up with what a full prefill
+    would have produced.
+    """
+    prefix_len = max(len(ids) for ids, _ in prefixes)
+    suffix_len = max(len(ids) for ids in suffixes)
+    device = prefixes[0][1][0][0].device
+
+    input_rows, mask_rows = [], []
+    for (prefix_ids, _), suffix_ids in zip(prefixes, suffixes):
+        prefix_pad = prefix_len - len(prefix_ids)
+        suffix_pad = suffix_len - len(suffix_ids)
+        input_rows.append([pad_token_id] * prefix_pad + prefix_ids + [pad_token_id] * suffix_pad + suffix_ids)
+        mask_rows.append([0] * prefix_pad + [1] * len(prefix_ids) + [0] * suffix_pad + [1] * len(suffix_ids))
+
+    layers = []
+    for layer_idx in range(len(prefixes[0][1])):
+        keys, values = [], []
+        for prefix_ids, states in prefixes:
+            key, value = states[layer_idx]
+            pad = prefix_len - key.shape[2]
+            # Always copy: generate() extends the cache and must not touch the stored states
+            keys.append(torch.nn.functional.pad(key, (0, 0, pad, 0)))
+            values.append(torch.nn.functional.pad(value, (0, 0, pad, 0)))
+        layers.append((torch.cat(keys, dim=0), torch.cat(values, dim=0)))
+
+    input_ids = torch.tensor(input_rows, dtype=torch.long, device=device)
+    attention_mask = torch.tensor(mask_rows, dtype=torch.long, device=device)
+    return input_ids, attention_mask, _to_dynamic_cache(layers)
+
+
+def snapshot_row(past_key_values, input_ids: torch.Tensor, attention_mask: torch.Tensor, row: int) -> CachedPrefix:
+    """Copy one batch row's prompt states out of a generate() cache, leaving out its pad columns
+
+    Position ids follow the attention mask, so the unpadded states are the ones
+    a contiguous prefill of the same ids would have produced.
+    """
+    positions = attention_mask[row].nonzero().flatten()
+    layers = [
+        (key[row:row + 1].index_select(2, positions), value[row:row + 1].index_select(2, positions))
+        for key, value in _cache_layers(past_key_values)
+    ]
+    return CachedPrefix(input_ids[row, positions].tolist(), layers)
@@ -0,0 +1,76 @@
+"""Prepare an offline SmolLM2 bundle for fast cold starts.
+
+Downloads the model once and writes a local bundle (single safetensors file,
+tokenizer files and a manifest) into the ``ai_cache`` volume. The service
+loads the bundle offline and memory-maps the weights instead of re-resolving
+and re-parsing them from the Hugging Face cache on every restart.
+
+Usage:
+    python prepare_model.py [--model HuggingFaceTB/SmolLM2-135M] [--output /app/cache/smollm2-135m]
+"""
+import argparse
+import json
+import logging
+import os
+import shutil
+import time
+
+import torch
+from transformers import AutoTokenizer, AutoModelForCausalLM
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_MODEL = "HuggingFaceTB/SmolLM2-135M"
+DEFAULT_BUNDLE_DIR = "/app/cache/smollm2-135m"
+MANIFEST = "bundle.json"
+
+
+def bundle_ready(bundle_dir: str) -> bool:
+    """A bundle is only usable once its manifest has been written"""
+    return os.path.isfile(os.path.join(bundle_dir, MANIFEST))
+
+
+def write_bundle(model, tokenizer, bundle_dir: str, model_name: str):
+    """Atomically write weights, tokenizer and manifest to ``bundle_dir``"""
+    staging_dir = f"{bundle_dir}.tmp-{os.getpid()}"
+    shutil.rmtree(staging_dir, ignore_errors=True)
+    os.makedirs(staging_dir)
+
+    # One safetensors shard so the whole checkpoint is a single mmap
+    model.save_pretrained(staging_dir, safe_serialization=True, max_shard_size="4GB")
+    tokenizer.save_pretrained(staging_dir)
+    with open(os.path.join(staging_dir, MANIFEST), "w") as f:
+        json.dump({
+            "model": model_name,
+            "dtype": str(model.dtype).replace("torch.", ""),
+            "created_at": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
+        }, f, indent=2)
+
+    shutil.rmtree(bundle_dir, ignore_errors=True)
+    os.replace(staging_dir, bundle_dir)
+    logger.info(f"Wrote model bundle for {model_name} to {bundle_dir}")
+
+
+def prepare(model_name: str, bundle_dir: str):
+    """Download ``model_name`` in float32 and write it as a local bundle"""
+    tokenizer = AutoTokenizer.from_pretrained(model_name)
+    model = AutoModelForCausalLM.from_pretrained(model_name, torch_dtype=torch.float32, trust_remote_code=True)
+    write_bundle(model, tokenizer, bundle_dir, model_name)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Prepare an offline SmolLM2 model bundle")
+    parser.add_argument("--model", default=os.getenv("MODEL_NAME", DEFAULT_MODEL))
+    parser.add_argument("--output", default=os.getenv("MODEL_BUNDLE_DIR", DEFAULT_BUNDLE_DIR))
+    parser.add_argument("--force", action="store_true", help="Rebuild the bundle even if one exists")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    if bundle_ready(args.output) and not args.force:
+        logger.info(f"Model bundle already present at {args.output}")
+        return
+    prepare(args.model, args.output)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,123 @@
+"""Token-budget prompt assembly.
+
+The per-request part of a prompt is described as a list of ``Segment``s:
+fixed text (labels, product facts, the answer cue) and variable fields that
+may be shortened (description, page content, the customer message). Fixed
+segments are tokenized once and kept in an LRU; only the variable fields are
+tokenized per request. When the prompt is over budget the variable fields
+are trimmed in token space, lowest priority first, and the final segment, the
+answer cue the model continues from, is always kept. Previously the prompt
+was truncated on the right, which cut the cue off long prompts.
+
+Segment boundaries sit before the separator of the following text (a space
+or newline), which is also where the byte-level tokenizer splits words, so
+the concatenated ids match tokenizing the whole prompt.
+"""
+import logging
+import threading
+from collections import OrderedDict
+from typing import Any, Dict, List, NamedTuple, Optional, Sequence
+
+logger = logging.getLogger(__name__)
+
+
+class Segment(NamedTuple):
+    """One piece of a prompt"""
+    text: str
+    # None keeps the segment whole; "head" keeps its beginning, "tail" its end
+    trim: Optional[str] = None
+    # Trimmable segments are shortened in ascending priority order
+    priority: int = 0
+    # Tokens a trimmed segment keeps at least (unless the cue itself does not fit)
+    min_tokens: int = 0
+
+
+def render(segments: Sequence[Segment]) -> str:
+    """The prompt text the segments stand for"""
+    return "".join(segment.text for segment in segments)
+
+
+class PromptBuilder:
+    """Builds prompt token ids from segments within a token budget"""
+
+    def __init__(self, max_static_entries: int = 1024):
+        self.max_static_entries = max(0, max_static_entries)
+        self._static: "OrderedDict[str, List[int]]" = OrderedDict()
+        self._lock = threading.Lock()
+        self.static_hits = 0
+        self.static_misses = 0
+        self.built = 0
+        self.trimmed = 0
+        self.trimmed_tokens = 0
+
+    def _encode_static(self, text: str, tokenizer) -> List[int]:
+        with self._lock:
+            ids = self._static.get(text)
+            if ids is not None:
+                self._static.move_to_end(text)
+                self.static_hits += 1
+                return ids
+            self.static_misses += 1
+
+        ids = tokenizer(text, add_special_tokens=False)["input_ids"]
+        with self._lock:
+            if self.max_static_entries:
+                self._static[text] = ids
+                while len(self._static) > self.max_static_entries:
+                    self._static.popitem(last=False)
+        return ids
+
+    def build(self, segments: Sequence[Segment], tokenizer, budget: int) -> List[int]:
+        """Token ids for ``segments``, trimming variable fields so at most ``budget`` ids remain"""
+        pieces = [
+            self._encode_static(segment.text, tokenizer) if segment.trim is None
+            else tokenizer(segment.text, add_special_tokens=False)["input_ids"]
+            for segment in segments
+        ]
+        budget = max(1, budget)
+        total = sum(len(piece) for piece in pieces)
+        overflow = total - budget
+
+        if overflow > 0:
+            trimmable = sorted(
+                (index for index, segment in enumerate(segments) if segment.trim is not None),
+                key=lambda index: segments[index].priority
+            )
+            for index in trimmable:
+                segment, piece = segments[index], pieces[index]
+                cut = min(overflow, max(0, len(piece) - segment.min_tokens))
+                if cut:
+                    pieces[index] = piece[cut:] if segment.trim == "tail" else piece[:len(piece) - cut]
+                    overflow -= cut
+                if overflow <= 0:
+                    break
+
+        ids = [token for piece in pieces[:-1] for token in piece]
+        if overflow > 0:
+            # Even the fixed text does not fit: drop from the front, never the cue
+            ids = ids[overflow:]
+        ids += pieces[-1][-budget:]
+
+        with self._lock:
+            self.built += 1
+            if len(ids) < total:
+                self.trimmed += 1
+                self.trimmed_tokens += total - len(ids)
+        return ids
+
+    def clear(self):
+        """Drop the cached static segments (e.g. after the tokenizer is replaced)"""
+        with self._lock:
+            self._static.clear()
+
+    def stats(self) -> Dict[str, Any]:
+        """Builder counters for health reporting"""
+        with self._lock:
+            return {
+                "static_entries": len(self._static),
+                "static_hits": self.static_hits,
+                "static_misses": self.static_misses,
+                "built": self.built,
+                "trimmed": self.trimmed,
+                "trimmed_tokens": self.trimmed_tokens,
+            }
@@ -0,0 +1,157 @@
+"""Response cache for repeated shopper questions.
+
+Generated replies are cached under a key built from the endpoint, the
+normalized message and the handful of prompt fields that change the answer
+(product name, price, stock status, ...). The in-process LRU enforces an
+entry count, a memory budget and a TTL; when a Redis URL is configured the
+entries are also shared with the other replicas through Redis.
+"""
+import hashlib
+import json
+import logging
+import re
+import sys
+import time
+from collections import OrderedDict
+from typing import Any, Dict, Optional, Tuple
+
+try:
+    import redis.asyncio as aioredis
+except ImportError:  # Redis backend is optional
+    aioredis = None
+
+logger = logging.getLogger(__name__)
+
+_WHITESPACE = re.compile(r"\s+")
+_EDGE_PUNCTUATION = re.compile(r"^[\s.,!?;:'\"]+|[\s.,!?;:'\"]+$")
+
+
+def normalize_message(message: str) -> str:
+    """Lowercase, collapse whitespace and drop surrounding punctuation"""
+    return _EDGE_PUNCTUATION.sub("", _WHITESPACE.sub(" ", message.lower()))
+
+
+def stock_status(product_info: Dict) -> Optional[str]:
+    """Reduce a stock count to the availability the prompt actually shows"""
+    stock = product_info.get("stock")
+    if stock is None:
+        return None
+    return "available" if stock > 0 else "out_of_stock"
+
+
+class ResponseCache:
+    """In-process LRU/TTL cache with an optional shared Redis tier"""
+
+    def __init__(
+        self,
+        max_entries: int = 1024,
+        max_bytes: int = 8 * 1024 * 1024,
+        ttl: float = 600.0,
+        redis_url: Optional[str] = None,
+        namespace: str = "smollm:response:"
+    ):
+        self.max_entries = max(0, max_entries)
+        self.max_bytes = max(0, max_bytes)
+        self.ttl = ttl
+        self.namespace = namespace
+        self._entries: "OrderedDict[str, Tuple[str, float, int]]" = OrderedDict()
+        self._bytes = 0
+        self.hits = 0
+        self.remote_hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.remote_errors = 0
+
+        self._redis = None
+        if redis_url:
+            if aioredis is None:
+                logger.warning("RESPONSE_CACHE_REDIS_URL is set but the redis package is not installed")
+            else:
+                self._redis = aioredis.from_url(redis_url, socket_timeout=0.05, socket_connect_timeout=0.2)
+
+    @staticmethod
+    def make_key(endpoint: str, message: str, **fields: Any) -> str:
+        """Stable key for an endpoint, normalized message and answer-relevant fields"""
+        payload = json.dumps([endpoint, normalize_message(message), fields], sort_keys=True, default=str)
+        return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+    async def get(self, key: str) -> Optional[str]:
+        """Return a cached response, checking the local tier before Redis"""
+        entry = self._entries.get(key)
+        if entry is not None:
+            value, expires_at, _ = entry
+            if expires_at > time.monotonic():
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return value
+            self._remove(key)
+
+        if self._redis is not None:
+            try:
+                value = await self._redis.get(self.namespace + key)
+            except Exception as e:
+                self.remote_errors += 1
+                logger.debug(f"Response cache Redis get failed: {e}")
+                value = None
+            if value is not None:
+                value = value.decode("utf-8") if isinstance(value, bytes) else value
+                self.remote_hits += 1
+                self._store(key, value)
+                return value
+
+        self.misses += 1
+        return None
+
+    async def set(self, key: str, value: str):
+        """Cache a response locally and, if configured, in Redis"""
+        self._store(key, value)
+        if self._redis is not None:
+            try:
+                await self._redis.set(self.namespace + key, value, ex=max(1, int(self.ttl)))
+            except Exception as e:
+                self.remote_errors += 1
+                logger.debug(f"Response cache Redis set failed: {e}")
+
+    def _store(self, key: str, value: str):
+        """Insert into the local LRU, evicting to stay within the count and memory limits"""
+        if not self.max_entries:
+            return
+        size = sys.getsizeof(key) + sys.getsizeof(value)
+        if size > self.max_bytes:
+            return
+        self._remove(key)
+        self._entries[key] = (value, time.monotonic() + self.ttl, size)
+        self._bytes += size
+        while len(self._entries) > self.max_entries or self._bytes > self.max_bytes:
+            oldest = next(iter(self._entries))
+            self._remove(oldest)
+            self.evictions += 1
+
+    def _remove(self, key: str):
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            self._bytes -= entry[2]
+
+    def stats(self) -> Dict[str, Any]:
+        """Cache counters for health reporting"""
+        lookups = self.hits + self.remote_hits + self.misses
+        return {
+            "entries": len(self._entries),
+            "bytes": self._bytes,
+            "max_entries": self.max_entries,
+            "max_bytes": self.max_bytes,
+            "hits": self.hits,
+            "remote_hits": self.remote_hits,
+            "misses": self.misses,
+            "hit_rate": round((self.hits + self.remote_hits) / lookups, 3) if lookups else 0.0,
+            "evictions": self.evictions,
+            "redis": self._redis is not None,
+            "remote_errors": self.remote_errors,
+        }
+
+    async def close(self):
+        """Close the Redis connection pool, if any"""
+        if self._redis is not None:
+            # redis-py 5 renamed close() to aclose()
+            close = getattr(self._redis, "aclose", None) or self._redis.close
+            await close()
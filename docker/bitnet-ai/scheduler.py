@@ -0,0 +1,153 @@
+"""Priority classes and weighted fair queuing in front of the inference pool.
+
+Every endpoint shares one model, so serving in arrival order lets a burst of
+website helper traffic, or one busy seller's storefront, push live chats to
+the back of the queue. ``FairScheduler`` picks what a free worker runs next:
+- each job belongs to a priority class (by default its endpoint). A waiting job
+  of a class with a lower priority number always goes first;
+- within a class, jobs are shared out over flows (the seller name) by weighted
+  fair queuing. A job's virtual finish time is
+  ``max(virtual time, flow's last finish) + cost / weight`` and the smallest
+  finish time runs next. A flow with twice the weight gets twice the share, and
+  a backlogged flow delays a newly active one by at most one job;
+- each class has a deadline. A job past its deadline is dropped when it reaches
+  the front of the queue instead of being generated.
+``FairQueue`` is the per-class queue. The micro-batcher also uses it on its own
+to fill each batch fairly across sellers.
+"""
+import heapq
+import itertools
+import logging
+import threading
+import time
+from typing import Any, Dict, Hashable, List, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+
+def parse_mapping(spec: str) -> Dict[str, float]:
+    """Parse "name:value,name:value" settings (e.g. SCHEDULER_SELLER_WEIGHTS) into a dict"""
+    mapping = {}
+    for part in spec.split(","):
+        name, _, value = part.rpartition(":")
+        if not name.strip():
+            continue
+        try:
+            mapping[name.strip()] = float(value)
+        except ValueError:
+            logger.warning(f"Ignoring scheduler setting {part.strip()!r}")
+    return mapping
+
+
+class FairQueue:
+    """Weighted fair queue over flows, served in order of virtual finish time
+
+    Not thread-safe; the owner holds its own lock.
+    """
+
+    def __init__(self, weights: Optional[Dict[Hashable, float]] = None, default_weight: float = 1.0):
+        self.weights = dict(weights or {})
+        self.default_weight = default_weight
+        self._heap: List[Tuple[float, int, float, Any]] = []
+        self._finish: Dict[Hashable, float] = {}
+        self._virtual = 0.0
+        self._order = itertools.count()
+
+    def __len__(self) -> int:
+        return len(self._heap)
+
+    def push(self, entry: Any, flow: Hashable, cost: float = 1.0):
+        """Queue ``entry`` behind the earlier entries of ``flow``"""
+        weight = max(self.weights.get(flow, self.default_weight), 1e-3)
+        start = max(self._virtual, self._finish.get(flow, 0.0))
+        finish = start + cost / weight
+        self._finish[flow] = finish
+        heapq.heappush(self._heap, (finish, next(self._order), start, entry))
+
+    def pop(self) -> Any:
+        """Remove and return the entry with the smallest virtual finish time"""
+        _, _, start, entry = heapq.heappop(self._heap)
+        # Virtual time follows the start tag of the entry being served (start-time fair queuing)
+        self._virtual = max(self._virtual, start)
+        if not self._heap:
+            # Every flow is idle, so none has a backlog to carry over
+            self._finish.clear()
+        elif len(self._finish) > 4 * len(self._heap) + 64:
+            # Flows whose last finish time has passed would start at virtual time anyway
+            self._finish = {flow: finish for flow, finish in self._finish.items() if finish > self._virtual}
+        return entry
+
+
+class FairScheduler:
+    """Strict-priority classes of fair queues, with per-class deadlines and queue counters"""
+
+    def __init__(
+        self,
+        priorities: Optional[Dict[str, float]] = None,
+        deadlines: Optional[Dict[str, float]] = None,
+        weights: Optional[Dict[Hashable, float]] = None,
+        default_deadline: float = 15.0
+    ):
+        self.priorities = dict(priorities or {})
+        self.deadlines = dict(deadlines or {})
+        self.weights = dict(weights or {})
+        self.default_deadline = default_deadline
+        self._queues: Dict[str, FairQueue] = {}
+        self._lock = threading.Lock()
+        self._dispatched: Dict[str, int] = {}
+        self._dropped: Dict[str, int] = {}
+        self._wait_seconds: Dict[str, float] = {}
+
+    def priority(self, name: str) -> float:
+        """Priority number of a class; classes without a setting go after every configured one"""
+        return self.priorities.get(name, max(self.priorities.values(), default=0) + 1)
+
+    def deadline(self, name: str) -> float:
+        """Seconds a job of class ``name`` may take from submission to result"""
+        return self.deadlines.get(name, self.default_deadline)
+
+    def fair_queue(self) -> FairQueue:
+        """Empty fair queue that uses the configured flow weights"""
+        return FairQueue(self.weights)
+
+    def push(self, entry: Any, name: str, flow: Hashable = "", cost: float = 1.0):
+        """Queue ``entry`` in class ``name`` under ``flow``"""
+        with self._lock:
+            if name not in self._queues:
+                self._queues[name] = self.fair_queue()
+            self._queues[name].push((time.monotonic(), entry), flow, cost)
+
+    def pop(self) -> Optional[Tuple[str, Any]]:
+        """Remove the next entry to run as ``(class, entry)``, or None when nothing waits"""
+        with self._lock:
+            waiting = [name for name, queue in self._queues.items() if queue]
+            if not waiting:
+                return None
+            name = min(waiting, key=self.priority)
+            enqueued, entry = self._queues[name].pop()
+            self._dispatched[name] = self._dispatched.get(name, 0) + 1
+            self._wait_seconds[name] = self._wait_seconds.get(name, 0.0) + time.monotonic() - enqueued
+            return name, entry
+
+    def record_drop(self, name: str, count: int = 1):
+        """Count work of class ``name`` dropped before generation because its deadline passed"""
+        with self._lock:
+            self._dropped[name] = self._dropped.get(name, 0) + count
+
+    def stats(self) -> Dict[str, Any]:
+        """Per-class queue counters for health reporting"""
+        with self._lock:
+            names = set(self.priorities) | set(self._queues)
+            return {
+                "priority": {name: self.priority(name) for name in names},
+                "queued": {name: len(self._queues.get(name, ())) for name in names},
+                "dispatched": {name: self._dispatched.get(name, 0) for name in names},
+                "dropped": {name: self._dropped.get(name, 0) for name in names},
+                "avg_wait_ms": {
+                    name: round(self._wait_seconds.get(name, 0.0) / self._dispatched[name] * 1000.0, 2)
+                    if self._dispatched.get(name) else 0.0
+                    for name in names
+                },
+                "deadline_seconds": {name: self.deadline(name) for name in names},
+                "seller_weights": len(self.weights),
+            }
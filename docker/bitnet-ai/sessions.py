@@ -0,0 +1,196 @@
+"""Server-side conversation sessions for multi-turn seller chat.
+
+A session is keyed by the chat id the caller passes in ``ChatRequest.context``.
+After a turn is generated the session keeps a snapshot of that turn's
+prompt: its token ids and the model's key/value states. The next turn is
+laid out as the snapshot followed by only the new text: the reply to the
+snapshot prompt, any turns answered without the model, then the new
+customer message. Only that text is prefilled. The snapshot goes through
+the same left-padded batch assembly as the shared system prefixes.
+
+Every session also keeps a compact text history of its recent turns. A
+turn is rebuilt from that history, with a fresh snapshot taken, when:
+- the snapshot was evicted,
+- it was over the per-session memory cap, or
+- it no longer leaves room for a new turn within the prompt budget.
+
+Sessions expire after a TTL, the least recently used ones are evicted past
+``max_sessions``, and snapshots are dropped (oldest first) when their total
+size passes ``max_total_bytes``.
+"""
+import logging
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Dict, Hashable, List, Optional, Tuple
+
+from prefix_cache import CachedPrefix
+
+logger = logging.getLogger(__name__)
+
+
+def kv_bytes_per_token(config, element_size: int = 4) -> int:
+    """Key/value memory one prompt token takes in a model with this config"""
+    heads = config.num_attention_heads
+    kv_heads = getattr(config, "num_key_value_heads", None) or heads
+    head_dim = getattr(config, "head_dim", None) or config.hidden_size // heads
+    return config.num_hidden_layers * 2 * kv_heads * head_dim * element_size
+
+
+def states_nbytes(prefix: CachedPrefix) -> int:
+    """Memory held by a snapshot's key/value tensors"""
+    return sum(key.numel() * key.element_size() + value.numel() * value.element_size() for key, value in prefix.states)
+
+
+class Session:
+    """One conversation: its KV snapshot, the text since the snapshot and recent turns"""
+
+    def __init__(self, fingerprint: Hashable):
+        self.fingerprint = fingerprint
+        self.snapshot: Optional[CachedPrefix] = None
+        self.snapshot_bytes = 0
+        # Text that follows the snapshot prompt (its reply and any turns answered without the model)
+        self.pending = ""
+        self.turns: List[Tuple[str, str]] = []
+        self.last_used = time.monotonic()
+
+
+class SessionStore:
+    """LRU/TTL store of conversation sessions with per-session and total KV memory caps"""
+
+    def __init__(
+        self,
+        max_sessions: int = 256,
+        ttl: float = 1800.0,
+        max_session_bytes: int = 16 * 1024 * 1024,
+        max_total_bytes: int = 256 * 1024 * 1024,
+        max_turns: int = 8
+    ):
+        self.max_sessions = max(0, max_sessions)
+        self.ttl = ttl
+        self.max_session_bytes = max_session_bytes
+        self.max_total_bytes = max_total_bytes
+        self.max_turns = max(1, max_turns)
+        self._sessions: "OrderedDict[str, Session]" = OrderedDict()
+        self._lock = threading.Lock()
+        self._total_bytes = 0
+        self.snapshot_hits = 0
+        self.rebuilds = 0
+        self.evictions = 0
+        self.expirations = 0
+        self.snapshots_dropped = 0
+
+    def get(self, chat_id: str, fingerprint: Hashable) -> Optional[Session]:
+        """The live session for ``chat_id``; a session for other seller/product facts is discarded"""
+        with self._lock:
+            session = self._sessions.get(chat_id)
+            if session is None:
+                return None
+            if time.monotonic() - session.last_used > self.ttl:
+                self._remove(chat_id)
+                self.expirations += 1
+                return None
+            if session.fingerprint != fingerprint:
+                self._remove(chat_id)
+                return None
+            self._sessions.move_to_end(chat_id)
+            session.last_used = time.monotonic()
+            return session
+
+    def record(
+        self,
+        chat_id: str,
+        fingerprint: Hashable,
+        message: str,
+        reply: str,
+        turn_text: str,
+        snapshot: Optional[CachedPrefix] = None,
+        lead: str = ""
+    ):
+        """Add a finished turn
+
+        ``turn_text`` is how the turn reads in a prompt after the previous
+        text. ``snapshot`` holds the states of this turn's prompt when the
+        model generated the reply; the pending text then restarts at the
+        reply, after the ``lead`` the snapshot prompt already ends with.
+        """
+        if not self.max_sessions:
+            return
+        with self._lock:
+            session = self._sessions.get(chat_id)
+            if session is None or session.fingerprint != fingerprint:
+                if session is not None:
+                    self._remove(chat_id)
+                session = self._sessions[chat_id] = Session(fingerprint)
+            self._sessions.move_to_end(chat_id)
+            session.last_used = time.monotonic()
+            session.turns = (session.turns + [(message, reply)])[-self.max_turns:]
+
+            if snapshot is not None:
+                self._drop_snapshot(session, count=False)
+                nbytes = states_nbytes(snapshot)
+                if nbytes <= self.max_session_bytes:
+                    session.snapshot, session.snapshot_bytes = snapshot, nbytes
+                    self._total_bytes += nbytes
+                else:
+                    self.snapshots_dropped += 1
+                session.pending = reply[len(lead):]
+            elif session.snapshot is not None:
+                session.pending += turn_text
+
+            self._enforce_limits()
+
+    def note_snapshot_hit(self):
+        with self._lock:
+            self.snapshot_hits += 1
+
+    def note_rebuild(self):
+        with self._lock:
+            self.rebuilds += 1
+
+    def _drop_snapshot(self, session: Session, count: bool = True):
+        if session.snapshot is not None:
+            self._total_bytes -= session.snapshot_bytes
+            session.snapshot, session.snapshot_bytes, session.pending = None, 0, ""
+            if count:
+                self.snapshots_dropped += 1
+
+    def _remove(self, chat_id: str):
+        session = self._sessions.pop(chat_id)
+        self._drop_snapshot(session, count=False)
+
+    def _enforce_limits(self):
+        now = time.monotonic()
+        for chat_id in [chat_id for chat_id, session in self._sessions.items() if now - session.last_used > self.ttl]:
+            self._remove(chat_id)
+            self.expirations += 1
+        while len(self._sessions) > self.max_sessions:
+            self._remove(next(iter(self._sessions)))
+            self.evictions += 1
+        # Over the memory budget the oldest sessions fall back to their text history
+        for session in self._sessions.values():
+            if self._total_bytes <= self.max_total_bytes:
+                break
+            self._drop_snapshot(session)
+
+    def clear(self):
+        """Drop every session (e.g. after the model is replaced)"""
+        with self._lock:
+            self._sessions.clear()
+            self._total_bytes = 0
+
+    def stats(self) -> Dict[str, Any]:
+        """Session counters for health reporting"""
+        with self._lock:
+            return {
+                "sessions": len(self._sessions),
+                "max_sessions": self.max_sessions,
+                "snapshots": sum(1 for session in self._sessions.values() if session.snapshot is not None),
+                "snapshot_bytes": self._total_bytes,
+                "max_snapshot_bytes": self.max_total_bytes,
+                "snapshot_hits": self.snapshot_hits,
+                "rebuilds": self.rebuilds,
+                "evictions": self.evictions,
+                "expirations": self.expirations,
+                "snapshots_dropped": self.snapshots_dropped,
+            }
@@ -0,0 +1,58 @@
+"""Single-flight coalescing of identical in-flight requests.
+
+When a product page gets busy, many customers send the same greeting or
+stock question at the same moment. The response cache only helps once the
+first answer is stored; until then every request would run its own
+``generate``. ``SingleFlight`` lets the first request for a key start the
+work and every identical request that arrives while it runs wait for the
+same result.
+"""
+import asyncio
+import logging
+from typing import Any, Awaitable, Callable, Dict, Hashable, Tuple
+
+logger = logging.getLogger(__name__)
+
+
+class SingleFlight:
+    """Shares one in-flight call per key between all concurrent callers"""
+
+    def __init__(self):
+        self._inflight: Dict[Hashable, asyncio.Future] = {}
+        self.calls = 0
+        self.coalesced = 0
+
+    async def do(self, key: Hashable, fn: Callable[[], Awaitable[Any]]) -> Tuple[Any, bool]:
+        """Return (result of ``fn()``, whether it was shared with an earlier caller)
+
+        The call runs as its own task, so a caller that gives up (timeout,
+        disconnect) does not cancel the work for the others. Exceptions are
+        raised to every caller.
+        """
+        task = self._inflight.get(key)
+        shared = task is not None
+        if shared:
+            self.coalesced += 1
+        else:
+            self.calls += 1
+            task = asyncio.ensure_future(fn())
+            self._inflight[key] = task
+            task.add_done_callback(lambda done: self._finish(key, done))
+        return await asyncio.shield(task), shared
+
+    def _finish(self, key: Hashable, task: asyncio.Future):
+        if self._inflight.get(key) is task:
+            del self._inflight[key]
+        # Mark the exception as retrieved in case every caller has already gone
+        if not task.cancelled():
+            task.exception()
+
+    def stats(self):
+        """Coalescing counters for health reporting"""
+        requests = self.calls + self.coalesced
+        return {
+            "in_flight": len(self._inflight),
+            "calls": self.calls,
+            "coalesced": self.coalesced,
+            "coalescing_ratio": round(self.coalesced / requests, 3) if requests else 0.0,
+        }
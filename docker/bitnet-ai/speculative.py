@@ -0,0 +1,193 @@
+"""Speculative decoding with a prompt-lookup drafter.
+
+Seller replies often repeat spans of their prompt: the product name, its
+price, phrases from the description. ``PromptLookupDrafter`` proposes the
+tokens that followed the latest earlier occurrence of the current n-gram
+in the prompt and reply so far. ``SpeculativeDecoder`` then verifies the
+whole draft with a single forward pass of the model, instead of one pass
+per token.
+
+Verification uses the same logits processors as ``generate`` (repetition
+penalty, no-repeat n-grams, temperature, top-p). When sampling, each drafted
+token is accepted with the probability the model gives it. On rejection the
+replacement is drawn from the remaining probability mass. Because the
+drafter is deterministic, this is standard speculative sampling, and every
+reply is distributed exactly as with plain decoding. Greedy decoding
+produces identical tokens.
+
+The decoder works on one sequence at a time on top of a (possibly prefix
+cached) ``DynamicCache``; rejected draft positions are cropped off the cache.
+"""
+import logging
+import threading
+import time
+from typing import Any, Dict, List, Optional, Sequence, Tuple, Union
+
+import torch
+from transformers import (
+    LogitsProcessorList, NoRepeatNGramLogitsProcessor, RepetitionPenaltyLogitsProcessor,
+    TemperatureLogitsWarper, TopPLogitsWarper
+)
+
+logger = logging.getLogger(__name__)
+
+
+def sampling_processors(
+    temperature: float,
+    top_p: float,
+    repetition_penalty: float = 1.0,
+    no_repeat_ngram_size: int = 0
+) -> LogitsProcessorList:
+    """The processors ``generate`` applies for these sampling settings, in the same order"""
+    processors = LogitsProcessorList()
+    if repetition_penalty != 1.0:
+        processors.append(RepetitionPenaltyLogitsProcessor(repetition_penalty))
+    if no_repeat_ngram_size > 0:
+        processors.append(NoRepeatNGramLogitsProcessor(no_repeat_ngram_size))
+    if temperature != 1.0:
+        processors.append(TemperatureLogitsWarper(temperature))
+    if top_p < 1.0:
+        processors.append(TopPLogitsWarper(top_p))
+    return processors
+
+
+class PromptLookupDrafter:
+    """Drafts the continuation of the latest earlier occurrence of the trailing n-gram"""
+
+    def __init__(self, num_tokens: int = 8, max_ngram: int = 3, min_ngram: int = 1):
+        self.num_tokens = max(1, num_tokens)
+        self.max_ngram = max(1, max_ngram)
+        self.min_ngram = max(1, min(min_ngram, self.max_ngram))
+
+    def propose(self, ids: Sequence[int], limit: int) -> List[int]:
+        """Up to ``limit`` draft tokens to follow ``ids``; empty when nothing matches"""
+        limit = min(limit, self.num_tokens)
+        if limit <= 0:
+            return []
+        # Longer n-grams first: they are rarer and predict the continuation better
+        for size in range(min(self.max_ngram, len(ids) - 1), self.min_ngram - 1, -1):
+            tail = list(ids[-size:])
+            for start in range(len(ids) - size - 1, -1, -1):
+                if list(ids[start:start + size]) == tail:
+                    return list(ids[start + size:start + size + limit])
+        return []
+
+
+class SpeculativeDecoder:
+    """Draft-and-verify decoding loop for a single sequence"""
+
+    def __init__(self, drafter: PromptLookupDrafter):
+        self.drafter = drafter
+        self._lock = threading.Lock()
+        self.generations = 0
+        self.forward_passes = 0
+        self.drafted = 0
+        self.accepted = 0
+
+    def generate(
+        self,
+        model,
+        input_ids: torch.LongTensor,
+        past_key_values,
+        processors: LogitsProcessorList,
+        stopping_criteria: Sequence[Any],
+        max_new_tokens: int,
+        eos_token_id: Optional[Union[int, Sequence[int]]] = None,
+        do_sample: bool = True
+    ) -> Tuple[torch.LongTensor, Dict[str, Any]]:
+        """Continue ``input_ids`` (shape [1, n]) and return the full sequence plus decoding counters
+
+        ``past_key_values`` may already hold states for the start of the
+        prompt (the cached system prefix); it is extended in place.
+        """
+        started = time.perf_counter()
+        device = input_ids.device
+        ids = input_ids[0].tolist()
+        prompt_length = len(ids)
+        eos = {eos_token_id} if isinstance(eos_token_id, int) else set(eos_token_id or ())
+        cache = past_key_values
+        drafted = accepted = passes = 0
+        first_token_at = None
+
+        # Keep the invariant: the cache covers every token but the last, which is fed with the draft
+        cached = cache.get_seq_length()
+        if cached < prompt_length - 1:
+            model(input_ids=input_ids[:, cached:prompt_length - 1], past_key_values=cache, use_cache=True)
+
+        while len(ids) - prompt_length < max_new_tokens:
+            # Leave room for the token the verification pass always adds
+            draft = self.drafter.propose(ids, max_new_tokens - (len(ids) - prompt_length) - 1)
+            logits = model(
+                input_ids=torch.tensor([ids[-1:] + draft], device=device), past_key_values=cache, use_cache=True
+            ).logits[0].float()
+            passes += 1
+
+            new_tokens: List[int] = []
+            for position in range(len(draft) + 1):
+                context = torch.tensor([ids + new_tokens], device=device)
+                scores = processors(context, logits[position:position + 1])[0]
+                probs = torch.softmax(scores, dim=-1) if do_sample else None
+                if position < len(draft):
+                    token = draft[position]
+                    if do_sample:
+                        keep = bool(torch.rand((), device=device) < probs[token])
+                    else:
+                        keep = int(scores.argmax()) == token
+                    if keep:
+                        new_tokens.append(token)
+                        continue
+                    if do_sample:
+                        # Rejected: sample from what is left once the drafted token is excluded
+                        probs = probs.clone()
+                        probs[token] = 0.0
+                        if float(probs.sum()) <= 0.0:
+                            new_tokens.append(token)
+                            break
+                new_tokens.append(int(torch.multinomial(probs, 1)) if do_sample else int(scores.argmax()))
+                break
+
+            drafted += len(draft)
+            accepted += len(new_tokens) - 1
+            # Drop the states of rejected draft positions; the newest token is fed next round
+            rejected = len(draft) - (len(new_tokens) - 1)
+            if rejected:
+                cache.crop(-rejected)
+            if first_token_at is None:
+                first_token_at = time.perf_counter()
+
+            for index, token in enumerate(new_tokens):
+                if token in eos:
+                    new_tokens = new_tokens[:index + 1]
+                    break
+            ids.extend(new_tokens)
+            if new_tokens[-1] in eos:
+                break
+            sequence = torch.tensor([ids], device=device)
+            if any(bool(criterion(sequence, None).all()) for criterion in stopping_criteria):
+                break
+
+        finished = time.perf_counter()
+        with self._lock:
+            self.generations += 1
+            self.forward_passes += passes
+            self.drafted += drafted
+            self.accepted += accepted
+        first_token_at = first_token_at or finished
+        return torch.tensor([ids], device=device), {
+            "drafted": drafted,
+            "accepted": accepted,
+            "forward_passes": passes,
+            "prefill": first_token_at - started,
+            "decode": finished - first_token_at,
+        }
+
+    def stats(self) -> Dict[str, Any]:
+        """Draft acceptance counters for health reporting"""
+        with self._lock:
+            return {
+                "generations": self.generations,
+                "forward_passes": self.forward_passes,
+                "drafted": self.drafted,
+                "accepted": self.accepted,
+                "acceptance_rate": round(self.accepted / self.drafted, 3) if self.drafted else 0.0,
+            }
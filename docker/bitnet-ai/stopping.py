@@ -0,0 +1,121 @@
+"""Early-stop rules for generated replies.
+
+The post-processing keeps at most a couple of sentences, cuts at leaked role
+markers ("Customer:", "Question:", ...) and caps the length, so every token
+generated past those points is thrown away. ``ReplyRules`` captures those
+limits per endpoint and ``ReplyStoppingCriteria`` checks them while
+``generate`` runs, finishing each batch row as soon as its reply is complete.
+``GenerationTimer`` never stops anything; it only timestamps decoding steps.
+"""
+import re
+import time
+from typing import List, Sequence, Tuple
+
+import torch
+from transformers import StoppingCriteria
+
+
+class ReplyRules:
+    """Limits that decide when a generated reply is complete"""
+
+    def __init__(
+        self,
+        max_sentences: int,
+        max_chars: int = 200,
+        role_markers: Sequence[str] = (),
+        sentence_end: str = ".!?"
+    ):
+        self.max_sentences = max_sentences
+        self.max_chars = max_chars
+        self.role_markers = tuple(role_markers)
+        self.sentence_end = sentence_end
+        # A terminator followed by a digit is a decimal point ("$599.99"), not a sentence end. While
+        # text is still being generated, a trailing terminator may be one, so it only counts once
+        # the next character is known
+        self._sentence_end = re.compile(rf"[{re.escape(sentence_end)}](?=\D)")
+        self._final_sentence_end = re.compile(rf"[{re.escape(sentence_end)}](?!\d)")
+        self._role_marker = (
+            re.compile("|".join(re.escape(marker) for marker in self.role_markers), re.IGNORECASE)
+            if self.role_markers else None
+        )
+
+    def with_markers(self, *markers: str) -> "ReplyRules":
+        """Copy of these rules with extra role markers (e.g. the seller's own name)"""
+        return ReplyRules(self.max_sentences, self.max_chars, self.role_markers + markers, self.sentence_end)
+
+    def cut(self, text: str, final: bool = False) -> Tuple[str, bool]:
+        """Return the part of ``text`` the rules allow and whether the reply is complete
+
+        ``final`` marks text whose generation has ended, so a trailing terminator ends a sentence.
+        """
+        reply = text.replace("\n", " ").lstrip()
+        complete = False
+
+        # A leaked role marker ends the reply right before it
+        if self._role_marker:
+            match = self._role_marker.search(reply)
+            if match:
+                reply = reply[:match.start()]
+                complete = True
+
+        # Stop at the end of the last allowed sentence
+        sentence_end = self._final_sentence_end if final else self._sentence_end
+        for count, match in enumerate(sentence_end.finditer(reply), start=1):
+            if count >= self.max_sentences:
+                reply = reply[:match.end()]
+                complete = True
+                break
+
+        if len(reply) > self.max_chars:
+            reply = reply[:self.max_chars].rsplit(' ', 1)[0]
+            complete = True
+
+        return reply, complete
+
+
+class ReplyStoppingCriteria(StoppingCriteria):
+    """Finishes each batch row once its generated text satisfies that row's rules
+
+    ``leads`` holds reply text already placed at the end of each row's prompt
+    (a template lead); it counts toward that row's reply.
+    """
+
+    def __init__(self, tokenizer, prompt_length: int, rules: List[ReplyRules], leads: Sequence[str] = ()):
+        self.tokenizer = tokenizer
+        self.prompt_length = prompt_length
+        self.rules = rules
+        self.leads = list(leads) or [""] * len(rules)
+        self._finished = [False] * len(rules)
+
+    def __call__(self, input_ids: torch.LongTensor, scores: torch.FloatTensor, **kwargs) -> torch.BoolTensor:
+        for row, rules in enumerate(self.rules):
+            if not self._finished[row]:
+                text = self.leads[row] + self.tokenizer.decode(input_ids[row, self.prompt_length:], skip_special_tokens=True)
+                self._finished[row] = rules.cut(text)[1]
+        return torch.tensor(self._finished, dtype=torch.bool, device=input_ids.device)
+
+
+class GenerationTimer(StoppingCriteria):
+    """Timestamps generate() steps to split its time into prefill and decode"""
+
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.first_token_at = None
+        self.finished_at = self.started
+        self.steps = 0
+
+    def __call__(self, input_ids: torch.LongTensor, scores: torch.FloatTensor, **kwargs) -> torch.BoolTensor:
+        # Called once per step after the new token is appended; the first call ends the prefill
+        self.finished_at = time.perf_counter()
+        if self.first_token_at is None:
+            self.first_token_at = self.finished_at
+        self.steps += 1
+        return torch.zeros(input_ids.shape[0], dtype=torch.bool, device=input_ids.device)
+
+    @property
+    def prefill_seconds(self) -> float:
+        return (self.first_token_at or self.finished_at) - self.started
+
+    @property
+    def decode_seconds(self) -> float:
+        return self.finished_at - (self.first_token_at or self.finished_at)
@@ -0,0 +1,129 @@
+"""Token streaming helpers for the SSE endpoints.
+
+``AsyncTextStreamer`` receives token ids from ``model.generate`` on an
+inference worker thread and hands decoded text deltas to the event loop.
+``StreamingReplyFilter`` applies the endpoint's ``ReplyRules`` (role-leak
+markers, sentence limit, character cap) to the growing text so generation can
+be stopped the moment the reply is complete, instead of decoding tokens we
+would drop. ``DuplexStreamingResponse`` streams a response while the handler
+is still reading the request body (``/chat/batch``).
+"""
+import asyncio
+import json
+import threading
+from typing import Any, Dict
+
+import torch
+from starlette.responses import StreamingResponse
+from starlette.types import Receive, Scope, Send
+from transformers import StoppingCriteria
+from transformers.generation.streamers import BaseStreamer
+
+from stopping import ReplyRules
+
+
+def format_sse(event: str, data: Dict[str, Any]) -> str:
+    """Encode one Server-Sent Event"""
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
+
+
+class DuplexStreamingResponse(StreamingResponse):
+    """StreamingResponse for handlers that keep reading the request body while responding
+
+    Older Starlette/uvicorn combinations poll ``receive`` for a disconnect while
+    streaming, which swallows the remaining request body. Here ``receive`` is
+    left to the body reader; a disconnect still ends the stream because
+    reading the body then raises ``ClientDisconnect``.
+    """
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        await self.stream_response(send)
+        if self.background is not None:
+            await self.background()
+
+
+class AsyncTextStreamer(BaseStreamer):
+    """Streamer that forwards decoded text deltas to an asyncio queue
+
+    A ``None`` item marks the end of the stream.
+    """
+
+    def __init__(self, tokenizer, loop: asyncio.AbstractEventLoop):
+        self.tokenizer = tokenizer
+        self.loop = loop
+        self.queue: asyncio.Queue = asyncio.Queue()
+        self._prompt_seen = False
+        self._token_ids = []
+        self._text_length = 0
+
+    def put(self, value: torch.Tensor):
+        # The first call carries the prompt, which is never streamed
+        if not self._prompt_seen:
+            self._prompt_seen = True
+            return
+        self._token_ids.extend(value.reshape(-1).tolist())
+        text = self.tokenizer.decode(self._token_ids, skip_special_tokens=True)
+        # Wait for the rest of a multi-byte character before emitting it
+        if text.endswith("\ufffd"):
+            return
+        self._emit(text[self._text_length:])
+        self._text_length = len(text)
+
+    def end(self):
+        text = self.tokenizer.decode(self._token_ids, skip_special_tokens=True)
+        self._emit(text[self._text_length:])
+        self.loop.call_soon_threadsafe(self.queue.put_nowait, None)
+
+    def _emit(self, delta: str):
+        if delta:
+            self.loop.call_soon_threadsafe(self.queue.put_nowait, delta)
+
+
+class StopOnEvent(StoppingCriteria):
+    """Stops generation once the consumer of the stream sets ``event``"""
+
+    def __init__(self, event: threading.Event):
+        self.event = event
+
+    def __call__(self, input_ids: torch.LongTensor, scores: torch.FloatTensor, **kwargs) -> torch.BoolTensor:
+        return torch.full((input_ids.shape[0],), self.event.is_set(), dtype=torch.bool, device=input_ids.device)
+
+
+class StreamingReplyFilter:
+    """Applies the endpoint's reply rules incrementally to streamed text"""
+
+    def __init__(self, rules: ReplyRules):
+        self.rules = rules
+        self.text = ""  # Raw generated text received so far
+        self.done = False
+        self._emitted = 0
+
+    def feed(self, delta: str) -> str:
+        """Add generated text and return the part that is safe to send"""
+        if self.done:
+            return ""
+        self.text += delta
+        reply, self.done = self.rules.cut(self.text)
+        if self.done:
+            safe = reply.rstrip()
+        else:
+            # Hold back the trailing partial word; it may still become a role marker
+            safe = reply[:reply.rfind(' ') + 1]
+        return self._advance(safe)
+
+    @property
+    def reply(self) -> str:
+        """Generated text cut by the rules, as the final response is built from"""
+        return self.rules.cut(self.text, final=True)[0]
+
+    def finish(self) -> str:
+        """Flush whatever is still held back once generation has ended"""
+        if self.done:
+            return ""
+        self.done = True
+        return self._advance(self.text.replace("\n", " ").strip())
+
+    def _advance(self, safe: str) -> str:
+        delta = safe[self._emitted:]
+        self._emitted = max(self._emitted, len(safe))
+        return delta
@@ -0,0 +1,116 @@
+"""Checks for the product catalog index"""
+import json
+import os
+
+import numpy as np
+
+from catalog import CatalogIndex, product_id, read_catalog, snippet, tokenize
+
+PRODUCTS = [
+    {"_id": {"$oid": "1"}, "name": "GeForce RTX 4070", "manufacturer": "NVIDIA", "category": "GPU", "price": 599, "stock": 3,
+     "specifications": {"memory": "12GB", "tdp": "200W"}},
+    {"_id": {"$oid": "2"}, "name": "Radeon RX 7800 XT", "manufacturer": "AMD", "category": "GPU", "price": 499, "stock": 0},
+    {"_id": {"$oid": "3"}, "name": "Ryzen 7 7800X3D", "manufacturer": "AMD", "category": "CPU", "price": 449,
+     "description": "Gaming processor with 3D V-Cache"},
+    {"_id": {"$oid": "4"}, "name": "Hidden Board", "category": "Motherboard", "isActive": False},
+]
+
+
+class ConceptEmbedder:
+    """Embeds text by the concepts it mentions, so synonyms land close together"""
+
+    CONCEPTS = (("gpu", "graphics", "geforce", "radeon"), ("cpu", "processor", "ryzen"), ("cheap", "budget"))
+
+    def encode(self, texts):
+        return np.array([
+            [sum(term in words for term in concept) + 0.01 for concept in self.CONCEPTS]
+            for words in (tokenize(text) for text in texts)
+        ])
+
+
+def index(products=PRODUCTS, embedder=None, **kwargs):
+    catalog = CatalogIndex(**kwargs)
+    catalog._embedder = embedder
+    catalog.sync(products)
+    return catalog
+
+
+def names(hits):
+    return [hit.product["name"] for hit in hits]
+
+
+def test_helpers():
+    assert tokenize("RTX-4070, 12GB!") == ["rtx", "4070", "12gb"]
+    assert product_id(PRODUCTS[0]) == "1" and product_id({"sku": 7}) == "7" and product_id({}) is None
+    assert snippet(PRODUCTS[0]) == "GeForce RTX 4070 (NVIDIA GPU): $599, in stock, memory 12GB, tdp 200W"
+    assert snippet({"name": "X", "stock": 0}) == "X: out of stock"
+
+
+def test_read_catalog_accepts_every_export_format(tmp_path):
+    (tmp_path / "list.json").write_text(json.dumps(PRODUCTS))
+    (tmp_path / "wrapped.json").write_text(json.dumps({"products": PRODUCTS}))
+    (tmp_path / "lines.jsonl").write_text("\n".join(json.dumps(product) for product in PRODUCTS) + "\n\n")
+    for name in ("list.json", "wrapped.json", "lines.jsonl"):
+        assert read_catalog(str(tmp_path / name)) == PRODUCTS
+
+
+def test_bm25_ranks_name_matches_first_and_skips_inactive_products():
+    catalog = index()
+    assert catalog.size == 3
+    assert names(catalog.search("amd gpu", 3))[0] == "Radeon RX 7800 XT"
+    # "7800X3D" is one term, so it does not match "7800"
+    assert names(catalog.search("7800", 3)) == ["Radeon RX 7800 XT"]
+    assert catalog.search("motherboard") == []
+    scores = [hit.score for hit in catalog.search("amd", 3)]
+    assert scores == sorted(scores, reverse=True)
+
+
+def test_related_needs_a_name_term_and_honours_exclude():
+    catalog = index()
+    # "amd" is in two products, but neither is named by it
+    assert catalog.related("is amd any good") == []
+    assert names(catalog.related("RTX 4070 vs Radeon RX 7800 XT?", exclude=["GeForce RTX 4070"])) == ["Radeon RX 7800 XT"]
+
+
+def test_reciprocal_rank_fusion_adds_semantic_matches():
+    catalog = index(embedder=ConceptEmbedder(), min_similarity=0.9)
+    assert catalog.embeddings
+    # No product says "graphics", so BM25 alone finds nothing; the embedding ranking does
+    assert set(names(catalog.search("graphics card", 2))) == {"GeForce RTX 4070", "Radeon RX 7800 XT"}
+    hits = catalog.search("radeon graphics", 3)
+    # The GPUs tie on similarity; the BM25 match puts the Radeon first, and both rank ahead of the CPU
+    assert names(hits) == ["Radeon RX 7800 XT", "GeForce RTX 4070", "Ryzen 7 7800X3D"]
+    assert hits[0].score > 1 / 60 > hits[2].score
+    # Related hits below min_similarity are dropped
+    assert names(catalog.related("a processor please")) == ["Ryzen 7 7800X3D"]
+
+
+def test_sync_reindexes_only_changed_products():
+    catalog = index()
+    version = catalog.version
+    assert not catalog.sync(PRODUCTS)
+    assert catalog.version == version
+    changed = [dict(PRODUCTS[0], price=549)] + PRODUCTS[2:]
+    assert catalog.sync(changed)
+    stats = catalog.stats()
+    assert stats["products"] == 2 and stats["updated"] == 4 and stats["removed"] == 1
+    assert catalog.version != version
+    assert catalog.search("radeon") == []
+    assert catalog.search("rtx")[0].product["price"] == 549
+
+
+def test_refresh_rereads_the_export_only_when_it_changes(tmp_path):
+    path = tmp_path / "catalog.jsonl"
+    path.write_text(json.dumps(PRODUCTS[0]) + "\n")
+    catalog = CatalogIndex(str(path))
+    assert catalog.refresh() and catalog.size == 1
+    assert not catalog.refresh()
+    path.write_text(json.dumps(PRODUCTS[0]) + "\n" + json.dumps(PRODUCTS[1]) + "\n")
+    stat = os.stat(path)
+    os.utime(path, (stat.st_atime, stat.st_mtime + 1))
+    assert catalog.refresh() and catalog.size == 2
+    path.write_text("{broken")
+    os.utime(path, (stat.st_atime, stat.st_mtime + 2))
+    assert not catalog.refresh()
+    assert catalog.size == 2 and catalog.stats()["load_errors"] == 1
+    assert not CatalogIndex(str(tmp_path / "missing.jsonl")).refresh()
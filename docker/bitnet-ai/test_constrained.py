@@ -0,0 +1,81 @@
+"""Checks for template-constrained answers"""
+import torch
+
+from constrained import ANSWER_TEMPLATES, ConstrainedAnswers, DigitBanLogitsProcessor, template_fields
+
+PRODUCT = {"name": "RTX 4070", "price": 599, "stock": 3, "specifications": {"memory": "12GB", "tdp": "200W", "ports": ""}}
+
+
+class Tokenizer:
+    def __init__(self, tokens):
+        self.tokens = tokens
+
+    def __len__(self):
+        return len(self.tokens)
+
+    def convert_ids_to_tokens(self, ids):
+        return [self.tokens[index] for index in ids]
+
+
+def test_every_template_fills_from_its_required_fields():
+    fields = template_fields(PRODUCT)
+    fields.update(out_of_stock=True)
+    for template in ANSWER_TEMPLATES:
+        assert set(template.required) <= set(fields), template
+        assert "{" not in template.lead.format(**fields)
+
+
+def test_template_fields_add_the_first_specifications():
+    fields = template_fields(PRODUCT, max_specs=1)
+    assert fields["specs"] == "memory 12GB"
+    assert template_fields(PRODUCT)["specs"] == "memory 12GB, tdp 200W"
+    assert "specs" not in template_fields({"name": "X"})
+
+
+def test_lead_picks_the_first_template_with_all_its_fields():
+    answers = ConstrainedAnswers()
+    assert answers.lead("price", PRODUCT) == "The RTX 4070 is priced at $599"
+    assert answers.lead("price", {"price": 5}) == "This product is priced at $5"
+    assert answers.lead("stock", PRODUCT) == "We have 3 units of the RTX 4070 in stock"
+    assert answers.lead("stock", {"name": "X", "stock": 0}) == "The X is currently out of stock"
+    assert answers.lead("quality", PRODUCT) == "The RTX 4070 comes with memory 12GB, tdp 200W"
+    assert answers.lead("stock", {"name": "X"}) == ""
+    assert answers.lead("shipping", PRODUCT) == answers.lead(None, PRODUCT) == ""
+    assert ConstrainedAnswers(enabled=False).lead("price", PRODUCT) == ""
+
+
+def test_only_recorded_leads_are_counted():
+    answers = ConstrainedAnswers()
+    answers.lead("price", PRODUCT)
+    assert answers.stats()["leads"] == {}
+    answers.record("price")
+    answers.record("price")
+    answers.record("stock")
+    assert answers.stats()["leads"] == {"price": 2, "stock": 1}
+
+
+def test_digit_tokens_are_banned_in_constrained_rows_only():
+    tokenizer = Tokenizer(["a", "Ġ5", "99", "b", "", "x1y"])
+    answers = ConstrainedAnswers()
+    assert answers.processor(tokenizer, []) is None
+    processor = answers.processor(tokenizer, [1])
+    assert processor.banned_ids.tolist() == [1, 2, 5]
+    scores = processor(torch.zeros(2, 1, dtype=torch.long), torch.zeros(2, 6))
+    assert scores[0].tolist() == [0.0] * 6
+    assert [score == -float("inf") for score in scores[1].tolist()] == [False, True, True, False, False, True]
+    assert answers.stats()["banned_tokens"] == 3
+
+
+def test_banned_ids_are_computed_once_per_tokenizer():
+    tokenizer = Tokenizer(["1", "a"])
+    answers = ConstrainedAnswers()
+    first = answers.processor(tokenizer, [0]).banned_ids
+    tokenizer.tokens = ["a", "1"]
+    assert answers.processor(tokenizer, [0]).banned_ids is first
+    assert answers.processor(Tokenizer(["a", "1"]), [0]).banned_ids.tolist() == [1]
+
+
+def test_processor_accepts_any_row_set():
+    processor = DigitBanLogitsProcessor(torch.tensor([0]), [0, 2])
+    scores = processor(torch.zeros(3, 1, dtype=torch.long), torch.zeros(3, 2))
+    assert scores[:, 0].tolist() == [-float("inf"), 0.0, -float("inf")]
@@ -0,0 +1,249 @@
+"""Checks for the inference worker pool, micro-batching and ordered_map"""
+import asyncio
+import threading
+
+import pytest
+
+from inference import DeadlineExceededError, InferenceExecutor, MicroBatcher, QueueFullError, ordered_map
+
+
+def test_runs_blocking_calls_off_the_event_loop():
+    async def main():
+        executor = InferenceExecutor(workers=1)
+        try:
+            return await executor.run(lambda a, b=0: (a + b, threading.current_thread().name), 1, b=2), executor.stats()
+        finally:
+            executor.shutdown()
+
+    (result, thread), stats = asyncio.run(main())
+    assert result == 3
+    assert thread.startswith("inference")
+    assert stats["completed"] == 1 and stats["queued"] == 0
+
+
+def test_rejects_past_the_admission_queue():
+    release = threading.Event()
+
+    async def main():
+        executor = InferenceExecutor(workers=1, max_queue=1)
+        try:
+            first = asyncio.ensure_future(executor.run(release.wait, 5))
+            second = asyncio.ensure_future(executor.run(lambda: "second"))
+            await asyncio.sleep(0.05)
+            with pytest.raises(QueueFullError):
+                await executor.run(lambda: "third")
+            release.set()
+            return await first, await second, executor.stats()["rejected"]
+        finally:
+            release.set()
+            executor.shutdown()
+
+    assert asyncio.run(main()) == (True, "second", 1)
+
+
+def test_job_queued_past_its_deadline_is_dropped():
+    release = threading.Event()
+    calls = []
+
+    async def main():
+        executor = InferenceExecutor(workers=1, max_queue=4)
+        try:
+            busy = asyncio.ensure_future(executor.run(release.wait, 5, timeout=5))
+            await asyncio.sleep(0.02)
+            with pytest.raises(DeadlineExceededError):
+                await executor.run(calls.append, "late", timeout=0.05)
+            release.set()
+            await busy
+            # The worker that picks the expired job drops it without running it
+            while executor.stats()["queued"]:
+                await asyncio.sleep(0.01)
+            return executor.stats(), executor.scheduler.stats()["dropped"]
+        finally:
+            release.set()
+            executor.shutdown()
+
+    stats, dropped = asyncio.run(main())
+    assert calls == []
+    assert stats["expired"] == 1 and stats["completed"] == 1
+    assert dropped == {"": 1}
+
+
+def test_higher_priority_class_runs_first():
+    release = threading.Event()
+    order = []
+
+    async def main():
+        executor = InferenceExecutor(workers=1, max_queue=4)
+        executor.scheduler.priorities.update({"chat": 0, "website_helper": 1})
+        try:
+            busy = asyncio.ensure_future(executor.run(release.wait, 5, priority_class="chat"))
+            await asyncio.sleep(0.02)
+            helper = asyncio.ensure_future(executor.run(order.append, "helper", priority_class="website_helper"))
+            chat = asyncio.ensure_future(executor.run(order.append, "chat", priority_class="chat"))
+            await asyncio.sleep(0.02)
+            release.set()
+            await asyncio.gather(busy, helper, chat)
+        finally:
+            release.set()
+            executor.shutdown()
+
+    asyncio.run(main())
+    assert order == ["chat", "helper"]
+
+
+def test_concurrent_requests_share_one_batch_per_key():
+    batches = []
+
+    def runner(key, items):
+        batches.append((key, list(items)))
+        return [f"{key}:{item}" for item in items]
+
+    async def main():
+        executor = InferenceExecutor(workers=1)
+        batcher = MicroBatcher(executor, runner, max_batch_size=4, max_wait_ms=20)
+        try:
+            return await asyncio.gather(
+                *[batcher.submit("chat", index) for index in range(3)], batcher.submit("website_helper", "a")
+            ), batcher.stats()
+        finally:
+            executor.shutdown()
+
+    results, stats = asyncio.run(main())
+    assert results == ["chat:0", "chat:1", "chat:2", "website_helper:a"]
+    assert sorted(batches) == [("chat", [0, 1, 2]), ("website_helper", ["a"])]
+    assert stats["batches"] == 2 and stats["avg_batch_size"] == 2.0
+
+
+def test_full_batch_runs_without_waiting_and_overflow_gets_its_own():
+    sizes = []
+
+    def runner(key, items):
+        sizes.append(len(items))
+        return list(items)
+
+    async def main():
+        executor = InferenceExecutor(workers=1)
+        # A wait this long would time the test out if full batches waited for it
+        batcher = MicroBatcher(executor, runner, max_batch_size=2, max_wait_ms=60000)
+        try:
+            return await asyncio.wait_for(asyncio.gather(*[batcher.submit("chat", index) for index in range(4)]), 5)
+        finally:
+            executor.shutdown()
+
+    assert asyncio.run(main()) == [0, 1, 2, 3]
+    assert sizes == [2, 2]
+
+
+def test_batch_is_filled_fairly_across_flows():
+    release = threading.Event()
+    batches = []
+
+    def runner(key, items):
+        batches.append(list(items))
+        return list(items)
+
+    async def main():
+        executor = InferenceExecutor(workers=1)
+        batcher = MicroBatcher(executor, runner, max_batch_size=2, max_wait_ms=1)
+        try:
+            busy = asyncio.ensure_future(executor.run(release.wait, 5))
+            await asyncio.sleep(0.02)
+            # The batches are only filled once the worker frees up, after the quiet seller arrived
+            burst = [asyncio.ensure_future(batcher.submit("chat", f"busy{index}", flow="busy")) for index in range(4)]
+            await asyncio.sleep(0.02)
+            quiet = asyncio.ensure_future(batcher.submit("chat", "quiet", flow="quiet"))
+            await asyncio.sleep(0.02)
+            release.set()
+            await asyncio.gather(busy, quiet, *burst)
+        finally:
+            release.set()
+            executor.shutdown()
+
+    asyncio.run(main())
+    assert "quiet" in batches[0]
+
+
+def test_runner_errors_reach_every_caller():
+    def runner(key, items):
+        raise RuntimeError("boom")
+
+    async def main():
+        executor = InferenceExecutor(workers=1)
+        batcher = MicroBatcher(executor, runner, max_batch_size=4, max_wait_ms=1)
+        try:
+            return await asyncio.gather(*[batcher.submit("chat", index) for index in range(2)], return_exceptions=True)
+        finally:
+            executor.shutdown()
+
+    assert [str(error) for error in asyncio.run(main())] == ["boom", "boom"]
+
+
+def test_priority_classes_are_not_batched_together():
+    batches = []
+
+    def runner(key, items):
+        batches.append((key, list(items)))
+        return list(items)
+
+    async def main():
+        executor = InferenceExecutor(workers=1)
+        batcher = MicroBatcher(executor, runner, max_batch_size=4, max_wait_ms=20)
+        try:
+            await asyncio.gather(batcher.submit("chat", "live"), batcher.submit("chat", "bulk", priority_class="chat_batch"))
+        finally:
+            executor.shutdown()
+
+    asyncio.run(main())
+    assert sorted(batches) == [("chat", ["bulk"]), ("chat", ["live"])]
+
+
+def test_ordered_map_keeps_input_order_within_the_window():
+    in_flight, peak = 0, 0
+
+    async def answer(item):
+        nonlocal in_flight, peak
+        in_flight += 1
+        peak = max(peak, in_flight)
+        # Later items finish first
+        await asyncio.sleep(0.01 * (5 - item))
+        in_flight -= 1
+        return item * 10
+
+    async def items():
+        for item in range(5):
+            yield item
+
+    async def main():
+        return [result async for result in ordered_map(answer, items(), 2)]
+
+    assert asyncio.run(main()) == [0, 10, 20, 30, 40]
+    assert peak == 2
+
+
+def test_ordered_map_cancels_work_in_flight_when_the_consumer_stops():
+    started, cancelled = [], []
+
+    async def answer(item):
+        started.append(item)
+        try:
+            await asyncio.sleep(0 if item == 0 else 5)
+        except asyncio.CancelledError:
+            cancelled.append(item)
+            raise
+        return item
+
+    async def items():
+        for item in range(10):
+            yield item
+
+    async def main():
+        results = ordered_map(answer, items(), 3)
+        first = await results.__anext__()
+        await results.aclose()
+        await asyncio.sleep(0)
+        return first
+
+    assert asyncio.run(main()) == 0
+    # Only the window was ever pulled from the input
+    assert started == [0, 1, 2]
+    assert cancelled == [1, 2]
@@ -0,0 +1,32 @@
+"""Checks for the intent table and pre-routing"""
+from intents import IntentClassifier
+
+CLASSIFIER = IntentClassifier()
+
+
+def test_triggers_match_on_word_boundaries():
+    assert CLASSIFIER.classify("chat", "what about shipping?").label == "shipping"
+    assert CLASSIFIER.classify("chat", "this is fine") is None
+
+
+def test_ties_go_to_the_intent_listed_first():
+    # price comes before stock in the table, whichever is mentioned first
+    assert CLASSIFIER.classify("chat", "stock and price?").label == "price"
+    assert CLASSIFIER.classify("chat", "price and stock?").label == "price"
+
+
+def test_confident_faq_is_prerouted():
+    assert CLASSIFIER.preroute("chat", "thank you!", {}, 0.75).startswith("You're very welcome")
+
+
+def test_negated_messages_are_not_prerouted():
+    assert CLASSIFIER.preroute("chat", "No thanks", {}, 0.75) is None
+    assert CLASSIFIER.preroute("chat", "I don’t want a refund, thanks", {}, 0.75) is None
+
+
+def test_only_observe_counts_matches():
+    classifier = IntentClassifier()
+    classifier.classify("chat", "hello")
+    classifier.preroute("chat", "thanks", {}, 0.75)
+    classifier.observe("chat", "hello")
+    assert classifier.stats()["matches"] == {"chat.greeting": 1}
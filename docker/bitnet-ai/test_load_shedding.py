@@ -0,0 +1,78 @@
+"""Checks for the adaptive load shedding controller"""
+import load_shedding
+from load_shedding import LoadController, LoadThresholds
+
+
+class Clock:
+    """Stands in for the ``time`` module so the decaying signals can be aged without sleeping"""
+
+    def __init__(self):
+        self.now = 100.0
+
+    def monotonic(self):
+        return self.now
+
+
+def controller(depth=0, **thresholds):
+    return LoadController(lambda: depth, LoadThresholds(**thresholds), low_value_intents=("greeting", "thanks"))
+
+
+def test_idle_service_is_not_degraded():
+    load = controller()
+    assert load.pressure() == 0.0 and load.level() == 0
+    assert load.max_new_tokens(96) == 96
+    assert load.shed("website_helper", lambda: "greeting") == ""
+
+
+def test_pressure_is_the_largest_signal():
+    load = controller(depth=4, queue_depth=8, queue_wait=0.5, latency=4.0)
+    assert load.pressure() == 0.5
+    load.observe(queue_seconds=1.0, generation_seconds=0.0)
+    # One sample moves the average 30% of the way
+    assert round(load.pressure(), 3) == 0.6
+
+
+def test_token_limit_shrinks_with_pressure_down_to_the_floor():
+    assert controller(depth=12, queue_depth=8).max_new_tokens(96) == 64
+    assert controller(depth=80, queue_depth=8, min_token_scale=0.5).max_new_tokens(96) == 48
+
+
+def test_steps_shed_low_value_intents_then_the_website_helper():
+    classified = []
+
+    def intent():
+        classified.append(1)
+        return "greeting"
+
+    reduce_only = controller(depth=8, queue_depth=8)
+    assert reduce_only.shed("chat", intent) == ""
+    # Messages are only classified once low-value intents are being shed
+    assert classified == []
+
+    low_value = controller(depth=12, queue_depth=8)
+    assert low_value.shed("chat", intent) == "low_value_fallback"
+    assert low_value.shed("chat", lambda: "price") == ""
+
+    overloaded = controller(depth=16, queue_depth=8)
+    assert overloaded.shed("website_helper", lambda: "price") == "shed_website_helper"
+    assert overloaded.shed("chat", lambda: "price") == ""
+    assert overloaded.stats()["level_name"] == "shed_website_helper"
+    assert overloaded.stats()["decisions"] == {"shed_website_helper": 1}
+
+
+def test_latency_signals_decay_once_samples_stop(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(load_shedding, "time", clock)
+    load = LoadController(lambda: 0, LoadThresholds(latency=1.0), half_life=5.0)
+    for _ in range(20):
+        load.observe(0.0, 4.0)
+    busy = load.pressure()
+    clock.now += 5.0
+    assert abs(load.pressure() - busy / 2) < 1e-9
+
+
+def test_disabled_controller_never_degrades():
+    load = LoadController(lambda: 100, enabled=False)
+    assert load.level() == 0
+    assert load.max_new_tokens(96) == 96
+    assert load.shed("website_helper", lambda: "greeting") == ""
@@ -0,0 +1,47 @@
+"""Checks for the table-driven reply post-processor"""
+from postprocess import REPLY_FORMATS, PostProcessor
+
+PROCESSOR = PostProcessor()
+
+
+def process(endpoint, text):
+    return PROCESSOR.process(endpoint, [text])[0]
+
+
+def test_decimal_price_is_not_a_sentence_end():
+    assert process("chat", "Sure. It costs $599.99. Anything else? More text").text == "Sure. It costs $599.99."
+    assert process("website_helper", "The RTX 4070 costs $599.99 today. Next").text == "The RTX 4070 costs $599.99 today."
+
+
+def test_role_marker_and_artifacts_are_cut():
+    result = process("chat", "Yes,  it is<|endoftext|> in stock. Customer: do you ship?")
+    assert result.text == "Yes, it is in stock."
+    assert result.valid
+
+
+def test_long_unfinished_sentence_is_closed():
+    assert process("chat", "It ships within two days").text == "It ships within two days."
+    assert process("chat", "Ok").text == ""
+
+
+def test_validation_reasons():
+    assert process("chat", "Hi.").reason == "too_short"
+    assert process("chat", "As an AI I cannot help with that.").reason == "banned_phrase"
+    assert process("chat", "good good good good good.").reason == "repetitive"
+
+
+def test_length_cap_keeps_whole_words():
+    text = process("chat", "word " * 80).text
+    assert len(text) <= REPLY_FORMATS["chat"].max_chars + 1
+    assert text.endswith("word.")
+
+
+def test_rejections_are_counted_per_endpoint_and_reason():
+    processor = PostProcessor()
+    processor.process("chat", ["Hi.", "It is in stock now."])
+    assert processor.stats() == {"processed": 2, "rejected": {"chat.too_short": 1}}
+
+
+def test_artifacts_collapse_with_surrounding_whitespace():
+    assert process("chat", "It is <|end|><|end|> in stock.").text == "It is in stock."
+    assert process("chat", "It is in stock<|im_end|>").text == "It is in stock."
@@ -0,0 +1,77 @@
+"""Checks for the shared-prefix KV cache and batch assembly"""
+import torch
+from transformers import LlamaConfig, LlamaForCausalLM
+
+from prefix_cache import PrefixKVCache, assemble_prefixed_batch
+
+
+def tiny_model():
+    torch.manual_seed(0)
+    config = LlamaConfig(
+        vocab_size=64, hidden_size=32, intermediate_size=64, num_hidden_layers=2,
+        num_attention_heads=4, num_key_value_heads=2, max_position_embeddings=128
+    )
+    return LlamaForCausalLM(config).eval()
+
+
+class Tokenizer:
+    """Maps each character to one token id"""
+
+    def __call__(self, text):
+        return {"input_ids": [ord(char) % 60 + 1 for char in text]}
+
+
+def states(length, fill):
+    return [(torch.full((1, 2, length, 4), float(fill)), torch.full((1, 2, length, 4), float(-fill)))]
+
+
+def test_rows_are_padded_so_every_prompt_ends_in_the_same_column():
+    input_ids, attention_mask, cache = assemble_prefixed_batch(
+        [([1, 2, 3], states(3, 1)), ([4], states(1, 2))], [[5], [6, 7]], pad_token_id=0
+    )
+    assert input_ids.tolist() == [[1, 2, 3, 0, 5], [0, 0, 4, 6, 7]]
+    assert attention_mask.tolist() == [[1, 1, 1, 0, 1], [0, 0, 1, 1, 1]]
+    key, value = cache[0]
+    assert key.shape == (2, 2, 3, 4)
+    # Prefix states are left-padded with zeros to the longest prefix
+    assert key[1, :, :2].abs().sum() == 0 and (key[1, :, 2] == 2).all()
+    assert (value[0] == -1).all()
+
+
+def test_assembled_states_are_copies():
+    stored = states(2, 1)
+    _, _, cache = assemble_prefixed_batch([([1, 2], stored)], [[3]], pad_token_id=0)
+    cache[0][0].zero_()
+    assert (stored[0][0] == 1).all()
+
+
+def test_cached_prefix_matches_a_full_prefill():
+    model, tokenizer = tiny_model(), Tokenizer()
+    prefix_cache = PrefixKVCache()
+    rows = [("You are a seller. ", "Price?"), ("Rules: be brief. ", "Is it in stock today?")]
+    prefixes = [prefix_cache.get(("chat", index), prefix, model, tokenizer) for index, (prefix, _) in enumerate(rows)]
+    suffixes = [tokenizer(suffix)["input_ids"] for _, suffix in rows]
+    input_ids, attention_mask, cache = assemble_prefixed_batch(prefixes, suffixes, pad_token_id=0)
+
+    suffix_len = input_ids.shape[1] - cache.get_seq_length()
+    position_ids = (attention_mask.cumsum(-1) - 1).clamp(min=0)
+    with torch.no_grad():
+        batched = model(
+            input_ids=input_ids[:, -suffix_len:], attention_mask=attention_mask, past_key_values=cache,
+            position_ids=position_ids[:, -suffix_len:]
+        ).logits[:, -1]
+        for row, (prefix, suffix) in enumerate(rows):
+            full = model(input_ids=torch.tensor([tokenizer(prefix + suffix)["input_ids"]])).logits[0, -1]
+            assert torch.allclose(batched[row], full, atol=1e-4)
+
+
+def test_lru_reuses_and_evicts_prefixes():
+    model, tokenizer = tiny_model(), Tokenizer()
+    prefix_cache = PrefixKVCache(max_entries=1)
+    first = prefix_cache.get("a", "abc", model, tokenizer)
+    assert prefix_cache.get("a", "abc", model, tokenizer)[1] is first[1]
+    prefix_cache.get("b", "xyz", model, tokenizer)
+    # A changed text under the same key is a miss, as is the evicted key
+    prefix_cache.get("b", "xy", model, tokenizer)
+    prefix_cache.get("a", "abc", model, tokenizer)
+    assert (prefix_cache.hits, prefix_cache.misses) == (1, 4)
@@ -0,0 +1,46 @@
+"""Checks for token-budget prompt assembly"""
+import re
+
+from prompt_builder import PromptBuilder, Segment, render
+
+
+class WordTokenizer:
+    """One token per word, its leading whitespace included, like a byte-level BPE"""
+
+    def __init__(self):
+        self.vocab = {}
+
+    def __call__(self, text, add_special_tokens=False):
+        return {"input_ids": [self.vocab.setdefault(word, len(self.vocab)) for word in re.findall(r"\s*\S+", text)]}
+
+    def decode(self, ids):
+        words = {index: word for word, index in self.vocab.items()}
+        return "".join(words[index] for index in ids)
+
+
+def test_segments_within_budget_match_the_whole_prompt():
+    tokenizer = WordTokenizer()
+    segments = [Segment("Product: GPU"), Segment(" fast and quiet", trim="head"), Segment("\nSeller:")]
+    assert PromptBuilder().build(segments, tokenizer, 100) == tokenizer(render(segments))["input_ids"]
+
+
+def test_lowest_priority_is_trimmed_first_and_the_cue_is_kept():
+    tokenizer = WordTokenizer()
+    segments = [
+        Segment(" one two three four", trim="head", priority=-1),
+        Segment(" why is it slow", trim="tail", priority=1, min_tokens=2),
+        Segment(" Seller:"),
+    ]
+    builder = PromptBuilder()
+    assert tokenizer.decode(builder.build(segments, tokenizer, 7)) == " one two why is it slow Seller:"
+    assert tokenizer.decode(builder.build(segments, tokenizer, 3)) == " it slow Seller:"
+    assert builder.stats()["trimmed"] == 2
+
+
+def test_static_segments_are_tokenized_once():
+    tokenizer = WordTokenizer()
+    builder = PromptBuilder()
+    for _ in range(3):
+        builder.build([Segment("System prompt"), Segment(" hi", trim="tail"), Segment(" Seller:")], tokenizer, 50)
+    assert builder.stats()["static_misses"] == 2
+    assert builder.stats()["static_hits"] == 4
@@ -0,0 +1,107 @@
+"""Checks for the response cache"""
+import asyncio
+import sys
+
+import response_cache
+from response_cache import ResponseCache, normalize_message, stock_status
+
+
+class Clock:
+    """Stands in for the ``time`` module so entries can be aged without sleeping"""
+
+    def __init__(self):
+        self.now = 100.0
+
+    def monotonic(self):
+        return self.now
+
+
+class FakeRedis:
+    def __init__(self, fail=False):
+        self.values = {}
+        self.fail = fail
+
+    async def get(self, key):
+        if self.fail:
+            raise ConnectionError("down")
+        return self.values.get(key)
+
+    async def set(self, key, value, ex=None):
+        if self.fail:
+            raise ConnectionError("down")
+        self.values[key] = value.encode("utf-8")
+
+
+def test_keys_ignore_case_spacing_and_edge_punctuation():
+    assert normalize_message("  Is it  IN stock?? ") == "is it in stock"
+    key = ResponseCache.make_key("chat", "Is it in stock?", name="RTX", price=599)
+    assert key == ResponseCache.make_key("chat", "is it in  stock", price=599, name="RTX")
+    assert key != ResponseCache.make_key("chat", "is it in stock", name="RTX", price=499)
+    assert key != ResponseCache.make_key("website_helper", "is it in stock", name="RTX", price=599)
+
+
+def test_stock_status_keeps_only_availability():
+    assert stock_status({"stock": 7}) == stock_status({"stock": 1}) == "available"
+    assert stock_status({"stock": 0}) == "out_of_stock"
+    assert stock_status({}) is None
+
+
+def test_least_recently_used_entry_is_evicted():
+    async def main():
+        cache = ResponseCache(max_entries=2)
+        await cache.set("a", "A")
+        await cache.set("b", "B")
+        await cache.get("a")
+        await cache.set("c", "C")
+        return [await cache.get(key) for key in "abc"], cache.stats()
+
+    values, stats = asyncio.run(main())
+    assert values == ["A", None, "C"]
+    assert stats["evictions"] == 1 and stats["hits"] == 3 and stats["misses"] == 1
+
+
+def test_entries_expire_after_the_ttl(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(response_cache, "time", clock)
+
+    async def main():
+        cache = ResponseCache(ttl=10)
+        await cache.set("a", "A")
+        clock.now += 9
+        fresh = await cache.get("a")
+        clock.now += 2
+        return fresh, await cache.get("a"), cache.stats()["entries"]
+
+    assert asyncio.run(main()) == ("A", None, 0)
+
+
+def test_memory_budget_evicts_and_skips_oversized_values():
+    entry_size = sys.getsizeof("a") + sys.getsizeof("x" * 100)
+
+    async def main():
+        cache = ResponseCache(max_bytes=2 * entry_size)
+        for key in "abc":
+            await cache.set(key, "x" * 100)
+        await cache.set("d", "x" * 10000)
+        return [await cache.get(key) is not None for key in "abcd"], cache.stats()["bytes"]
+
+    present, size = asyncio.run(main())
+    assert present == [False, True, True, False]
+    assert size == 2 * entry_size
+
+
+def test_redis_tier_fills_the_local_lru_and_survives_errors():
+    async def main():
+        cache = ResponseCache()
+        cache._redis = FakeRedis()
+        await cache.set("a", "A")
+        cache._entries.clear()
+        remote = await cache.get("a")
+        local = await cache.get("a")
+        cache._redis = FakeRedis(fail=True)
+        await cache.set("b", "B")
+        return remote, local, await cache.get("b"), cache.stats()
+
+    remote, local, after_error, stats = asyncio.run(main())
+    assert (remote, local, after_error) == ("A", "A", "B")
+    assert stats["remote_hits"] == 1 and stats["hits"] == 2 and stats["remote_errors"] == 1
@@ -0,0 +1,42 @@
+"""Checks for priority classes and weighted fair queuing"""
+from scheduler import FairQueue, FairScheduler, parse_mapping
+
+
+def test_parse_mapping():
+    assert parse_mapping("chat:0, website_helper:1,,Shop: A:2") == {"chat": 0.0, "website_helper": 1.0, "Shop: A": 2.0}
+    assert parse_mapping("broken,x:y") == {}
+
+
+def test_backlogged_flow_does_not_hold_up_a_new_one():
+    queue = FairQueue()
+    for index in range(4):
+        queue.push(("busy", index), "busy")
+    queue.push(("quiet", 0), "quiet")
+    assert [queue.pop() for _ in range(len(queue))] == [
+        ("busy", 0), ("quiet", 0), ("busy", 1), ("busy", 2), ("busy", 3)
+    ]
+
+
+def test_weights_set_the_share():
+    queue = FairQueue({"big": 2})
+    for index in range(4):
+        queue.push(("big", index), "big")
+        queue.push(("small", index), "small")
+    order = [queue.pop()[0] for _ in range(6)]
+    assert order.count("big") == 4 and order.count("small") == 2
+
+
+def test_lower_priority_number_goes_first():
+    scheduler = FairScheduler({"chat": 0, "website_helper": 1})
+    scheduler.push("helper", "website_helper")
+    scheduler.push("bulk", "unlisted")
+    scheduler.push("chat", "chat", flow="Shop")
+    assert [scheduler.pop()[1] for _ in range(3)] == ["chat", "helper", "bulk"]
+    assert scheduler.pop() is None
+    assert scheduler.stats()["dispatched"] == {"chat": 1, "website_helper": 1, "unlisted": 1}
+
+
+def test_class_deadlines_default():
+    scheduler = FairScheduler(deadlines={"website_helper": 5}, default_deadline=15)
+    assert scheduler.deadline("website_helper") == 5
+    assert scheduler.deadline("chat") == 15
@@ -0,0 +1,107 @@
+"""Checks for conversation sessions"""
+from types import SimpleNamespace
+
+import torch
+
+import sessions
+from prefix_cache import CachedPrefix
+from sessions import SessionStore, kv_bytes_per_token, states_nbytes
+
+
+class Clock:
+    """Stands in for the ``time`` module so sessions can be aged without sleeping"""
+
+    def __init__(self):
+        self.now = 100.0
+
+    def monotonic(self):
+        return self.now
+
+
+def snapshot(tokens):
+    # One layer of float32 keys and values: 2 * 2 heads * 4 dims * 4 bytes = 64 bytes per token
+    states = [(torch.zeros(1, 2, tokens, 4), torch.zeros(1, 2, tokens, 4))]
+    return CachedPrefix(list(range(tokens)), states)
+
+
+def record(store, chat_id, reply="Hi", tokens=None, fingerprint="shop"):
+    store.record(chat_id, fingerprint, "hello", reply, f" turn {reply}", snapshot(tokens) if tokens else None)
+
+
+def test_kv_bytes_per_token_follows_the_config():
+    config = SimpleNamespace(num_hidden_layers=30, num_attention_heads=9, num_key_value_heads=3, hidden_size=576)
+    assert kv_bytes_per_token(config) == 30 * 2 * 3 * 64 * 4
+    assert kv_bytes_per_token(config, element_size=2) == 30 * 2 * 3 * 64 * 2
+    plain = SimpleNamespace(num_hidden_layers=2, num_attention_heads=4, hidden_size=32, num_key_value_heads=None)
+    assert kv_bytes_per_token(plain) == 2 * 2 * 4 * 8 * 4
+    assert states_nbytes(snapshot(3)) == 3 * 64
+
+
+def test_turns_and_pending_text_follow_the_snapshot():
+    store = SessionStore(max_turns=2)
+    record(store, "a", "The price is $5.", tokens=4)
+    session = store.get("a", "shop")
+    assert session.pending == "The price is $5." and session.snapshot_bytes == 4 * 64
+    # Turns answered without the model are appended to the text after the snapshot
+    record(store, "a", "Thanks!")
+    record(store, "a", "Bye!")
+    assert session.pending == "The price is $5. turn Thanks! turn Bye!"
+    assert session.turns == [("hello", "Thanks!"), ("hello", "Bye!")]
+
+
+def test_lead_is_left_out_of_the_pending_text():
+    store = SessionStore()
+    store.record("a", "shop", "price?", "The X is priced at $5, a steal.", "", snapshot(2), lead="The X is priced at $5")
+    assert store.get("a", "shop").pending == ", a steal."
+
+
+def test_other_facts_start_a_new_session():
+    store = SessionStore()
+    record(store, "a", tokens=2)
+    assert store.get("a", "other shop") is None
+    assert store.get("a", "shop") is None
+    assert store.stats()["snapshot_bytes"] == 0
+
+
+def test_least_recently_used_sessions_are_evicted():
+    store = SessionStore(max_sessions=2)
+    record(store, "a")
+    record(store, "b")
+    store.get("a", "shop")
+    record(store, "c")
+    assert store.get("b", "shop") is None
+    assert store.get("a", "shop") is not None and store.get("c", "shop") is not None
+    assert store.stats()["evictions"] == 1
+
+
+def test_sessions_expire_after_the_ttl(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(sessions, "time", clock)
+    store = SessionStore(ttl=60)
+    record(store, "a", tokens=2)
+    clock.now += 61
+    assert store.get("a", "shop") is None
+    assert store.stats()["expirations"] == 1 and store.stats()["snapshot_bytes"] == 0
+
+
+def test_snapshot_over_the_per_session_cap_is_not_kept():
+    store = SessionStore(max_session_bytes=4 * 64)
+    record(store, "a", tokens=5)
+    session = store.get("a", "shop")
+    assert session.snapshot is None and session.turns == [("hello", "Hi")]
+    assert store.stats()["snapshots_dropped"] == 1
+
+
+def test_total_cap_drops_the_oldest_snapshots_first():
+    store = SessionStore(max_total_bytes=5 * 64)
+    record(store, "a", tokens=3)
+    record(store, "b", tokens=3)
+    assert store.get("a", "shop").snapshot is None
+    assert store.get("b", "shop").snapshot is not None
+    assert store.stats()["snapshot_bytes"] == 3 * 64
+
+
+def test_disabled_store_keeps_nothing():
+    store = SessionStore(max_sessions=0)
+    record(store, "a", tokens=2)
+    assert store.get("a", "shop") is None
@@ -0,0 +1,73 @@
+"""Checks for request coalescing"""
+import asyncio
+
+import pytest
+
+from singleflight import SingleFlight
+
+
+def test_concurrent_callers_share_one_call():
+    calls = []
+
+    async def generate():
+        calls.append(1)
+        await asyncio.sleep(0.01)
+        return "reply"
+
+    async def main():
+        flight = SingleFlight()
+        results = await asyncio.gather(*[flight.do("key", generate) for _ in range(3)])
+        return results, flight.stats()
+
+    results, stats = asyncio.run(main())
+    assert len(calls) == 1
+    assert results == [("reply", False), ("reply", True), ("reply", True)]
+    assert stats == {"in_flight": 0, "calls": 1, "coalesced": 2, "coalescing_ratio": 0.667}
+
+
+def test_different_keys_and_later_calls_run_again():
+    calls = []
+
+    async def generate():
+        calls.append(1)
+        return len(calls)
+
+    async def main():
+        flight = SingleFlight()
+        first = await asyncio.gather(flight.do("a", generate), flight.do("b", generate))
+        return first, await flight.do("a", generate)
+
+    assert asyncio.run(main()) == ([(1, False), (2, False)], (3, False))
+
+
+def test_errors_reach_every_caller():
+    async def generate():
+        await asyncio.sleep(0.01)
+        raise ValueError("boom")
+
+    async def main():
+        flight = SingleFlight()
+        results = await asyncio.gather(*[flight.do("key", generate) for _ in range(2)], return_exceptions=True)
+        return results, flight.stats()["in_flight"]
+
+    results, in_flight = asyncio.run(main())
+    assert [str(error) for error in results] == ["boom", "boom"]
+    assert in_flight == 0
+
+
+def test_a_caller_giving_up_does_not_cancel_the_others():
+    async def generate():
+        await asyncio.sleep(0.05)
+        return "reply"
+
+    async def main():
+        flight = SingleFlight()
+        first = asyncio.ensure_future(flight.do("key", generate))
+        second = asyncio.ensure_future(flight.do("key", generate))
+        await asyncio.sleep(0.01)
+        first.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await first
+        return await second
+
+    assert asyncio.run(main()) == ("reply", True)
@@ -0,0 +1,89 @@
+"""Checks for prompt-lookup speculative decoding"""
+import torch
+from transformers import DynamicCache, LlamaConfig, LlamaForCausalLM, LogitsProcessorList
+
+from speculative import PromptLookupDrafter, SpeculativeDecoder, sampling_processors
+
+PROMPT = [5, 6, 7, 8, 9, 5, 6, 7, 8, 9, 5, 6]
+
+
+def tiny_model():
+    torch.manual_seed(0)
+    config = LlamaConfig(
+        vocab_size=32, hidden_size=32, intermediate_size=64, num_hidden_layers=2,
+        num_attention_heads=4, num_key_value_heads=2, max_position_embeddings=128
+    )
+    return LlamaForCausalLM(config).eval()
+
+
+def greedy(model, ids, max_new_tokens):
+    ids = list(ids)
+    with torch.no_grad():
+        for _ in range(max_new_tokens):
+            ids.append(int(model(input_ids=torch.tensor([ids])).logits[0, -1].argmax()))
+    return ids
+
+
+class FixedDrafter(PromptLookupDrafter):
+    """Always drafts the same tokens, so most drafts are rejected"""
+
+    def propose(self, ids, limit):
+        return [1, 2, 3][:max(0, limit)]
+
+
+def test_drafts_what_followed_the_latest_match():
+    drafter = PromptLookupDrafter(num_tokens=3, max_ngram=2)
+    assert drafter.propose([1, 2, 3, 4, 1, 2], 8) == [3, 4, 1]
+    # The longer n-gram wins over a later single-token match
+    assert drafter.propose([7, 8, 1, 9, 8, 9, 7, 8], 8) == [1, 9, 8]
+    assert drafter.propose([1, 2, 3, 4, 1, 2], 2) == [3, 4]
+    assert drafter.propose([1, 2, 3], 8) == []
+    assert drafter.propose([1, 2, 1], 0) == []
+
+
+def test_greedy_output_matches_plain_decoding():
+    model = tiny_model()
+    for drafter in (PromptLookupDrafter(num_tokens=4), FixedDrafter()):
+        decoder = SpeculativeDecoder(drafter)
+        cache = DynamicCache()
+        with torch.no_grad():
+            output, info = decoder.generate(
+                model, torch.tensor([PROMPT]), cache, LogitsProcessorList(), [], 12, do_sample=False
+            )
+        assert output[0].tolist() == greedy(model, PROMPT, 12)
+        # Rejected draft positions were cropped: the cache holds every token but the last
+        assert cache.get_seq_length() == output.shape[1] - 1
+        assert info["forward_passes"] <= 12 and info["accepted"] <= info["drafted"]
+
+
+def test_eos_ends_the_reply():
+    model = tiny_model()
+    eos = greedy(model, PROMPT, 3)[-1]
+    decoder = SpeculativeDecoder(PromptLookupDrafter())
+    with torch.no_grad():
+        output, _ = decoder.generate(
+            model, torch.tensor([PROMPT]), DynamicCache(), LogitsProcessorList(), [], 12, eos_token_id=eos, do_sample=False
+        )
+    ids = output[0].tolist()
+    assert ids[-1] == eos and eos not in ids[len(PROMPT):-1]
+
+
+def test_sampling_stays_within_the_token_budget():
+    model = tiny_model()
+    decoder = SpeculativeDecoder(PromptLookupDrafter())
+    torch.manual_seed(1)
+    with torch.no_grad():
+        output, info = decoder.generate(
+            model, torch.tensor([PROMPT]), DynamicCache(), sampling_processors(0.7, 0.9, 1.2, 3), [], 10
+        )
+    assert output.shape[1] == len(PROMPT) + 10
+    stats = decoder.stats()
+    assert stats["generations"] == 1 and stats["drafted"] == info["drafted"]
+
+
+def test_sampling_processors_follow_the_settings():
+    assert len(sampling_processors(1.0, 1.0)) == 0
+    names = [type(processor).__name__ for processor in sampling_processors(0.3, 0.9, 1.1, 3)]
+    assert names == [
+        "RepetitionPenaltyLogitsProcessor", "NoRepeatNGramLogitsProcessor", "TemperatureLogitsWarper", "TopPLogitsWarper"
+    ]
@@ -0,0 +1,34 @@
+"""Checks for the early-stop reply rules"""
+from stopping import ReplyRules
+from streaming import StreamingReplyFilter
+
+
+def test_trailing_decimal_point_does_not_end_the_reply():
+    rules = ReplyRules(max_sentences=2)
+    assert rules.cut("Sure. It costs $599.") == ("Sure. It costs $599.", False)
+    assert rules.cut("Sure. It costs $599.99") == ("Sure. It costs $599.99", False)
+
+
+def test_price_in_the_last_sentence_is_kept_whole():
+    rules = ReplyRules(max_sentences=2)
+    assert rules.cut("Sure. It costs $599.99. Anything else?") == ("Sure. It costs $599.99.", True)
+
+
+def test_trailing_terminator_ends_a_finished_reply():
+    rules = ReplyRules(max_sentences=1)
+    assert rules.cut("It costs $599.", final=True) == ("It costs $599.", True)
+    assert rules.cut("It costs $599.") == ("It costs $599.", False)
+
+
+def test_role_marker_and_length_cut():
+    rules = ReplyRules(max_sentences=2, max_chars=20, role_markers=("Customer:",))
+    assert rules.cut("Yes we do customer: hi") == ("Yes we do ", True)
+    assert rules.cut("one two three four five six seven") == ("one two three four", True)
+
+
+def test_streaming_filter_waits_for_the_decimals():
+    reply_filter = StreamingReplyFilter(ReplyRules(max_sentences=1))
+    for delta in ["It costs", " $599", ".", "99", ". More"]:
+        reply_filter.feed(delta)
+    assert reply_filter.done
+    assert reply_filter.reply == "It costs $599.99."